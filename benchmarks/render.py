@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+Render benchmarks for every template against synthetic environments of growing size.
+
+For each scenario (number of Cassandra instances, extra public load balancers and availability zones) every
+template configured for the environment is rendered: the template's constructor (which runs configure()),
+to_json(), and the diff apply shows against the smallest scenario's render. Every render is also split into nested
+stacks and merged back, as apply does with a deployed split stack, which has to diff clean against the render. AWS
+is answered from synthetic data generated for the scenario by a handler on botocore's before-call event, the same
+hook --replay uses, so the benchmarks need neither network access nor credentials.
+
+    python benchmarks/render.py --out before.json
+    python benchmarks/render.py --out after.json --compare before.json
+"""
+import argparse
+import copy
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # templates read instance-data/ relative to the working directory
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+from botocore.awsrequest import AWSResponse  # noqa: E402
+
+from config import constants  # noqa: E402
+from templates import TEMPLATES  # noqa: E402
+from utils import aws, cache, nested  # noqa: E402
+from utils.diff import TemplateDiff  # noqa: E402
+
+ENV = 'benchmark'
+BASE_ENV = 'appdev'
+
+# (cassandra instances, extra public load balancers, zones); the first scenario is the diff baseline
+SCENARIOS = [
+    (3, 1, 3),
+    (30, 1, 3),
+    (300, 1, 3),
+    (3, 10, 3),
+    (3, 50, 3),
+    (3, 1, 6),
+    (3, 1, 12),
+    (300, 50, 12),
+]
+QUICK_SCENARIOS = [(3, 1, 3), (30, 10, 6)]
+
+
+def scenario_name(scenario):
+    return 'cassandra={}-lbs={}-zones={}'.format(*scenario)
+
+
+def synthetic_environment(cassandra_instances, load_balancers, zones):
+    """
+    :return: (dict) a copy of the BASE_ENV configuration scaled to the scenario
+    """
+    env = copy.deepcopy(constants.ENVIRONMENTS[BASE_ENV])
+    region = env['region']
+    env['vpc']['zones'] = [{
+        'public-cidrblock': '10.20.{}.0/24'.format(i),
+        'private-cidrblock': '10.20.{}.0/24'.format(100 + i),
+        'availability-zone': '{}{}'.format(region, chr(ord('a') + i)),
+        'preferred': i == 0,
+    } for i in range(zones)]
+    env['cassandra']['clusters'][0]['instances'] = [
+        {'ip': '10.20.{}.{}'.format(100 + i % zones, 10 + i // zones)} for i in range(cassandra_instances)]
+    env['mesos']['master']['masters'] = ['10.20.{}.5'.format(100 + i % zones) for i in range(3)]
+    env['mesos']['agent']['extra_public_load_balancers'] = [
+        {'name': 'extra{}'.format(i), 'cert': env['mesos']['agent']['public_elb_cert']}
+        for i in range(load_balancers)]
+    for db in env.get('rds', []):
+        db.setdefault('admin_pass', 'benchmark')
+    return env
+
+
+class SyntheticAWS(object):
+    """
+    Answers the describe calls templates make with data derived from the current environment's configuration
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.operations = {
+            'DescribeVpcs': self._vpcs,
+            'DescribeSubnets': self._subnets,
+            'DescribeRouteTables': self._route_tables,
+            'DescribeSecurityGroups': lambda params: {'SecurityGroups': []},
+            'DescribeImages': self._images,
+            'GetCallerIdentity': lambda params: {'Account': '123456789012', 'Arn': 'arn', 'UserId': 'benchmark'},
+            'DescribeInstanceTypes': self._instance_types,
+        }
+
+    def install(self):
+        events = aws.get_session().events
+        events.register_first('before-parameter-build.*.*', self._capture_params, unique_id='benchmark-params')
+        events.register_first('before-call.*.*', self._respond, unique_id='benchmark-respond')
+
+    def _capture_params(self, params, context, **kwargs):
+        context['benchmark_params'] = copy.deepcopy(params)
+
+    def _respond(self, model, context, **kwargs):
+        self.calls += 1
+        if model.name not in self.operations:
+            raise RuntimeError('No synthetic response for {}'.format(model.name))
+        parsed = self.operations[model.name](context.get('benchmark_params', {}))
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': 200, 'HTTPHeaders': {}, 'RetryAttempts': 0}
+        return AWSResponse('https://benchmark', 200, {}, None), parsed
+
+    @staticmethod
+    def _config():
+        return constants.ENVIRONMENTS[ENV]
+
+    def _vpcs(self, params):
+        return {'Vpcs': [{'VpcId': 'vpc-benchmark', 'CidrBlock': self._config()['vpc']['cidrblock']}]}
+
+    def _subnets(self, params):
+        subnets = []
+        for i, zone in enumerate(self._config()['vpc']['zones']):
+            for kind, public in (('public', True), ('private', False)):
+                subnets.append({
+                    'SubnetId': 'subnet-{}{}'.format(kind, i),
+                    'VpcId': 'vpc-benchmark',
+                    'CidrBlock': zone['{}-cidrblock'.format(kind)],
+                    'AvailabilityZone': zone['availability-zone'],
+                    'MapPublicIpOnLaunch': public,
+                })
+        return {'Subnets': subnets}
+
+    def _route_tables(self, params):
+        return {'RouteTables': [{
+            'RouteTableId': 'rtb-{}{}'.format(role, i),
+            'VpcId': 'vpc-benchmark',
+            'Tags': [{'Key': '{}:role'.format(constants.TAG), 'Value': role}],
+        } for role in ('public', 'private') for i in range(len(self._config()['vpc']['zones']))]}
+
+    def _instance_types(self, params):
+        return {'InstanceTypes': [{
+            'InstanceType': name,
+            'VCpuInfo': {'DefaultVCpus': 4},
+            'MemoryInfo': {'SizeInMiB': 16384},
+            'NetworkInfo': {'NetworkPerformance': 'Up to 10 Gigabit'},
+            'EbsInfo': {'EbsOptimizedSupport': 'default'},
+        } for name in params.get('InstanceTypes', [])]}
+
+    def _images(self, params):
+        names = [v for f in params.get('Filters', []) if f['Name'] == 'name' for v in f['Values']]
+        return {'Images': [{
+            'ImageId': 'ami-{:08x}'.format(zlib.crc32(name.encode('utf-8'))),
+            'Name': name.replace('*', '').replace('?', '0'),
+            'CreationDate': '2020-01-01T00:00:00.000Z',
+            'OwnerId': '123456789012',
+            'State': 'available',
+        } for name in names]}
+
+
+def _render(template_name):
+    template = TEMPLATES[template_name](template_name, ENV, {})
+    return template, template.to_json()
+
+
+def check_split_round_trip(rendered):
+    """
+    Splits a render into nested stacks and merges them back the way apply reads a deployed split stack
+    :raise: RuntimeError if the merged template does not diff clean against the render
+    """
+    parent, children = nested.split_template(json.loads(json.dumps(rendered)))
+    merged, _ = nested.merge_template(parent, children)
+    lines = list(TemplateDiff(rendered, merged).lines())
+    if len(lines) > 1:
+        raise RuntimeError('splitting into {} nested stacks and merging them back changes {} lines, e.g. {}'.format(
+            len(children), len(lines) - 1, lines[0]))
+
+
+def measure(template_name, baseline, repeat):
+    """
+    Times one template in the current environment
+    :param baseline: (dict) render of the same template in the first scenario, the old side of the diff
+    :return: (dict) timings in seconds, peak traced memory in bytes, size and AWS calls
+    """
+    configure, to_json, diff = [], [], []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        template = TEMPLATES[template_name](template_name, ENV, {})
+        configured = time.perf_counter()
+        body = template.to_json()
+        rendered = time.perf_counter()
+        for _ in TemplateDiff(baseline, json.loads(body)).lines():
+            pass
+        diffed = time.perf_counter()
+        configure.append(configured - start)
+        to_json.append(rendered - configured)
+        diff.append(diffed - rendered)
+
+    gc.collect()
+    tracemalloc.start()
+    _render(template_name)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    check_split_round_trip(json.loads(body))
+    return {
+        'configure': statistics.median(configure),
+        'to_json': statistics.median(to_json),
+        'diff': statistics.median(diff),
+        'peak_memory': peak,
+        'resources': len(template.resources),
+        'bytes': len(body),
+    }
+
+
+def run(scenarios, template_names, repeat):
+    aws_stub = SyntheticAWS()
+    aws_stub.install()
+    # every render does its own discovery, so the cost of discovery is part of configure()
+    cache.configure(mode='off')
+
+    results = {}
+    baselines = {}
+    for scenario in scenarios:
+        constants.ENVIRONMENTS[ENV] = synthetic_environment(*scenario)
+        names = [t for t in template_names if TEMPLATES[t].is_enabled(ENV)]
+        for template_name in names:
+            key = '{}/{}'.format(scenario_name(scenario), template_name)
+            calls = aws_stub.calls
+            try:
+                if template_name not in baselines:
+                    baselines[template_name] = json.loads(_render(template_name)[1])
+                    calls = aws_stub.calls
+                result = measure(template_name, baselines[template_name], repeat)
+            except Exception as e:
+                # e.g. more resources than one template may hold; recorded so comparisons show the change
+                results[key] = {'error': '{}: {}'.format(type(e).__name__, e)}
+                print('{:<36} {:<16} {}'.format(scenario_name(scenario), template_name, results[key]['error']))
+                continue
+            result['aws_calls'] = (aws_stub.calls - calls) // (repeat + 1)
+            results[key] = result
+            print('{:<36} {:<16} configure {:>8.1f}ms  to_json {:>8.1f}ms  diff {:>8.1f}ms  peak {:>7.1f}MB  '
+                  '{:>5} resources'.format(scenario_name(scenario), template_name, result['configure'] * 1e3,
+                                           result['to_json'] * 1e3, result['diff'] * 1e3,
+                                           result['peak_memory'] / 1e6, result['resources']))
+    return results
+
+
+def compare(results, baseline_path, threshold):
+    """
+    Prints every measurement that got worse than the baseline by more than threshold (a fraction)
+    :return: (int) number of regressions
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    regressions = 0
+    for key, result in sorted(results.items()):
+        if 'error' in result and key in baseline and 'error' not in baseline[key]:
+            regressions += 1
+            print('REGRESSION {} now fails: {}'.format(key, result['error']))
+        if key not in baseline or 'error' in result or 'error' in baseline[key]:
+            continue
+        for metric in ('configure', 'to_json', 'diff', 'peak_memory'):
+            old, new = baseline[key][metric], result[metric]
+            if old and (new - old) / old > threshold and new - old > (1e-3 if metric != 'peak_memory' else 1e5):
+                regressions += 1
+                print('REGRESSION {} {}: {:.4g} -> {:.4g} (+{:.0%})'.format(key, metric, old, new, (new - old) / old))
+    print('{} regressions against {}'.format(regressions, baseline_path))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark template rendering against synthetic environments')
+    parser.add_argument('--out', default='benchmark-results.json',
+                        help='Where to write the results, relative to the repository root')
+    parser.add_argument('--compare', metavar='RESULTS', help='Results of an earlier run to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown (fraction) reported as a regression (default 0.2)')
+    parser.add_argument('--template', action='append', help='Only benchmark this template (repeatable)')
+    parser.add_argument('--repeat', type=int, default=3, help='Renders per measurement, the median is kept')
+    parser.add_argument('--quick', action='store_true', help='Only run two small scenarios')
+    args = parser.parse_args()
+
+    started = time.time()
+    results = run(QUICK_SCENARIOS if args.quick else SCENARIOS, args.template or sorted(TEMPLATES), args.repeat)
+    with open(args.out, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'started': started,
+            'duration': time.time() - started,
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+    print('Wrote {} results to {}'.format(len(results), args.out))
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
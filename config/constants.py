@@ -73,6 +73,8 @@ ENVIRONMENTS = {
         'mesos': {
             'master': {
                 'instance_type': 't3.medium',
+                # Optional: 'cluster', 'spread' or 'partition' (with 'partition_count', default one per zone)
+                # 'placement_group': 'spread',
                 'masters': [
                     '<Private IP>',
                     '<Private IP>',
@@ -86,11 +88,45 @@ ENVIRONMENTS = {
                 'public_elb_cert': 'dev.nxtlytics.dev',
                 'rootfs_size': 20,
                 'dockervol_size': 50,
+                # 'instance-store' keeps docker's overlay on the NVMe instance store (i3, i4i, m5d, c5d, ...)
+                # 'docker_storage': 'instance-store',
                 'preferred_placement': True,  # Place all instances in a single AZ to save inter-AZ bandwidth costs
                 'count': {
                     'public': 0,
                     'private': 1
                 },
+                # Optional, per placement: instance types to choose from and the share of Spot instances
+                # 'capacity': {
+                #     'private': {
+                #         'instance_types': ['c5.4xlarge', 'c5a.4xlarge', 'c5n.4xlarge', 'm5.4xlarge'],
+                #         'on_demand_base': 1,
+                #         'spot_percentage': 70,
+                #         'spot_allocation_strategy': 'capacity-optimized'
+                #     }
+                # },
+                # Optional, per placement: target tracking scaling between count and max_size (default 100)
+                # 'scaling': {
+                #     'private': {
+                #         'max_size': 20,
+                #         'cpu': 60,  # average CPU utilization, in percent
+                #         'requests_per_target': 1000,  # ALB requests per agent and minute
+                #         'requests_load_balancer': 'external',  # default 'internal'
+                #         'allocation': 75,  # share of CPUs allocated to Mesos tasks, published by the agents
+                #         'disable_scale_in': True
+                #     }
+                # },
+                # Optional, per placement: agents that already ran their one-time setup, ready for scale-out
+                # 'warm_pool': {
+                #     'private': {
+                #         'min_size': 2,
+                #         'max_prepared': 10,  # in service and in the pool, default max_size
+                #         'state': 'Stopped',  # or 'Running' or 'Hibernated'
+                #         'reuse_on_scale_in': True
+                #     }
+                # },
+                # 'instance_warmup': 300,  # seconds before a new agent counts towards the scaling metrics
+                # 'scaling_cooldown': 300,
+                # 'protect_from_scale_in': True,
                 'iam_roles': [
                     {
                         'name': 'SampleBucket',
@@ -107,6 +143,17 @@ ENVIRONMENTS = {
                     'cassandra_template': 'cassandra311',
                     'instance_type': 't3.xlarge',
                     'data_volume_size': 100,
+                    # Any volume (rootfs, data_volume, ...) takes <volume>_type, <volume>_iops and <volume>_throughput
+                    # 'data_volume_type': 'gp3',
+                    # 'data_volume_iops': 6000,
+                    # 'data_volume_throughput': 250,
+                    # 'instance-store' keeps data on the NVMe instance store, the data volume is the fallback
+                    # 'data_storage': 'instance-store',
+                    # Partition placement groups put each rack (availability zone) in its own partition
+                    # 'placement_group': 'partition',
+                    # 'partition_count': 3,
+                    # New data volumes start from the newest snapshot of their node, which then repairs the rest
+                    # 'seed_from_snapshot': True,
                     'instances': [
                         # Template uses the first 3 for seeds
                         {'ip': '<Private IP>'},
@@ -121,7 +168,10 @@ ENVIRONMENTS = {
                 'name': 'app',
                 'engine': 'redis',
                 'multi_az': True,
-                'instance_type': 'cache.t3.small'
+                'instance_type': 'cache.t3.small',
+                # 'replicas_per_node_group': 1,
+                # 'num_node_groups': 3,
+                # 'parameters': {'maxmemory-policy': 'allkeys-lru'}
             }
         ],
         'kafka': [
@@ -129,7 +179,17 @@ ENVIRONMENTS = {
                 'name': 'app',
                 'instance_type': 't3.xlarge',
                 'volume_size': 100,
-                'count': 3
+                'count': 3,
+                # 'cluster' keeps the brokers close together, in availability_zone (default the first private subnet's)
+                # 'placement_group': 'cluster',
+                # 'availability_zone': 'us-west-2a',
+                # Optional, instead of count: one broker per entry, each with a fixed broker ID (default its position),
+                # ENI and retained log volume (log_volume_size, default 100, log_volume_type, ...)
+                # 'brokers': [
+                #     {'ip': '<Private IP>'},
+                #     {'ip': '<Private IP>'},
+                #     {'ip': '<Private IP>', 'id': 3},
+                # ],
             }
         ],
         'rds': [
@@ -11,10 +11,15 @@ CASSANDRA_CLUSTER='__CASSANDRA_CLUSTER__'
 CASSANDRA_CLUSTER_OVERRIDE='__CASSANDRA_CLUSTER_OVERRIDE__'
 CASSANDRA_SEEDS='__CASSANDRA_SEEDS__'
 SERVICE='__SERVICE__'
+DATA_STORAGE='__DATA_STORAGE__'
+# Snapshot the data volume was created from, empty if it started out empty
+DATA_SNAPSHOT_ID='__DATA_SNAPSHOT_ID__'
 # Filled by AWS in Cloudformation
 DATA_EBS_VOLUME_ID='{#CFN_DATA_EBS_VOLUME_ID}'
 ENI_ID='{#CFN_ENI_ID}'
 
+__INSTANCE_STORE_FUNCTIONS__
+
 # TODO: bake me into base!
 function get_ram_mb_by_percent() {
     local PERCENT=$1
@@ -34,8 +39,20 @@ function setup_networking() {
 function setup_volumes() {
     local DEVICE
     local MOUNT_PATH="/mnt/data"
+    local MOUNT_OPTIONS="defaults"
+
+    if [[ "${DATA_STORAGE}" == "instance-store" ]]; then
+        DEVICE=$(get_instance_store_device)
+        if [[ -n "${DEVICE}" ]]; then
+            MOUNT_OPTIONS="defaults,nofail"
+        else
+            echo "No NVMe instance store volumes found, falling back to EBS"
+        fi
+    fi
 
-    if [[ ! -n "${DATA_EBS_VOLUME_ID:-''}" ]]; then
+    if [[ -n "${DEVICE}" ]]; then
+        echo "Using instance store ${DEVICE}"
+    elif [[ -n "${DATA_EBS_VOLUME_ID}" ]]; then
         DEVICE="/dev/sdf"
         attach_ebs $(get_instance_id) ${DATA_EBS_VOLUME_ID} ${DEVICE}
         if [ $? -ne 0 ]; then
@@ -72,9 +89,12 @@ function setup_volumes() {
         mkdir -p ${MOUNT_PATH}/cassandra/data
         mkdir -p ${MOUNT_PATH}/cassandra/commitlog
         chown -R cassandra: ${MOUNT_PATH}/cassandra
+    elif [[ -n "${DATA_SNAPSHOT_ID}" && "${DEVICE}" == "/dev/sdf" && ! -f ${MOUNT_PATH}/cassandra/.repaired-${DATA_SNAPSHOT_ID} ]]; then
+        # Restored from a snapshot: the node keeps its identity and only repairs what changed since
+        REPAIR_MARKER=${MOUNT_PATH}/cassandra/.repaired-${DATA_SNAPSHOT_ID}
     fi
 
-    local FSTAB="${DEVICE} ${MOUNT_PATH} ext4 defaults 0 0"
+    local FSTAB="${DEVICE} ${MOUNT_PATH} ext4 ${MOUNT_OPTIONS} 0 0"
     sed -i '/${DEVICE}/d' /etc/fstab
     echo ${FSTAB} >> /etc/fstab
 }
@@ -289,6 +309,26 @@ EOF
     service datadog-agent restart
 }
 
+function repair_restored_data() {
+    if [[ -z "${REPAIR_MARKER}" ]]; then
+        return
+    fi
+    # Wait for the node to be up and normal, then repair its ranges, all in the background so a node that does not
+    # come up does not hold up the rest of the bootstrap
+    (
+        DEADLINE=$(( $(date +%s) + 3600 ))
+        until nodetool status 2>/dev/null | grep -q "^UN  ${ENI_IP} "; do
+            if [[ $(date +%s) -ge ${DEADLINE} ]]; then
+                logger -s -t cassandra-restore "${ENI_IP} is not up after an hour, data restored from" \
+                    "${DATA_SNAPSHOT_ID} was not repaired"
+                exit 1
+            fi
+            sleep 10
+        done
+        nodetool repair --full && touch ${REPAIR_MARKER}
+    ) > /var/log/cassandra/restore-repair.log 2>&1 &
+}
+
 function setup_consul() {
     # Register with Consul
     cat <<EOF > /etc/consul.d/${SERVICE}.json
@@ -318,3 +358,4 @@ update_java
 setup_cassandra
 setup_datadog
 setup_consul
+repair_restored_data
@@ -0,0 +1,27 @@
+# Included by templates that can keep their data on NVMe instance store volumes
+
+# Prints the device made from the NVMe instance store volumes of this instance: the volume itself when there is
+# one, a RAID0 array of them when there are several, nothing when the instance type has none.
+function get_instance_store_device() {
+    local RAID_DEVICE="/dev/md0"
+    local DEVICES=($(lsblk -dpno NAME,MODEL | awk '/Amazon EC2 NVMe Instance Storage/ {print $1}'))
+
+    if [ ${#DEVICES[@]} -eq 0 ]; then
+        return
+    elif [ ${#DEVICES[@]} -eq 1 ]; then
+        echo ${DEVICES[0]}
+        return
+    fi
+
+    # The array survives a reboot (but not a stop), assemble it again if it is already there
+    if [ ! -b ${RAID_DEVICE} ]; then
+        which mdadm > /dev/null 2>&1 || yum install -y mdadm > /dev/null 2>&1
+        mdadm --assemble ${RAID_DEVICE} ${DEVICES[@]} > /dev/null 2>&1 || \
+            mdadm --create ${RAID_DEVICE} --level=0 --raid-devices=${#DEVICES[@]} --force --run ${DEVICES[@]} > /dev/null 2>&1
+        if [ $? -ne 0 ]; then
+            return
+        fi
+        mdadm --detail --scan > /etc/mdadm.conf
+    fi
+    echo ${RAID_DEVICE}
+}
@@ -6,7 +6,15 @@ source /opt/ivy/bash_functions.sh
 ### CONFIG ###
 ###
 CLUSTER_NAME="__CLUSTER_NAME__"
-NAME="${CLUSTER_NAME}-$(get_instance_id)"
+# Brokers with a stable identity, filled by AWS in Cloudformation, empty for brokers of a shared autoscaling group
+BROKER_ID="__BROKER_ID__"
+ENI_ID="{#CFN_ENI_ID}"
+LOG_EBS_VOLUME_ID="{#CFN_LOG_EBS_VOLUME_ID}"
+if [[ -n "${BROKER_ID}" ]]; then
+    NAME="${CLUSTER_NAME}-${BROKER_ID}"
+else
+    NAME="${CLUSTER_NAME}-$(get_instance_id)"
+fi
 REGION=$(get_region)
 set_hostname ${NAME}
 set_prompt_color "__PROMPT_COLOR__"
@@ -19,6 +27,49 @@ function get_ram_mb_by_percent() {
     echo ${MB}
 }
 
+function setup_networking() {
+    if [[ -z "${ENI_ID}" ]]; then
+        return
+    fi
+    ENI_IP=$(get_eni_ip ${ENI_ID})
+    attach_eni $(get_instance_id) ${ENI_ID}
+}
+
+function setup_log_volume() {
+    local DEVICE="/dev/sdf"
+    local MOUNT_PATH="/mnt/kafka"
+
+    if [[ -z "${LOG_EBS_VOLUME_ID}" ]]; then
+        return
+    fi
+    attach_ebs $(get_instance_id) ${LOG_EBS_VOLUME_ID} ${DEVICE}
+    if [ $? -ne 0 ]; then
+        echo "Error attach volume, aborting"
+        exit 1
+    fi
+
+    # the volume outlives brokers, only format it the first time
+    if ! file -sL ${DEVICE} | grep -q "XFS"; then
+        echo "Device needs formatting..."
+        mkfs.xfs ${DEVICE}
+        if [ $? -ne 0 ]; then
+            echo "Error formatting volume, aborting"
+            exit 1
+        fi
+    fi
+
+    mkdir -p ${MOUNT_PATH}
+    mount ${DEVICE} ${MOUNT_PATH}
+    if [ $? -ne 0 ]; then
+        echo "Error mounting volume, aborting"
+        exit 1
+    fi
+    mkdir -p ${MOUNT_PATH}/logs
+    chown -R kafka: ${MOUNT_PATH}
+
+    echo "${DEVICE} ${MOUNT_PATH} xfs defaults,nofail 0 0" >> /etc/fstab
+}
+
 function setup_consul() {
     # Register with Consul
     cat <<EOF > /etc/consul.d/${CLUSTER_NAME}.json
@@ -69,6 +120,17 @@ log.retention.ms=259200000
 delete.topic.enable=true
 EOF
 
+    # Brokers with a stable identity keep their ID, address and logs across replacements
+    if [[ -n "${BROKER_ID}" ]]; then
+        sed -i -e '/^broker.id=/d' -e '/^log.dirs=/d' -e '/^advertised.listeners=/d' /etc/kafka/server.properties
+        cat <<EOF >> /etc/kafka/server.properties
+
+broker.id=${BROKER_ID}
+log.dirs=/mnt/kafka/logs
+advertised.listeners=PLAINTEXT://${ENI_IP}:9092
+EOF
+    fi
+
     JVM_HEAP=$(get_ram_mb_by_percent .55)
     echo "KAFKA_HEAP_OPTS=\"-Xmx${JVM_HEAP}m -Xms${JVM_HEAP}m\"" >> /etc/sysconfig/kafka
 }
@@ -98,6 +160,8 @@ function setup_swap() {
     echo "Finished setting up swap"
 }
 
+setup_networking
+setup_log_volume
 setup_consul
 #setup_swap
 configure_kafka
@@ -7,15 +7,34 @@ source /opt/ivy/bash_functions.sh
 ###
 PLACEMENT="__PLACEMENT__"
 ZK_CONNECT="__ZK_CONNECT__"
+DOCKER_STORAGE="__DOCKER_STORAGE__"
+PUBLISH_ALLOCATION="__PUBLISH_ALLOCATION__"
+WARM_POOL="__WARM_POOL__"
+LIFECYCLE_HOOK="__LIFECYCLE_HOOK__"
 CLUSTER_NAME="mesos-$(get_environment)"
 AVAILABILITY_ZONE=$(get_availability_zone)
 ENVIRONMENT=$(get_environment)
 INSTANCE_ID=$(get_instance_id)
 IP=$(get_ip_from_interface eth0)
+# Written once the agent joined the cluster, later boots leave it alone
+JOINED_MARKER=/opt/ivy/.mesos-agent-joined
+
+__INSTANCE_STORE_FUNCTIONS__
 
 function setup_docker_overlay() {
     local DEVICE="/dev/xvdb"
     local MOUNT_PATH="/mnt/docker"
+    local MOUNT_OPTIONS="defaults"
+
+    if [[ "${DOCKER_STORAGE}" == "instance-store" ]]; then
+        local INSTANCE_STORE=$(get_instance_store_device)
+        if [[ -n "${INSTANCE_STORE}" ]]; then
+            DEVICE=${INSTANCE_STORE}
+            MOUNT_OPTIONS="defaults,nofail"
+        else
+            echo "No NVMe instance store volumes found, using ${DEVICE}"
+        fi
+    fi
 
     service docker stop
     sleep 2
@@ -30,8 +49,8 @@ function setup_docker_overlay() {
     # TODO: can probably remove this once it's baked into the AMI(?)
     echo 'DOCKER_STORAGE_OPTIONS="--storage-driver overlay2"' > /etc/sysconfig/docker-storage
 
-    local FSTAB="${DEVICE} ${MOUNT_PATH} xfs defaults 0 0"
-    sed -i '/${DEVICE}/d' /etc/fstab
+    local FSTAB="${DEVICE} ${MOUNT_PATH} xfs ${MOUNT_OPTIONS} 0 0"
+    sed -i "\| ${MOUNT_PATH} |d" /etc/fstab
     echo ${FSTAB} >> /etc/fstab
 
     service docker start
@@ -43,6 +62,11 @@ function setup_docker_config() {
     # failure of the entire cloud-init script
     mkdir /root/.docker
     curl --fail -o /root/.docker/config.json http://localhost:8500/v1/kv/config/infrastructure/docker_config?raw || true
+
+    if [[ -f /root/.docker/config.json ]]; then
+        # custom docker options (auth/etc)
+        echo 'file:///root/.docker/config.json' > /etc/mesos-slave/docker_config
+    fi
 }
 
 function setup_mesos_agent() {
@@ -94,11 +118,6 @@ EOF
     echo org_apache_mesos_LogrotateContainerLogger > /etc/mesos-slave/container_logger
     echo '/mnt/docker/work_dir' > /etc/mesos-slave/work_dir
 
-    if [[ -f /root/.docker/config.json ]]; then
-        # custom docker options (auth/etc)
-        echo 'file:///root/.docker/config.json' > /etc/mesos-slave/docker_config
-    fi
-
     # Set Mesos Slave attributes
     if [[ ! -d "/etc/mesos-slave/attributes" ]]; then
         mkdir -p /etc/mesos-slave/attributes
@@ -157,6 +176,23 @@ function setup_consul() {
 EOF
 }
 
+function setup_allocation_metric() {
+    # Agents of this placement scale on the average share of their CPUs allocated to Mesos tasks
+    if [[ "${PUBLISH_ALLOCATION}" != "true" ]]; then
+        return
+    fi
+
+    cat <<'EOF' > /opt/ivy/publish_allocation.sh
+#!/bin/bash
+source /opt/ivy/bash_functions.sh
+AVAILABILITY_ZONE=$(get_availability_zone)
+PERCENT=$(curl -s --fail http://localhost:5051/metrics/snapshot | python -c 'import json, sys; print(json.load(sys.stdin)["slave/cpus_percent"] * 100)') || exit 0
+aws cloudwatch put-metric-data --region ${AVAILABILITY_ZONE%?} --namespace Mesos --metric-name CpusAllocatedPercent \
+    --dimensions Environment=$(get_environment),Placement=__PLACEMENT__ --unit Percent --value ${PERCENT}
+EOF
+    echo "* * * * * root bash /opt/ivy/publish_allocation.sh" > /etc/cron.d/mesos-allocation-metric
+}
+
 function setup_datadog() {
   # 99th percentile, enable if needed
   #sed -i -e "s/# histogram_percentiles:.*/histogram_percentiles: 0.95, 0.99/" /etc/datadog-agent/datadog.yaml
@@ -209,28 +245,113 @@ instances:
     thresholds:
       critical: [1, 20]
 EOF
+}
+
+function setup_host() {
+    set_hostname mesos-agent-${INSTANCE_ID}
+    set_prompt_color "__PROMPT_COLOR__"
+}
+
+function start_consul() {
+    setup_consul
+    bash /opt/ivy/configure_consul.sh
+}
+
+function start_services() {
+    # Enable statically configured services
+    systemctl enable haproxy mesos-slave consul-template
+    systemctl start haproxy mesos-slave consul-template
+
+    # Start dynamically configured services
+    bash /opt/ivy/setup_registrator.sh
+    bash /opt/ivy/ec2metaproxy.sh
+}
+
+# Warm pools: one-time setup, done before an instance enters the warm pool. Nothing in it needs consul.
+function prepare_agent() {
+    setup_host
+    setup_docker_overlay
+    setup_mesos_agent
+    setup_allocation_metric
+    setup_datadog
+}
+
+# Warm pools: done when the instance goes into service
+function join_cluster() {
+    # Start consul before enabling any services that require it
+    start_consul
+    setup_docker_config
+    service datadog-agent restart
+    start_services
+}
+
+function get_target_lifecycle_state() {
+    curl -s http://169.254.169.254/latest/meta-data/autoscaling/target-lifecycle-state
+}
 
-  service datadog-agent restart
+function complete_lifecycle_action() {
+    local REGION=${AVAILABILITY_ZONE%?}
+    local ASG=$(aws autoscaling describe-auto-scaling-instances --region ${REGION} --instance-ids ${INSTANCE_ID} \
+        --query 'AutoScalingInstances[0].AutoScalingGroupName' --output text)
+    aws autoscaling complete-lifecycle-action --region ${REGION} --auto-scaling-group-name ${ASG} \
+        --lifecycle-hook-name ${LIFECYCLE_HOOK} --instance-id ${INSTANCE_ID} --lifecycle-action-result CONTINUE || true
+}
+
+# Joins the cluster once the instance leaves the warm pool: on the next boot for stopped pools, as soon as the
+# target lifecycle state changes for running and hibernated ones
+function setup_warm_pool_join() {
+    cp $0 /opt/ivy/mesos-agent.sh
+    cat <<EOF > /etc/systemd/system/mesos-agent-join.service
+[Unit]
+Description=Join the Mesos cluster when the instance goes into service
+After=network-online.target docker.service
+
+[Service]
+Type=simple
+ExecStart=/bin/bash /opt/ivy/mesos-agent.sh join
+
+[Install]
+WantedBy=multi-user.target
+EOF
+    systemctl daemon-reload
+    systemctl enable mesos-agent-join
 }
 
 # Don't let your dreams be dreams! DO IT!
-set_hostname mesos-agent-${INSTANCE_ID}
-set_prompt_color "__PROMPT_COLOR__"
-
-# Start consul before enabling any services that require it
-setup_consul
-bash /opt/ivy/configure_consul.sh
-
-# Enable services
-setup_docker_overlay
-setup_docker_config
-setup_mesos_agent
-setup_datadog
-
-# Enable statically configured services
-systemctl enable haproxy mesos-slave consul-template
-systemctl start haproxy mesos-slave consul-template
-
-# Start dynamically configured services
-bash /opt/ivy/setup_registrator.sh
-bash /opt/ivy/ec2metaproxy.sh
+if [[ "$1" == "join" ]]; then
+    until [[ "$(get_target_lifecycle_state)" == "InService" ]]; do
+        sleep 5
+    done
+    # Stopping the instance in the warm pool wiped its instance store volumes, and with them docker's overlay
+    if [[ "${DOCKER_STORAGE}" == "instance-store" ]] && ! mountpoint -q /mnt/docker; then
+        setup_docker_overlay
+    fi
+    if [[ ! -f ${JOINED_MARKER} ]]; then
+        join_cluster
+        touch ${JOINED_MARKER}
+    fi
+    # A no-op unless the instance is launching from the warm pool
+    complete_lifecycle_action
+elif [[ "${WARM_POOL}" == "true" ]]; then
+    prepare_agent
+    setup_warm_pool_join
+    if [[ "$(get_target_lifecycle_state)" == Warmed:* ]]; then
+        complete_lifecycle_action
+    fi
+    systemctl start --no-block mesos-agent-join
+else
+    setup_host
+
+    # Start consul before enabling any services that require it
+    start_consul
+
+    # Enable services
+    setup_docker_overlay
+    setup_docker_config
+    setup_mesos_agent
+    setup_allocation_metric
+    setup_datadog
+    service datadog-agent restart
+
+    start_services
+fi
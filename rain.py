@@ -1,19 +1,43 @@
 #!/usr/bin/env python
 import argparse
-import datetime
-import difflib
+import atexit
+import concurrent.futures
+import hashlib
 import json
 import pprint
 import os
+import subprocess
 import sys
+import threading
 import time
 
-import boto3
-import botocore.exceptions
-import json_tools
-
 from templates import TEMPLATES
 from config import constants
+from utils import aws, cache, nested, trace
+from utils.amis import get_ami_catalog
+from utils.diff import TemplateDiff
+from utils.stack_graph import DependencyError, StackGraph, find_exports, find_imports
+
+# botocore and boto3 (and the template modules) are imported where they are used, so listing commands and
+# --help do not pay for them
+
+# Output every stack carries with the fingerprint of what rain applied to it
+FINGERPRINT_OUTPUT = 'RainFingerprint'
+
+_output_lock = threading.Lock()
+_output = threading.local()
+
+
+def say(message='', prefix=None):
+    """
+    Prints a message as one block, prefixing every line with the stack the calling thread is applying.
+    Keeps the output of concurrent applies readable when they share one terminal.
+    """
+    if prefix is None:
+        prefix = getattr(_output, 'prefix', '')
+    with _output_lock:
+        for line in str(message).split('\n'):
+            print(prefix + line)
 
 
 def confirm_choice(message):
@@ -31,53 +55,33 @@ def confirm_choice(message):
         sys.stdout.write("Please respond with 'yes' or 'no'")
 
 
-def print_reduced(diff):
-    """ Prints JSON diff in reduced format (similar to plain diffs).
+def wait_for_completion(env, stack_id):
     """
-    for action in diff:
-        if 'add' in action:
-            print('+ {}:\n{}'.format(action['add'], json.dumps(action['value'], indent=4)))
-        elif 'remove' in action:
-            print('- {}:\n{}'.format(action['remove'], json.dumps(action['prev'], indent=4)))
-        elif 'replace' in action:
-            prev = json.dumps(action['prev'])
-            new = json.dumps(action['value'])
-            print('{}:\n'.format(action['replace']))
-            # try:
-            for line in difflib.ndiff((prev, ), (new, )):
-                print(line)
-            # except Exception as e:
-            #     print(action)
-            #     print('? {}:\n{}'.format(action['add'], json.dumps(action['value'], indent=4)))
-        print("\n-----------------------------------\n")
-
+    Prints the stack's events as they arrive until the current operation finishes
+    :return: (bool) True if the stack operation succeeded
+    """
+    from utils import events
 
-def wait_for_completion(env, stack_id):
-    conn = boto3.client('cloudformation', region_name=constants.ENVIRONMENTS[env]['region'])
-    print('Waiting for stack {}...'.format(stack_id))
-    last_event = conn.describe_stack_events(StackName=stack_id)['StackEvents'][0]
-    failed = False
-    while not (last_event['ResourceType'] == 'AWS::CloudFormation::Stack' and
-               last_event['ResourceStatus'] in ['CREATE_FAILED', 'CREATE_COMPLETE', 'DELETE_FAILED',
-                                                'DELETE_COMPLETE', 'ROLLBACK_COMPLETE', 'UPDATE_FAILED',
-                                                'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']):
-        if last_event['ResourceStatus'].endswith('FAILED'):
-            failed = True
-        time.sleep(1)
-        last_event = conn.describe_stack_events(StackName=stack_id)['StackEvents'][0]
-        print('{} StackId: {}, Resource: {ResourceType}, Status: {ResourceStatus}'.
-              format(datetime.datetime.now().isoformat(), stack_id, **last_event))
-    if failed:
-        print('*** Stack apply failed! ***')
+    prefix = getattr(_output, 'prefix', '')
+    say('Waiting for stack {}...'.format(stack_id))
+    with trace.phase('wait'):
+        tail = events.get_tailer(constants.ENVIRONMENTS[env]['region']).wait(
+            stack_id, emit=lambda line: say(line, prefix=prefix))
+    for event in tail.failures:
+        say('Failed: {LogicalResourceId} ({ResourceType}): {ResourceStatusReason}'.format(
+            **dict({'ResourceStatusReason': ''}, **event)))
+    if not tail.succeeded:
+        say('*** Stack apply failed! ({}) ***'.format(tail.status))
     else:
-        print('Stack action complete.')
+        say('Stack action complete.')
+    return tail.succeeded
 
 
 def list_templates():
     """
     List all Troposphere Templates
     """
-    return TEMPLATES
+    return TEMPLATES.paths
 
 
 def list_stacks(env, stack_status_filters=None):
@@ -87,7 +91,7 @@ def list_stacks(env, stack_status_filters=None):
     if stack_status_filters is None:
         stack_status_filters = []
 
-    conn = boto3.client('cloudformation', region_name=constants.ENVIRONMENTS[env]['region'])
+    conn = aws.get_client('cloudformation', constants.ENVIRONMENTS[env]['region'])
     result = conn.list_stacks(StackStatusFilter=stack_status_filters)
     stack_summaries = result['StackSummaries']
     while result.get('NextToken'):
@@ -113,13 +117,140 @@ def confirm_action(f, *args, **kwargs):
         sys.exit(0)
 
 
-def apply_stack(env, template_name, params={}):
-    cfn_conn = boto3.client('cloudformation', region_name=constants.ENVIRONMENTS[env]['region'])
-    s3_conn = boto3.client('s3', region_name=constants.ENVIRONMENTS[env]['region'])
+def get_template(env, template_name, params={}):
     TemplateClass = TEMPLATES.get(template_name, None)
     if not TemplateClass:
         raise RuntimeError('{} not a valid Template Class'.format(template_name))
-    template = TemplateClass(template_name, env, params)
+    return TemplateClass(template_name, env, params)
+
+
+def _template_location(env, template_name, body):
+    """
+    :return: (string, string) bucket and key a template body is uploaded to, derived from the body's hash
+    """
+    return '{}-{}-infra'.format(constants.TAG, env), \
+        'cfn/{}/{}-{}.json'.format(env, template_name, hashlib.sha256(body.encode('utf-8')).hexdigest())
+
+
+def template_url(env, template_name, body):
+    """
+    :return: (string) S3 URL upload_template() puts a template body at, known before uploading it
+    """
+    bucket, key = _template_location(env, template_name, body)
+    return 'https://s3.dualstack.{}.amazonaws.com/{}/{}'.format(constants.ENVIRONMENTS[env]['region'], bucket, key)
+
+
+def upload_template(env, template_name, body):
+    """
+    Uploads a template body too large to pass inline. Keys are derived from the body's hash, so applying an
+    unchanged template again finds the object already there and skips the upload.
+    :return: (string) S3 URL of the template
+    """
+    import botocore.exceptions
+
+    s3_conn = aws.get_client('s3', constants.ENVIRONMENTS[env]['region'])
+    bucket, key = _template_location(env, template_name, body)
+    try:
+        s3_conn.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        s3_conn.put_object(
+            Body=body,
+            Bucket=bucket,
+            ContentType='application/json',
+            Key=key
+        )
+    return template_url(env, template_name, body)
+
+
+def render_template(template, params={}):
+    """
+    Renders a template and stamps it with a fingerprint of the rendered template and its parameters.
+    The fingerprint is computed before it is added, so it only changes when the template or parameters do.
+    :return: (dict, string) the rendered template including the fingerprint output, and the fingerprint
+    """
+    with trace.phase('to_json'):
+        rendered = template.to_dict()
+    fingerprint = hashlib.sha256(json.dumps({'template': rendered, 'parameters': params}, sort_keys=True,
+                                            separators=(',', ':')).encode('utf-8')).hexdigest()
+    rendered.setdefault('Outputs', {})[FINGERPRINT_OUTPUT] = {
+        'Description': 'SHA-256 of the template and parameters rain last applied',
+        'Value': fingerprint
+    }
+    return rendered, fingerprint
+
+
+def describe_stack(env, stack_name):
+    """
+    :return: (dict) the live stack named stack_name, None if there is none
+    """
+    import botocore.exceptions
+
+    conn = aws.get_client('cloudformation', constants.ENVIRONMENTS[env]['region'])
+    try:
+        return conn.describe_stacks(StackName=stack_name)['Stacks'][0]
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ValidationError' and 'does not exist' in e.response['Error']['Message']:
+            return None
+        raise
+
+
+def get_output(stack, key):
+    """
+    :return: (string) value of output key of a described stack, None if the stack has no such output
+    """
+    for output in stack.get('Outputs', []):
+        if output['OutputKey'] == key:
+            return output['OutputValue']
+    return None
+
+
+def get_deployed_template(env, stack_name):
+    """
+    Downloads the template of a live stack, with the resources of nested stacks rain split off merged back in
+    :return: (dict, dict) the template, and logical ID -> nested stack holding it (None for the stack itself)
+    """
+    cfn_conn = aws.get_client('cloudformation', constants.ENVIRONMENTS[env]['region'])
+    # round trip through JSON to turn the parsed template into plain dicts and lists
+    template = json.loads(json.dumps(cfn_conn.get_template(StackName=stack_name)['TemplateBody']))
+    children = {}
+    for logical_id in nested.child_stacks(template):
+        child_id = cfn_conn.describe_stack_resource(
+            StackName=stack_name, LogicalResourceId=logical_id)['StackResourceDetail'].get('PhysicalResourceId')
+        if child_id:
+            children[logical_id] = json.loads(json.dumps(cfn_conn.get_template(StackName=child_id)['TemplateBody']))
+    return nested.merge_template(template, children)
+
+
+def split_template(env, template_name, rendered, old_location=None):
+    """
+    Splits a rendered template into nested stacks, pointing the parent at the URLs the children will be uploaded to
+    :param old_location: (dict) logical ID -> nested stack holding it in the deployed stack, to keep them there
+    :return: (dict, dict, list) the parent template, logical ID -> nested stack holding it (None for the parent),
+             and the (template name, body) of every child to upload before applying the parent
+    """
+    parent, children = nested.split_template(rendered, old_location)
+    location = dict((logical_id, None) for logical_id in parent['Resources'] if logical_id not in children)
+    uploads = []
+    for child_id, child in sorted(children.items()):
+        uploads.append(('{}-{}'.format(template_name, child_id), nested.dumps(child)))
+        parent['Resources'][child_id]['Properties']['TemplateURL'] = template_url(env, *uploads[-1])
+        location.update((logical_id, child_id) for logical_id in child['Resources'])
+        say('{}: {} resources, {} parameters'.format(child_id, len(child['Resources']),
+                                                    len(child.get('Parameters', {}))))
+    return parent, location, uploads
+
+
+def plan_stack(env, template_name, params={}, force=False):
+    """
+    Renders template_name and prints how applying it would change its stack: the diff against the deployed
+    template and the resources that move between nested stacks, or the whole template for a new stack.
+    Stacks whose stored fingerprint matches the rendered template are left alone without diffing.
+    :param force: (bool) diff even if the fingerprint matches
+    :return: (dict) the plan for run_plan(), None if the stack is up to date
+    """
+    template = get_template(env, template_name, params)
     stack_args = {
         'Capabilities': template.CAPABILITIES,
         'Parameters': [
@@ -135,63 +266,496 @@ def apply_stack(env, template_name, params={}):
             {'Key': '{}:environment'.format(constants.TAG), 'Value': env}
         ],
     }
-    if len(template.to_json()) < 51200:
-        stack_args['TemplateBody'] = template.to_json()
+    rendered, fingerprint = render_template(template, params)
+    with trace.phase('to_json'):
+        body = json.dumps(rendered, indent=4, sort_keys=True, separators=(',', ': '))
+    stack = describe_stack(env, stack_args['StackName'])
+    if stack and not force and get_output(stack, FINGERPRINT_OUTPUT) == fingerprint:
+        say('{} is up to date (fingerprint {}), nothing to apply.'.format(stack_args['StackName'], fingerprint[:12]))
+        return None
+    old, old_location = get_deployed_template(env, stack_args['StackName']) if stack else (None, {})
+    # once split, a stack stays split so its resources do not move back and forth between stacks
+    if nested.needs_split(rendered, body) or any(old_location.values()):
+        say('Splitting {} resources into nested stacks'.format(len(rendered['Resources'])))
+        parent, location, uploads = split_template(env, template_name, rendered, old_location)
+        with trace.phase('to_json'):
+            body = nested.dumps(parent)
     else:
-        bucket = '{}-{}-infra'.format(constants.TAG, env)
-        key = 'cfn/{}/{}-{}'.format(env, datetime.datetime.now().strftime('%Y%m%d-%H:%M'), template_name)
-        s3_conn.put_object(
-            Body=template.to_json(),
-            Bucket=bucket,
-            ContentType='application/json',
-            Key=key
-        )
-        stack_args['TemplateURL'] = 'https://s3.dualstack.{}.amazonaws.com/{}/{}'.format(
-            constants.ENVIRONMENTS[env]['region'], bucket, key)
-    if template:
-        if stack_args['StackName'] in [s['StackName']
-                                       for s in list_stacks(env)
-                                       if s['StackStatus'] != 'DELETE_COMPLETE']:
-            # stack exists, update
-            stack_args.pop('Tags', None)  # update_stack can't take Tags
-            old = json.loads(json.dumps(cfn_conn.get_template(**{'StackName': stack_args['StackName']})['TemplateBody']))
-            new = json.loads(template.to_json())
-            print("Proposed changes:")
-            print_reduced(json_tools.diff(old, new))
-            try:
-                response = confirm_action(cfn_conn.update_stack, **stack_args)
-            except botocore.exceptions.ClientError as e:
-                if e.response['Error']['Code'] == 'ValidationError':
-                    print(e.response['Error']['Message'])
-                    sys.exit(0)
-            except:
+        location = dict((logical_id, None) for logical_id in rendered['Resources'])
+        uploads = []
+    if len(body) < 51200:
+        stack_args['TemplateBody'] = body
+    else:
+        uploads.append((template_name, body))
+        stack_args['TemplateURL'] = template_url(env, template_name, body)
+    if stack:
+        stack_args.pop('Tags', None)  # update_stack can't take Tags
+        say("Proposed changes:")
+        with trace.phase('diff'):
+            for line in TemplateDiff(old, rendered).lines():
+                say(line)
+            for logical_id, old_stack, new_stack in nested.moved_resources(old_location, location):
+                say('! {} moves from {} to {} and will be recreated'.format(
+                    logical_id, old_stack or 'the parent stack', new_stack or 'the parent stack'))
+    else:
+        say('Creating a new stack: {}'.format(stack_args['StackName']))
+        say('Template:')
+        say(body)
+    return {'stack_args': stack_args, 'update': bool(stack), 'fingerprint': fingerprint, 'uploads': uploads}
+
+
+def run_plan(env, plan, confirm=True):
+    """
+    Creates or updates a stack as planned by plan_stack() and waits for it to finish
+    :param confirm: (bool) ask before changing the stack
+    :return: (bool) True if the stack is up to date afterwards
+    """
+    import botocore.exceptions
+
+    cfn_conn = aws.get_client('cloudformation', constants.ENVIRONMENTS[env]['region'])
+    run = confirm_action if confirm else lambda f, *args, **kwargs: f(*args, **kwargs)
+
+    def submit(action):
+        # templates only go to S3 once the change is confirmed
+        with trace.phase('upload'):
+            for template_name, body in plan['uploads']:
+                upload_template(env, template_name, body)
+        return action(**plan['stack_args'])
+
+    if plan['update']:
+        try:
+            response = run(submit, cfn_conn.update_stack)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ValidationError':
                 raise
-        else:
-            # Create a new stack
-            print('Creating a new stack: {}'.format(stack_args['StackName']))
-            print('Template:')
-            print(template.to_json())
-            response = confirm_action(cfn_conn.create_stack, **stack_args)
+            # "No updates are to be performed." is the only validation error left after a successful render
+            say(e.response['Error']['Message'])
+            return 'No updates' in e.response['Error']['Message']
+    else:
+        response = run(submit, cfn_conn.create_stack)
 
-        wait_for_completion(env, response['StackId'])
+    succeeded = wait_for_completion(env, response['StackId'])
+    # the stack may have changed the VPC layout or security groups, don't render from stale discovery data
+    cache.get_cache().purge(resource_types=cache.NETWORK_RESOURCE_TYPES,
+                            region=constants.ENVIRONMENTS[env]['region'])
+    return succeeded
+
+
+def apply_stack(env, template_name, params={}, confirm=True, force=False):
+    """
+    Creates or updates the stack for template_name and waits for it to finish.
+    Stacks whose stored fingerprint matches the rendered template are left alone without diffing.
+    :param confirm: (bool) ask before changing the stack
+    :param force: (bool) diff and update even if the fingerprint matches
+    :return: (bool) True if the stack is up to date afterwards
+    """
+    plan = plan_stack(env, template_name, params, force)
+    return run_plan(env, plan, confirm) if plan else True
+
+
+def list_exports(env):
+    """
+    :return: (set) of export names currently published in the environment's region
+    """
+    conn = aws.get_client('cloudformation', constants.ENVIRONMENTS[env]['region'])
+    exports = set()
+    for page in conn.get_paginator('list_exports').paginate():
+        exports.update(e['Name'] for e in page['Exports'])
+    return exports
+
+
+def build_stack_graph(env, template_names, params={}):
+    """
+    Builds the dependency graph between template_names from the templates' DEPENDS_ON declarations and the
+    Fn::ImportValue/Export pairs found by rendering each template. Dependencies outside template_names must
+    already be deployed, otherwise a DependencyError is raised before anything is applied.
+    :return: (StackGraph)
+    """
+    graph = StackGraph()
+    declared = {}
+    for template_name in template_names:
+        if template_name not in TEMPLATES:
+            raise DependencyError('{} not a valid Template Class'.format(template_name))
+        graph.add_node(template_name)
+        declared[template_name] = [d for d in TEMPLATES[template_name].DEPENDS_ON if d != template_name]
+
+    deployed = set(s['StackName'] for s in list_stacks(env) if s['StackStatus'] != 'DELETE_COMPLETE')
+
+    def is_deployed(template_name):
+        return '{}-{}'.format(env, template_name) in deployed
+
+    for template_name, dependencies in declared.items():
+        for dependency in dependencies:
+            if dependency in template_names:
+                graph.add_edge(template_name, dependency)
+            elif not is_deployed(dependency):
+                raise DependencyError('{} depends on {}, which is neither deployed nor part of this apply'.format(
+                    template_name, dependency))
+
+    # render every template once to find the exports it publishes and the imports it needs
+    imports, exporters = {}, {}
+    for template_name in template_names:
+        try:
+            rendered = get_template(env, template_name, params).to_dict()
+        except Exception as e:
+            if any(d in template_names and not is_deployed(d) for d in declared[template_name]):
+                # a declared dependency is created by this apply, so this template cannot render yet
+                say('{}: skipping dependency detection, it renders after {} ({})'.format(
+                    template_name, ', '.join(declared[template_name]), e))
+                continue
+            raise DependencyError('{} failed to render: {}'.format(template_name, e))
+        imports[template_name] = find_imports(rendered)
+        for export in find_exports(rendered):
+            exporters[export] = template_name
+
+    published = None
+    for template_name, names in sorted(imports.items()):
+        for name in sorted(names):
+            if name in exporters:
+                graph.add_edge(template_name, exporters[name])
+                continue
+            if published is None:
+                published = list_exports(env)
+            if name not in published:
+                raise DependencyError('{} imports {}, which no deployed stack or selected template exports'.format(
+                    template_name, name))
+
+    graph.levels()  # fail on cycles now rather than half way through
+    return graph
+
+
+def apply_stacks(env, template_names, params={}, parallelism=4, force=False):
+    """
+    Applies several stacks, running every stack whose dependencies are done concurrently.
+    Every stack is rendered and diffed against its current state first and the changes are confirmed once.
+    Stacks that can only render once their dependencies are applied, or that render differently by then, are
+    diffed again and confirmed on their own when their turn comes. Stops starting new stacks after the first
+    failure.
+    :return: (bool) True if every stack succeeded
+    """
+    graph = build_stack_graph(env, template_names, params)
+    print('Env: {} applying {} templates, up to {} at a time:'.format(env, len(template_names), parallelism))
+    for i, level in enumerate(graph.levels(), 1):
+        print('  {}: {}'.format(i, ', '.join(
+            '{} (after {})'.format(t, ', '.join(sorted(graph.dependencies[t]))) if graph.dependencies[t] else t
+            for t in level)))
+
+    plans = {}
+    for level in graph.levels():
+        for template_name in level:
+            _output.prefix = '[{}-{}] '.format(env, template_name)
+            try:
+                plans[template_name] = plan_stack(env, template_name, params, force)
+            except Exception as e:
+                if not graph.dependencies[template_name]:
+                    raise DependencyError('{} failed to render: {}'.format(template_name, e))
+                say('Renders after {} is applied, changes are shown then ({}: {})'.format(
+                    ', '.join(sorted(graph.dependencies[template_name])), type(e).__name__, e))
+            finally:
+                _output.prefix = ''
+    if all(template_name in plans and plans[template_name] is None for template_name in template_names):
+        print('\nEvery stack is up to date.')
+        return True
+
+    changed = set()
+    prompt_lock = threading.Lock()
+
+    def apply_one(template_name):
+        _output.prefix = '[{}-{}] '.format(env, template_name)
+        try:
+            plan = plans.get(template_name)
+            if template_name not in plans or changed & graph.dependencies[template_name]:
+                # the dependencies this stack renders from changed since it was planned
+                planned = plan['fingerprint'] if plan else None
+                plan = plan_stack(env, template_name, params, force)
+                if plan and plan['fingerprint'] != planned:
+                    with prompt_lock:
+                        if not confirm_choice('\n\nApply these changes to {}? (yes/no) '.format(
+                                plan['stack_args']['StackName'])):
+                            say('Cancelled.')
+                            return False
+            if not plan:
+                return True
+            changed.add(template_name)
+            return run_plan(env, plan, confirm=False)
+        except Exception as e:
+            say('*** {}: {} ***'.format(type(e).__name__, e))
+            return False
+        finally:
+            _output.prefix = ''
+
+    results = confirm_action(graph.run, apply_one, parallelism)
+    print('\nSummary:')
+    for template_name in sorted(results):
+        print('  {:<16} {}'.format(template_name, results[template_name]))
+    return all(result == 'succeeded' for result in results.values())
+
+
+def show_cache(purge=False, resource_types=None, expired_only=False):
+    """
+    List or purge the local AWS discovery cache
+    """
+    discovery_cache = cache.get_cache()
+    if purge:
+        removed = discovery_cache.purge(resource_types=resource_types, expired_only=expired_only)
+        print('Removed {} cache entries from {}'.format(removed, discovery_cache.path))
+        return
+    for path, entry in discovery_cache.entries():
+        if resource_types and entry.get('resource_type') not in resource_types:
+            continue
+        print('{:<16} {:<14} {:<16} age: {:>6}s {}{}'.format(
+            entry.get('resource_type'), entry.get('account'), entry.get('region'),
+            int(time.time() - entry.get('created', 0)),
+            '(expired) ' if discovery_cache.is_expired(entry) else '',
+            path))
+
+
+def show_amis(env, template_names=None):
+    """
+    Print the AMI each template would pick, resolving every template's lookups in one pass
+    """
+    catalog = get_ami_catalog(constants.ENVIRONMENTS[env]['region'])
+    # like render_templates, only templates env is configured for unless they are named
+    lookups = [(name, lookup)
+               for name in (template_names or sorted(t for t in TEMPLATES if TEMPLATES[t].is_enabled(env)))
+               for lookup in TEMPLATES[name].ami_lookups(env)]
+    catalog.resolve([lookup for _, lookup in lookups])
+    for template_name, (ami_name, owner) in lookups:
+        try:
+            image = catalog.image(ami_name, owner)
+            print('{:<16} {:<24} {:<40} {} {}'.format(template_name, image['ImageId'], image['Name'],
+                                                      image['CreationDate'], owner))
+        except IndexError as e:
+            print('{:<16} {}'.format(template_name, e))
+
+
+def configured_instance_types(config):
+    """
+    :param config: (dict) an environment's configuration, or part of it
+    :return: (set) every EC2 instance type in its instance_type and instance_types settings
+    """
+    found = set()
+    if isinstance(config, dict):
+        for key, value in config.items():
+            if key in ('instance_type', 'instance_types'):
+                # RDS and ElastiCache node types (db.*, cache.*) are not EC2 instance types
+                found.update(t for t in ([value] if isinstance(value, str) else value)
+                             if not t.startswith(('db.', 'cache.')))
+            else:
+                found.update(configured_instance_types(value))
+    elif isinstance(config, list):
+        for value in config:
+            found.update(configured_instance_types(value))
+    return found
+
+
+def show_instance_types(env, instance_types=None):
+    """
+    Prints the capabilities of instance_types, by default of every instance type env is configured with
+    """
+    from utils.instance_types import get_instance_type_catalog
+
+    catalog = get_instance_type_catalog(constants.ENVIRONMENTS[env]['region'])
+    instance_types = sorted(instance_types or configured_instance_types(constants.ENVIRONMENTS[env]))
+    catalog.resolve(instance_types)
+    print('{:<16} {:>5} {:>9} {:<20} {:<13} {}'.format('Type', 'vCPUs', 'Memory', 'Network', 'EBS-optimized',
+                                                         'Instance store'))
+    for instance_type in instance_types:
+        try:
+            capabilities = catalog.capabilities(instance_type)
+        except KeyError as e:
+            print('{:<16} {}'.format(instance_type, e))
+            continue
+        storage = capabilities['InstanceStorage']
+        print('{:<16} {:>5} {:>7.1f}Gi {:<20} {:<13} {}'.format(
+            instance_type, capabilities['VCpus'], capabilities['MemoryMiB'] / 1024.0,
+            capabilities['NetworkPerformance'], capabilities['EbsOptimizedSupport'],
+            ', '.join('{}x {}GB {}'.format(d['Count'], d['SizeInGB'], d['Type']) for d in storage['Disks']) +
+            (' (NVMe)' if storage['NvmeSupport'] != 'unsupported' else '') if storage else '-'))
 
 
 def show_template(env, template_name, params={}):
-    TemplateClass = TEMPLATES.get(template_name, None)
-    template = TemplateClass(template_name, env, params)
+    template = get_template(env, template_name, params)
     print('=========== Environment: [{}], Template: [{}] ==========='.format(env, template_name))
-    print(template.to_json())
+    with trace.phase('to_json'):
+        body = template.to_json()
+    print(body)
+
+
+def _init_render_worker(cache_mode, cache_path, replay):
+    # forked workers must not reuse the parent's HTTPS connections
+    aws.configure()
+    cache.configure(mode=cache_mode, path=cache_path)
+    if replay:
+        from utils.recorder import AWSRecorder
+        AWSRecorder(replay, 'replay').install()
+
+
+def _render_job(env, template_name, params, out):
+    """
+    Renders one template for one environment into out/<env>/<template>.json
+    :return: (tuple) env, template name, seconds taken, path written and error (None on success)
+    """
+    start = time.time()
+    path = os.path.join(out, env, '{}.json'.format(template_name))
+    try:
+        template = get_template(env, template_name, params)
+        with trace.phase('to_json'):
+            body = template.to_json()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(body)
+        return env, template_name, time.time() - start, path, None
+    except Exception as e:
+        return env, template_name, time.time() - start, path, '{}: {}'.format(type(e).__name__, e)
+
+
+def render_templates(envs, template_names, out, params={}, workers=None, replay=None):
+    """
+    Renders every (environment, template) pair to files under out, one process pool job per pair, and prints
+    the time each job took. Templates an environment has no configuration for are skipped.
+    :param template_names: (list) of templates, None for every template
+    :return: (bool) True if every template rendered
+    """
+    jobs = [(env, template_name)
+            for env in envs
+            for template_name in (template_names or sorted(TEMPLATES))
+            if template_names or TEMPLATES[template_name].is_enabled(env)]
+    discovery_cache = cache.get_cache()
+    start = time.time()
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_render_worker,
+            initargs=(discovery_cache.mode, discovery_cache.path, replay)) as executor:
+        futures = [executor.submit(_render_job, env, template_name, params, out) for env, template_name in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            env, template_name, seconds, path, error = future.result()
+            failed += 1 if error else 0
+            print('{:<12} {:<16} {:>7.2f}s {}'.format(env, template_name, seconds, error or path))
+    print('Rendered {} of {} templates in {:.2f}s'.format(len(jobs) - failed, len(jobs), time.time() - start))
+    return failed == 0
+
+
+def write_profile(profiler, path, top=25):
+    """
+    Stops a cProfile profiler, saves its stats to path and prints the functions with the most cumulative time
+    """
+    import pstats
+
+    profiler.disable()
+    profiler.dump_stats(path)
+    sys.stderr.write('\ncProfile stats written to {}\n'.format(path))
+    pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(top)
+
+
+def startup_profile(argv, top=15):
+    """
+    Runs rain again under python -X importtime and summarizes where its startup time went
+    :param argv: (list) arguments for the profiled run
+    :return: (int) exit code of the profiled run
+    """
+    start = time.time()
+    process = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__)] + argv,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.time() - start
+    modules = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            sys.stderr.write(line + '\n')
+            continue
+        fields = line[len('import time:'):].split('|')
+        if not fields[0].strip().isdigit():
+            continue  # column headers
+        name = fields[2][1:]
+        modules.append((int(fields[0]), int(fields[1]), name.strip(), (len(name) - len(name.lstrip())) // 2))
+
+    top_level = sorted((m for m in modules if m[3] == 0), reverse=True, key=lambda m: m[1])
+    print('\nStartup profile: {:.3f}s wall, {:.3f}s importing {} modules'.format(
+        elapsed, sum(m[1] for m in top_level) / 1e6, len(modules)))
+    print('Slowest top level imports (cumulative):')
+    for self_us, cumulative_us, name, _ in top_level[:top]:
+        print('  {:>8.1f}ms  {}'.format(cumulative_us / 1e3, name))
+    print('Slowest modules (self):')
+    for self_us, cumulative_us, name, _ in sorted(modules, reverse=True)[:top]:
+        print('  {:>8.1f}ms  {}'.format(self_us / 1e3, name))
+    return process.returncode
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Wrapper around boto and troposphere to manage cloudformation')
     parser.add_argument('environment', nargs='?', const=1, default=os.environ.get('ENV', 'dev'),
                         choices=constants.ENVIRONMENTS.keys(), help='Environment to run')
-    parser.add_argument('action', choices=['templates', 'stacks', 'show', 'apply'])
+    parser.add_argument('action', choices=['templates', 'stacks', 'show', 'render', 'apply', 'cache', 'amis',
+                                           'instance-types'])
     parser.add_argument('--template')
+    parser.add_argument('--templates', help='apply, render: comma separated templates (apply runs them in dependency order)')
+    parser.add_argument('--all', action='store_true',
+                        help='apply: every template configured for the environment, in dependency order')
+    parser.add_argument('--force', action='store_true',
+                        help='apply: diff and update stacks even when their fingerprint shows no change')
+    parser.add_argument('--parallelism', type=int, default=4, help='apply: stacks to apply at once (default 4)')
+    parser.add_argument('--all-envs', action='store_true', help='render: every environment in constants.py')
+    parser.add_argument('--all-templates', action='store_true',
+                        help='render: every template configured for each environment')
+    parser.add_argument('--out', default='rendered', help='render: directory to write <env>/<template>.json to')
+    parser.add_argument('--workers', type=int, help='render: worker processes (default: one per CPU)')
+    parser.add_argument('--instance-type', action='append',
+                        help='instance-types: show this instance type (repeatable, default: every configured one)')
     parser.add_argument('--parameters')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Ignore cached AWS discovery results, but store fresh ones')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the AWS discovery cache')
+    parser.add_argument('--purge', action='store_true', help='cache: delete cache entries instead of listing them')
+    parser.add_argument('--expired', action='store_true', help='cache: only purge expired entries')
+    parser.add_argument('--resource-type', action='append', choices=sorted(cache.DEFAULT_TTLS.keys()),
+                        help='cache: only list or purge this resource type (repeatable)')
+    parser.add_argument('--max-pool-connections', type=int,
+                        help='HTTPS connections kept per AWS client (default {})'.format(aws.MAX_POOL_CONNECTIONS))
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument('--record', metavar='FIXTURE',
+                           help='Capture every AWS response made during this run to a JSON fixture')
+    recording.add_argument('--replay', metavar='FIXTURE',
+                           help='Answer every AWS call from a fixture captured with --record, without network access')
+    parser.add_argument('--trace', action='store_true',
+                        help='Report every AWS call (latency, retries, calling template method) and time per phase')
+    parser.add_argument('--trace-chrome', metavar='FILE', help='Write AWS calls and phases as a Chrome trace to FILE')
+    parser.add_argument('--profile', metavar='FILE', help='Run under cProfile, save the stats to FILE')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='Run the command under python -X importtime and report the slowest imports')
     args = parser.parse_args()
 
+    if args.startup_profile:
+        sys.exit(startup_profile([a for a in sys.argv[1:] if a != '--startup-profile']))
+
+    if args.trace or args.trace_chrome:
+        # installed before the recorder so replayed calls are traced too
+        tracer = trace.enable()
+        if args.trace:
+            atexit.register(tracer.report)
+        if args.trace_chrome:
+            atexit.register(tracer.write_chrome_trace, args.trace_chrome)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        atexit.register(write_profile, profiler, args.profile)
+        profiler.enable()
+
+    aws.configure(max_pool_connections=args.max_pool_connections)
+
+    if args.no_cache or args.record or args.replay:
+        # recordings must see every call, and replays must not depend on local state
+        cache.configure(mode='off')
+    elif args.refresh:
+        cache.configure(mode='refresh')
+
+    if args.record or args.replay:
+        from utils.recorder import AWSRecorder
+    if args.record:
+        AWSRecorder(args.record, 'record').install()
+    elif args.replay:
+        AWSRecorder(args.replay, 'replay').install()
+
     params = {}
     if args.parameters:
         for param in args.parameters.split(','):
@@ -205,6 +769,32 @@ if __name__ == '__main__':
             pprint.pprint(stack)
     elif args.action == 'show':
         show_template(args.environment, args.template, params)
+    elif args.action == 'render':
+        if args.record:
+            parser.error('render runs in worker processes and cannot --record, record with show instead')
+        if not (args.template or args.templates or args.all_templates):
+            parser.error('render needs --template, --templates or --all-templates')
+        template_names = None if args.all_templates else \
+            (args.templates.split(',') if args.templates else [args.template])
+        envs = sorted(constants.ENVIRONMENTS) if args.all_envs else [args.environment]
+        ok = render_templates(envs, template_names, args.out, params, args.workers, args.replay)
+        sys.exit(0 if ok else 1)
     elif args.action == 'apply':
-        print('Env: {} applying template: {}'.format(args.environment, args.template))
-        apply_stack(args.environment, args.template, params)
+        if args.all or args.templates:
+            template_names = args.templates.split(',') if args.templates else \
+                sorted(t for t in TEMPLATES if TEMPLATES[t].is_enabled(args.environment))
+            try:
+                ok = apply_stacks(args.environment, template_names, params, args.parallelism, args.force)
+            except DependencyError as e:
+                print('Cannot apply: {}'.format(e))
+                sys.exit(1)
+        else:
+            print('Env: {} applying template: {}'.format(args.environment, args.template))
+            ok = apply_stack(args.environment, args.template, params, force=args.force)
+        sys.exit(0 if ok else 1)
+    elif args.action == 'amis':
+        show_amis(args.environment, [args.template] if args.template else None)
+    elif args.action == 'instance-types':
+        show_instance_types(args.environment, args.instance_type)
+    elif args.action == 'cache':
+        show_cache(purge=args.purge, resource_types=args.resource_type, expired_only=args.expired)
@@ -1,15 +1,44 @@
-from templates import vpc, vpn, security_groups, rds, elasticache, cassandra, kafka, pritunl, nexus, mesos_masters, mesos_agents
-
-TEMPLATES = {
-    'VPC': vpc.VPCTemplate,
-    'VPN': vpn.VPNTemplate,
-    'SecurityGroups': security_groups.SecurityGroupTemplate,
-    'RDS': rds.RDSTemplate,
-    'ElastiCache': elasticache.ElastiCacheTemplate,
-    'Cassandra': cassandra.CassandraTemplate,
-    'Kafka': kafka.KafkaTemplate,
-    'Pritunl': pritunl.PritunlTemplate,
-    'Nexus': nexus.NexusTemplate,
-    'MesosMasters': mesos_masters.MesosMastersTemplate,
-    'MesosAgents': mesos_agents.MesosAgentsTemplate
-}
+import importlib
+
+from collections.abc import Mapping
+
+
+class TemplateRegistry(Mapping):
+    """
+    Maps template names to template classes, importing each template module (and with it troposphere, awacs
+    and boto3) only when that template is first looked up. Listing names does not import anything.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self._classes = {}
+
+    def __getitem__(self, name):
+        if name not in self._classes:
+            module_name, class_name = self.paths[name].rsplit('.', 1)
+            self._classes[name] = getattr(importlib.import_module(module_name), class_name)
+        return self._classes[name]
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, name):
+        return name in self.paths
+
+
+TEMPLATES = TemplateRegistry({
+    'VPC': 'templates.vpc.VPCTemplate',
+    'VPN': 'templates.vpn.VPNTemplate',
+    'SecurityGroups': 'templates.security_groups.SecurityGroupTemplate',
+    'RDS': 'templates.rds.RDSTemplate',
+    'ElastiCache': 'templates.elasticache.ElastiCacheTemplate',
+    'Cassandra': 'templates.cassandra.CassandraTemplate',
+    'Kafka': 'templates.kafka.KafkaTemplate',
+    'Pritunl': 'templates.pritunl.PritunlTemplate',
+    'Nexus': 'templates.nexus.NexusTemplate',
+    'MesosMasters': 'templates.mesos_masters.MesosMastersTemplate',
+    'MesosAgents': 'templates.mesos_agents.MesosAgentsTemplate'
+})
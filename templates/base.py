@@ -1,12 +1,16 @@
-import boto3
 import logging
 import os
 import re
 
-from troposphere import ec2, iam, Parameter, Ref, Template, ImportValue, Sub, Join, autoscaling, GetAtt
+from troposphere import ec2, iam, Base64, Parameter, Ref, Template, ImportValue, Sub, Join, autoscaling, GetAtt
 from awacs import ec2 as iam_ec2
 from awacs import aws as iam_aws
-from utils import security_groups
+from utils import security_groups, trace
+from utils.aws import get_client
+from utils.amis import get_ami_catalog
+from utils.ec2 import get_block_device_mapping, MAX_PARTITIONS, PLACEMENT_STRATEGIES, PlacementGroup
+from utils.instance_types import get_instance_type_catalog
+from utils.discovery import DiscoveryContext
 
 from config import constants
 
@@ -17,6 +21,11 @@ class IvyTemplate(Template):
     ENVIRONMENT = None
     TEAM = constants.TEAMS['infrastructure']
     CAPABILITIES = ['CAPABILITY_IAM']
+    # Section of constants.ENVIRONMENTS[env] this template is built from, None if every environment has it
+    CONFIG_KEY = None
+    # Templates whose stacks must exist before this one renders. Edges through Fn::ImportValue are also
+    # detected when applying, but lookups done with the EC2 API (like the VPC) have to be declared here.
+    DEPENDS_ON = ('VPC', 'SecurityGroups')
 
     def __init__(self, template_name, env, params):
         super(IvyTemplate, self).__init__()
@@ -25,14 +34,25 @@ class IvyTemplate(Template):
         self.defaults = {}
         self.region = constants.ENVIRONMENTS[self.env]['region']
         self.sysenv = constants.ENVIRONMENTS[self.env]['sysenv']
-        self.ec2_conn = boto3.client('ec2', region_name=self.region)
+        self.ec2_conn = get_client('ec2', self.region)
+        self.discovery = DiscoveryContext(self.ec2_conn, self.env)
+        self.ami_catalog = get_ami_catalog(self.region)
+        self.instance_type_catalog = get_instance_type_catalog(self.region)
+        with trace.phase('discovery'):
+            self.ami_catalog.resolve(self.ami_lookups(self.env))
         self.name = self.env + template_name
         self.template_name = template_name
         self.tpl_name = template_name.lower()
         self._security_groups = set()
         self.instance_role = None
         self.instance_profile = None
-        self.configure()
+        with trace.phase('configure'):
+            self.configure()
+
+    def add_resource(self, resource):
+        # troposphere stops at 500 resources like CloudFormation, but rain splits templates that come close into
+        # nested stacks when applying them (see utils/nested.py), so only the nested stacks have to stay below it
+        return self._update(self.resources, resource)
 
     @property
     def security_groups(self):
@@ -57,6 +77,29 @@ class IvyTemplate(Template):
         # This must be overridden by subclasses
         raise NotImplementedError
 
+    @classmethod
+    def is_enabled(cls, env):
+        """
+        :return: (bool) True if env has the configuration this template needs
+        """
+        return cls.CONFIG_KEY is None or cls.CONFIG_KEY in constants.ENVIRONMENTS[env]
+
+    @classmethod
+    def ami_lookups(cls, env):
+        """
+        AMIs this template will look up for env, so they can all be resolved in one pass before configure().
+        The first lookup is the one used for the AMI parameter.
+        :return: (list) of (AMI name prefix, owner) tuples
+        """
+        return []
+
+    @staticmethod
+    def ami_owner(env):
+        """
+        Owner of the ivy-* AMIs for env
+        """
+        return constants.ENVIRONMENTS[env].get('ami_owner', 'self')
+
     def get_standard_parameters(self):
         """
         Injects into template commonly used parameters
@@ -80,6 +123,114 @@ class IvyTemplate(Template):
             )
         )
 
+    def _instance_type_name(self, instance_type=None):
+        # a Ref to the InstanceType parameter (or nothing) stands for the parameter's default
+        if isinstance(instance_type, str):
+            return instance_type
+        return self.parameters['InstanceType'].resource['Default']
+
+    def ebs_optimized(self, *instance_types):
+        """
+        :param instance_types: instance types or Refs to the InstanceType parameter, none for its default
+        :return: (bool) True if every instance type can be EBS-optimized
+        """
+        return all(self.instance_type_catalog.ebs_optimized(self._instance_type_name(t))
+                   for t in instance_types or [None])
+
+    def get_block_device_mapping(self, instance_type=None, launch_template=False):
+        """
+        :param instance_type: instance type or a Ref to the InstanceType parameter, None for its default
+        :return: (list) of block device mappings for the instance store volumes of instance_type
+        """
+        return get_block_device_mapping(self._instance_type_name(instance_type), self.region, launch_template)
+
+    def data_storage(self, config, key, *instance_types):
+        """
+        Reads where instances keep their data: 'ebs' (the default) or 'instance-store', the NVMe instance store
+        volumes of the instance, striped together when there are several. Instances without any use EBS instead.
+        :param config: (dict) configuration of the cluster or service
+        :param key: (string) setting in config
+        :param instance_types: instance types or Refs to the InstanceType parameter, none for its default
+        :return: (string) 'ebs' or 'instance-store'
+        """
+        storage = config.get(key, 'ebs')
+        if storage not in ('ebs', 'instance-store'):
+            raise RuntimeError('{} must be "ebs" or "instance-store": {}'.format(key, storage))
+        if storage == 'instance-store':
+            names = [self._instance_type_name(t) for t in instance_types or [None]]
+            missing = [t for t in names if not self.instance_type_catalog.nvme_instance_store(t)]
+            if missing:
+                logger.warning('%s: %s have no NVMe instance store, their instances will use EBS',
+                               key, ', '.join(missing))
+        return storage
+
+    def add_placement_groups(self, title, config, zones):
+        """
+        Adds the placement groups the placement_group setting of a cluster asks for: 'cluster' packs instances close
+        together, 'spread' puts every instance on distinct hardware and 'partition' splits instances into
+        partition_count (default one per zone) partitions that share no hardware
+        :param title: (string) prefix of the resource titles
+        :param config: (dict) configuration of the cluster
+        :param zones: (list) availability zones the cluster's instances run in
+        :return: (dict) availability zone to placement group, empty when the cluster has no placement_group. Cluster
+                 placement groups cannot span zones, so there is one per zone; the others are shared by all zones.
+        """
+        strategy = config.get('placement_group')
+        if not strategy:
+            return {}
+        if strategy not in PLACEMENT_STRATEGIES:
+            raise RuntimeError('placement_group must be one of {}: {}'.format(', '.join(PLACEMENT_STRATEGIES),
+                                                                             strategy))
+        zones = sorted(set(zones))
+
+        if strategy == 'cluster':
+            return dict((zone, self.add_resource(PlacementGroup('{}PlacementGroup{}'.format(title, zone[-1].upper()),
+                                                                Strategy=strategy)))
+                        for zone in zones)
+
+        kwargs = {}
+        if strategy == 'partition':
+            partitions = config.get('partition_count', min(len(zones), MAX_PARTITIONS))
+            if not 1 <= partitions <= MAX_PARTITIONS:
+                raise RuntimeError('partition_count must be 1 to {}: {}'.format(MAX_PARTITIONS, partitions))
+            kwargs['PartitionCount'] = partitions
+        elif 'partition_count' in config:
+            raise RuntimeError('partition_count needs placement_group "partition", not "{}"'.format(strategy))
+        placement_group = self.add_resource(PlacementGroup('{}PlacementGroup'.format(title), Strategy=strategy,
+                                                           **kwargs))
+        return dict((zone, placement_group) for zone in zones)
+
+    @staticmethod
+    def placement(placement_groups, zone, zones):
+        """
+        :param placement_groups: (dict) availability zone to placement group, see add_placement_groups()
+        :param zones: (list) availability zones of the cluster, sorted
+        :return: (ec2.Placement) of an instance in zone, None without placement groups. Instances of a partition
+                 placement group go to the partition of their zone, zones share partitions only when there are fewer.
+        """
+        if zone not in placement_groups:
+            return None
+        placement_group = placement_groups[zone]
+        if placement_group.Strategy == 'partition':
+            return ec2.Placement(GroupName=Ref(placement_group),
+                                 PartitionNumber=zones.index(zone) % placement_group.PartitionCount + 1)
+        return ec2.Placement(GroupName=Ref(placement_group))
+
+    def get_ami_parameter(self):
+        """
+        Injects the AMI parameter, defaulting to the newest image for this template's first AMI lookup
+        """
+        name, owner = self.ami_lookups(self.env)[0]
+        self.ami = self.add_parameter(
+            Parameter(
+                'AMI',
+                Type='String',
+                Description='AMI ID for instances',
+                Default=self.ami_catalog.latest(name, owner)
+            )
+        )
+        return self.ami
+
     def get_tags(self, service_override=None, role_override=None, typ=None):
         """
         Get the default tags for this environment
@@ -134,6 +285,58 @@ class IvyTemplate(Template):
         self.resources[self.instance_role.title] = self.instance_role
         self.resources[self.instance_profile.title] = self.instance_profile
 
+    def add_launch_template(self, title, instance_type, block_device_mappings, user_data, ebs_optimized=False,
+                            associate_public_ip_address=False, hibernation=False, placement=None):
+        """
+        Adds a launch template for an autoscaling group with the standard AMI, key pair, instance profile and
+        security groups of this template
+        :param instance_type: (string) instance type, or a Ref to the InstanceType parameter
+        :param user_data: (string) user data, Base64 encoded by this function
+        :param hibernation: (bool) instances can be hibernated
+        :param placement: (ec2.Placement) placement group (and partition) of the instances
+        :return: (ec2.LaunchTemplate) the added resource
+        """
+        options = {}
+        if hibernation:
+            options['HibernationOptions'] = ec2.HibernationOptions(Configured=True)
+        if placement:
+            options['Placement'] = placement
+        return self.add_resource(
+            ec2.LaunchTemplate(
+                title,
+                LaunchTemplateData=ec2.LaunchTemplateData(
+                    BlockDeviceMappings=block_device_mappings,
+                    EbsOptimized=ebs_optimized,
+                    IamInstanceProfile=ec2.IamInstanceProfile(Arn=GetAtt(self.instance_profile, 'Arn')),
+                    ImageId=Ref(self.ami),
+                    InstanceType=instance_type,
+                    KeyName=Ref(self.keypair_name),
+                    Monitoring=ec2.Monitoring(Enabled=False),
+                    NetworkInterfaces=[
+                        ec2.NetworkInterfaces(
+                            AssociatePublicIpAddress=associate_public_ip_address,
+                            DeleteOnTermination=True,
+                            DeviceIndex=0,
+                            Groups=self.security_groups
+                        )
+                    ],
+                    UserData=Base64(user_data),
+                    **options
+                )
+            )
+        )
+
+    @staticmethod
+    def launch_template_specification(launch_template):
+        """
+        :return: (autoscaling.LaunchTemplateSpecification) pointing at the latest version of launch_template, so
+                 autoscaling groups pick up every change
+        """
+        return autoscaling.LaunchTemplateSpecification(
+            LaunchTemplateId=Ref(launch_template),
+            Version=GetAtt(launch_template, 'LatestVersionNumber')
+        )
+
     def add_security_group(self, *security_groups):
         for sg in security_groups:
             self._security_groups.add(sg)
@@ -265,12 +468,10 @@ class IvyTemplate(Template):
 
         # Add unmanaged (created outside CloudFormation) security groups to instances
         _unmanaged_filters = [
-            {'Name': 'vpc-id', 'Values': [self.vpc_id]},
             {'Name': 'tag:{}:environment'.format(constants.TAG), 'Values': [self.env]}
         ]
         for sg_filters in constants.ENVIRONMENTS[self.env]['security_groups'].get('default_unmanaged'):
-            for sg in self.ec2_conn.describe_security_groups(Filters=_unmanaged_filters + sg_filters).get(
-                    'SecurityGroups'):
+            for sg in self.discovery.security_groups(self.vpc_id, _unmanaged_filters + sg_filters):
                 self.add_security_group(sg['GroupId'])
 
     def _search_tags(self, tags, key, value):
@@ -294,15 +495,7 @@ class IvyTemplate(Template):
         Returns a VPC based on self.env
         :return: (dict) representing a VPC
         """
-        result = self.ec2_conn.describe_vpcs(Filters=[
-            {'Name': 'tag:{}:service'.format(constants.TAG), 'Values': ['VPC']},
-            {'Name': 'tag:{}:environment'.format(constants.TAG), 'Values': [self.env]}
-        ])['Vpcs']
-        if len(result) == 0:
-            raise Exception('VPC {} not found in region {}'.format(self.env, self.region))
-        elif len(result) > 1:
-            raise Exception('More than 1 VPC {} found in region {}'.format(self.env, self.region))
-        return result[0]
+        return self.discovery.vpc()
 
     def get_subnets(self, _filter=None, _preferred_only=False):
         """
@@ -314,8 +507,7 @@ class IvyTemplate(Template):
         if _filter not in [None, 'private', 'public']:
             raise RuntimeError('Filter not one of None, "public", or "private": {}'.format(_filter))
         filter_is_public = True if _filter == 'public' else False
-        all_subnets = self.ec2_conn.describe_subnets(
-            Filters=[{'Name': 'vpc-id', 'Values': [self.vpc_id]}])['Subnets']
+        all_subnets = self.discovery.subnets(self.vpc_id)
         if _filter:
             subnets = filter(lambda s: s['MapPublicIpOnLaunch'] == filter_is_public, all_subnets)
         else:
@@ -338,12 +530,10 @@ class IvyTemplate(Template):
         """
         if _filter not in [None, 'private', 'public']:
             raise RuntimeError('Filter not one of None, "public", or "private": {}'.format(_filter))
-        route_tables = self.ec2_conn.describe_route_tables(
-            Filters=[{'Name': 'vpc-id', 'Values': [self.get_vpc()['VpcId']]}]
-        )['RouteTables']
+        route_tables = self.discovery.route_tables(self.get_vpc()['VpcId'])
         if _filter:
-            return filter(lambda rt: self._search_tags(rt['Tags'], '{}:role'.format(constants.TAG), _filter),
-                          route_tables)
+            return list(filter(lambda rt: self._search_tags(rt['Tags'], '{}:role'.format(constants.TAG), _filter),
+                               route_tables))
         else:
             return route_tables
 
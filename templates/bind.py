@@ -1,13 +1,18 @@
-from troposphere import autoscaling, ec2, iam, route53, Base64, Parameter, Ref, Sub, GetAtt
+from troposphere import autoscaling, ec2, iam, route53, Base64, Ref, Sub, GetAtt
 
 from config import constants
 from .base import IvyTemplate
-from utils.ec2 import get_latest_ami_id
+from utils.amis import AMAZON_LINUX_2
 import textwrap
 
 
 class BindTemplate(IvyTemplate):
     CAPABILITIES = ['CAPABILITY_IAM']
+    CONFIG_KEY = 'bind'
+
+    @classmethod
+    def ami_lookups(cls, env):
+        return [(AMAZON_LINUX_2, 'amazon')]
 
     def make_bind_zone(self, zone):
         """ Creates an individual zone for a given zone config """
@@ -34,14 +39,7 @@ class BindTemplate(IvyTemplate):
         self.get_default_security_groups()
         self.get_standard_parameters()
         self.get_standard_policies()
-        self.ami = self.add_parameter(
-            Parameter(
-                'AMI',
-                Type='String',
-                Description='AMI ID for instances',
-                Default=get_latest_ami_id(self.region, 'amzn2-ami-hvm-2.0.????????-x86_64-gp2', 'amazon')
-            )
-        )
+        self.get_ami_parameter()
 
         config = constants.ENVIRONMENTS[self.env][self.service]
 
@@ -1,16 +1,21 @@
 import hashlib
 
-from troposphere import autoscaling, ec2, Base64, Parameter, Ref, Sub, iam
+from troposphere import autoscaling, ec2, Ref, Sub, iam
 
 import netaddr
 
 from config import constants
 from .base import IvyTemplate
-from utils.ec2 import EBS_OPTIMIZED_INSTANCES, get_block_device_mapping, get_latest_ami_id
+from utils.ec2 import ebs_block_device, ebs_volume, get_latest_snapshots, get_stack_volumes
 
 
 class CassandraTemplate(IvyTemplate):
     CAPABILITIES = ['CAPABILITY_IAM']
+    CONFIG_KEY = 'cassandra'
+
+    @classmethod
+    def ami_lookups(cls, env):
+        return [('ivy-cassandra', cls.ami_owner(env))]
 
     def configure(self):
         """
@@ -22,16 +27,8 @@ class CassandraTemplate(IvyTemplate):
         self.get_standard_parameters()
         self.get_standard_policies()
 
-        _global_config = constants.ENVIRONMENTS[self.env]
 
-        self.ami = self.add_parameter(
-            Parameter(
-                'AMI',
-                Type='String',
-                Description='AMI ID for instances',
-                Default=get_latest_ami_id(self.region, 'ivy-cassandra', _global_config.get('ami_owner', 'self'))
-            )
-        )
+        self.get_ami_parameter()
         _cassandra_security_group = self.add_resource(
             ec2.SecurityGroup(
                 '{}SecurityGroup'.format(self.name),
@@ -81,10 +78,28 @@ class CassandraTemplate(IvyTemplate):
             }
         ))
 
+        subnets = self.get_subnets('private')
+        stack_volumes = None
         for cluster in constants.ENVIRONMENTS[self.env]['cassandra']['clusters']:
-            for _instance in cluster['instances']:
-
-                subnet = [s for s in self.get_subnets('private') if netaddr.IPAddress(_instance['ip']) in netaddr.IPNetwork(s['CidrBlock'])][0]
+            if cluster.get('seed_from_snapshot') and cluster.get('data_volume_size'):
+                # Only volumes the stack does not have yet start from a snapshot, the others keep theirs: a
+                # changed SnapshotId would replace the volume
+                if stack_volumes is None:
+                    stack_volumes = get_stack_volumes('{}-{}'.format(self.env, self.template_name), self.region)
+                snapshots = get_latest_snapshots({'{}:service'.format(constants.TAG): 'cassandra-{}'.format(
+                    cluster['name'])}, '{}:role'.format(constants.TAG), self.region)
+            else:
+                snapshots = None
+
+            instance_subnets = [
+                [s for s in subnets if netaddr.IPAddress(i['ip']) in netaddr.IPNetwork(s['CidrBlock'])][0]
+                for i in cluster['instances']
+            ]
+            # Racks are availability zones, partition placement groups get one partition per rack
+            zones = sorted(set(s['AvailabilityZone'] for s in instance_subnets))
+            placement_groups = self.add_placement_groups(self.name + cluster['name'], cluster, zones)
+
+            for _instance, subnet in zip(cluster['instances'], instance_subnets):
 
                 service = 'cassandra-{}'.format(cluster['name'])
                 role = '-'.join([self.name, cluster['name'], subnet['AvailabilityZone'], _instance['ip']])
@@ -105,15 +120,12 @@ class CassandraTemplate(IvyTemplate):
                 self.add_resource(eni)
 
                 # Add the rootfs
-                _block_device_mapping = get_block_device_mapping(self.parameters['InstanceType'].resource['Default'])
+                _instance_type = cluster.get('instance_type', Ref(self.instance_type))
+                _block_device_mapping = self.get_block_device_mapping(_instance_type, launch_template=True)
                 _block_device_mapping += {
-                    ec2.BlockDeviceMapping(
+                    ec2.LaunchTemplateBlockDeviceMapping(
                         DeviceName="/dev/xvda",
-                        Ebs=ec2.EBSBlockDevice(
-                            DeleteOnTermination=True,
-                            VolumeSize=cluster.get('rootfs_size', 20),
-                            VolumeType="gp2",
-                        )
+                        Ebs=ebs_block_device(cluster, 'rootfs', 20, boot=True)
                     )
                 }
 
@@ -132,15 +144,19 @@ class CassandraTemplate(IvyTemplate):
                     # Use the first three cassandra nodes as seeds
                     seeds = ','.join([i['ip'] for i in cluster['instances']][:3])
 
+                snapshot_id = ''
                 if cluster.get('data_volume_size'):
+                    data_volume_title = '{}{}DataVolume{}'.format(self.name, cluster['name'], uniq_id)  # something like 'envnameCassandraappDataVolumec47145e176'
+                    if snapshots is not None:
+                        snapshot_id = stack_volumes.get(data_volume_title, snapshots.get(role, ''))
                     # Create the EBS volume
-                    data_volume = ec2.Volume(
-                        '{}{}DataVolume{}'.format(self.name, cluster['name'], uniq_id),  # something like 'envnameCassandraappDataVolumec47145e176'
-                        Size=cluster.get('data_volume_size', 20),
-                        VolumeType='gp2',
+                    data_volume = ebs_volume(
+                        data_volume_title,
+                        cluster, 'data_volume', 20,
                         AvailabilityZone=subnet['AvailabilityZone'],
                         DeletionPolicy='Retain',
-                        Tags=tags + [ec2.Tag('Name', role + "-datavol")]
+                        Tags=tags + [ec2.Tag('Name', role + "-datavol")],
+                        **({'SnapshotId': snapshot_id} if snapshot_id else {})
                     )
                     self.add_resource(data_volume)
                 else:
@@ -151,15 +167,18 @@ class CassandraTemplate(IvyTemplate):
                 user_data_template = self.get_cloudinit_template(
                     cluster['cassandra_template'],
                     replacements=(
+                        ('__INSTANCE_STORE_FUNCTIONS__', self.get_cloudinit_template('instance_store')),
                         ('__PROMPT_COLOR__', self.prompt_color()),
                         ('__CASSANDRA_CLUSTER__', cluster['name'] ),
                         ('__CASSANDRA_CLUSTER_OVERRIDE__', cluster.get('cluster_name_override', "") ),
                         ('__CASSANDRA_SEEDS__', seeds),
-                        ('__SERVICE__', service)
+                        ('__SERVICE__', service),
+                        ('__DATA_STORAGE__', self.data_storage(cluster, 'data_storage', _instance_type)),
+                        ('__DATA_SNAPSHOT_ID__', snapshot_id)
                     )
                 )
                 # Phase 2: Allow AWS Cloudformation to further substitute Ref()'s in the userdata
-                userdata = Base64(Sub(
+                userdata = Sub(
                     user_data_template
                         .replace('${', '${!')  # Replace bash brackets with CFN escaped style
                         .replace('{#', '${'),  # Replace rain-style CFN escapes with proper CFN brackets
@@ -167,31 +186,23 @@ class CassandraTemplate(IvyTemplate):
                         'CFN_ENI_ID': Ref(eni),
                         'CFN_DATA_EBS_VOLUME_ID': Ref(data_volume) if data_volume else ""
                     }
-                ))
+                )
 
-                # Create the Launch Configuration / ASG
-                _instance_type = cluster.get('instance_type', Ref(self.instance_type))
-                launch_configuration = self.add_resource(
-                    autoscaling.LaunchConfiguration(
-                        '{}{}LaunchConfiguration{}'.format(self.name, cluster['name'], uniq_id),
-                        AssociatePublicIpAddress=False,
-                        BlockDeviceMappings=_block_device_mapping,
-                        EbsOptimized=True if _instance_type in EBS_OPTIMIZED_INSTANCES else False,
-                        ImageId=Ref(self.ami),
-                        InstanceType=_instance_type,
-                        InstanceMonitoring=False,
-                        IamInstanceProfile=Ref(self.instance_profile),
-                        KeyName=Ref(self.keypair_name),
-                        SecurityGroups=self.security_groups,
-                        UserData=userdata
-                    )
+                # Create the Launch Template / ASG
+                launch_template = self.add_launch_template(
+                    '{}{}LaunchTemplate{}'.format(self.name, cluster['name'], uniq_id),
+                    instance_type=_instance_type,
+                    block_device_mappings=_block_device_mapping,
+                    user_data=userdata,
+                    ebs_optimized=self.ebs_optimized(_instance_type),
+                    placement=self.placement(placement_groups, subnet['AvailabilityZone'], zones)
                 )
                 self.add_resource(
                     autoscaling.AutoScalingGroup(
                         '{}{}ASGroup{}'.format(self.name, cluster['name'], uniq_id),
                         AvailabilityZones=[subnet['AvailabilityZone']],
                         HealthCheckType='EC2',
-                        LaunchConfigurationName=Ref(launch_configuration),
+                        LaunchTemplate=self.launch_template_specification(launch_template),
                         MinSize=1,
                         MaxSize=1,
                         VPCZoneIdentifier=[subnet['SubnetId']],
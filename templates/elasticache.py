@@ -5,6 +5,82 @@ from config import constants
 
 
 class ElastiCacheTemplate(IvyTemplate):
+    CONFIG_KEY = 'elasticache'
+
+    @staticmethod
+    def parameter_group_family(engine_version):
+        """
+        :return: (string) cache parameter group family of a Redis version, e.g. 'redis5.0' or 'redis6.x'
+        """
+        major, minor = engine_version.split('.')[:2]
+        if int(major) < 6:
+            return 'redis{}.{}'.format(major, minor)
+        if int(major) == 6:
+            return 'redis6.x'
+        return 'redis{}'.format(major)
+
+    def generate_replication_group(self, name, cache, subnet_group, security_group):
+        """
+        A Redis replication group: a primary with replicas_per_node_group read replicas, or, with num_node_groups,
+        a cluster mode enabled group of that many shards with replicas_per_node_group replicas each
+        :return: (elasticache.ReplicationGroup, list) the replication group and its (record name, endpoint) pairs
+        """
+        engine_version = cache.get('engine_version', '5.0.6')
+        replicas = cache.get('replicas_per_node_group', 0)
+        if not 0 <= replicas <= 5:
+            raise RuntimeError('replicas_per_node_group of {} must be 0 to 5: {}'.format(cache['name'], replicas))
+        record_name = '{}.{}'.format(cache['name'], cache['engine'])
+
+        kwargs = {}
+        if replicas:
+            # Replicas take over from a failed primary, in another availability zone with multi_az
+            kwargs['AutomaticFailoverEnabled'] = True
+            if cache.get('multi_az'):
+                kwargs['MultiAZEnabled'] = True
+        else:
+            kwargs['AutomaticFailoverEnabled'] = False
+
+        if cache.get('num_node_groups'):
+            if not 1 <= cache['num_node_groups'] <= 500:
+                raise RuntimeError('num_node_groups of {} must be 1 to 500: {}'.format(
+                    cache['name'], cache['num_node_groups']))
+            parameters = dict(cache.get('parameters', {}), **{'cluster-enabled': 'yes'})
+            parameter_group = self.add_resource(
+                elasticache.ParameterGroup(
+                    '{}ParameterGroup'.format(name),
+                    CacheParameterGroupFamily=self.parameter_group_family(engine_version),
+                    Description='Cluster mode enabled parameters for {}'.format(name),
+                    Properties=parameters
+                )
+            )
+            # cluster mode always fails over to a replica
+            kwargs.update(
+                AutomaticFailoverEnabled=True,
+                CacheParameterGroupName=Ref(parameter_group),
+                NumNodeGroups=cache['num_node_groups'],
+                ReplicasPerNodeGroup=replicas
+            )
+            endpoints = [('ConfigurationEndPoint.Address', record_name)]
+        else:
+            kwargs['NumCacheClusters'] = 1 + replicas
+            endpoints = [('PrimaryEndPoint.Address', record_name)]
+            if replicas:
+                endpoints.append(('ReaderEndPoint.Address', '{}-reader.{}'.format(cache['name'], cache['engine'])))
+
+        replication_group = self.add_resource(
+            elasticache.ReplicationGroup(
+                '{}ReplicationGroup'.format(name),
+                AutoMinorVersionUpgrade=True,
+                CacheNodeType=cache['instance_type'],
+                CacheSubnetGroupName=Ref(subnet_group),
+                Engine='redis',
+                EngineVersion=engine_version,
+                ReplicationGroupDescription='{} RedisElasticache Cluster'.format(name),
+                SecurityGroupIds=[Ref(security_group)],
+                **kwargs
+            )
+        )
+        return replication_group, [(record, GetAtt(replication_group, attribute)) for attribute, record in endpoints]
 
     def configure(self):
         elasticache_metadata = constants.ENVIRONMENTS[self.env]['elasticache']
@@ -38,22 +114,11 @@ class ElastiCacheTemplate(IvyTemplate):
                 )
             )
             if cache['engine'] == 'redis':
-                cache_cluster = self.add_resource(
-                    elasticache.ReplicationGroup(
-                        '{}ReplicationGroup'.format(name),
-                        AutomaticFailoverEnabled=False,
-                        AutoMinorVersionUpgrade=True,
-                        CacheNodeType=cache['instance_type'],
-                        CacheSubnetGroupName=Ref(subnet_group),
-                        Engine='redis',
-                        EngineVersion=cache.get('engine_version', '5.0.6'),
-                        NumCacheClusters=1,
-                        ReplicationGroupDescription='{} RedisElasticache Cluster'.format(name),
-                        SecurityGroupIds=[Ref(security_group)]
-                    )
-                )
-                records = [GetAtt(cache_cluster, 'PrimaryEndPoint.Address')]
+                cache_cluster, records = self.generate_replication_group(name, cache, subnet_group, security_group)
             else:
+                if not 1 <= cache.get('num_cache_nodes', 3) <= 40:
+                    raise RuntimeError('num_cache_nodes of {} must be 1 to 40: {}'.format(
+                        cache['name'], cache['num_cache_nodes']))
                 cache_cluster = self.add_resource(
                     elasticache.CacheCluster(
                         '{}CacheCluster'.format(name),
@@ -62,12 +127,13 @@ class ElastiCacheTemplate(IvyTemplate):
                         CacheSubnetGroupName=Ref(subnet_group),
                         ClusterName=cache.get('cluster_name', name),
                         Engine='memcached',
-                        EngineVersion='1.5.16',
-                        NumCacheNodes=3,
+                        EngineVersion=cache.get('engine_version', '1.5.16'),
+                        NumCacheNodes=cache.get('num_cache_nodes', 3),
                         VpcSecurityGroupIds=[Ref(security_group)]
                     )
                 )
-                records = [GetAtt(cache_cluster, 'ConfigurationEndpoint.Address')]
+                records = [('{}.{}'.format(cache['name'], cache['engine']),
+                            GetAtt(cache_cluster, 'ConfigurationEndpoint.Address'))]
 
             if self.get_partition() != 'aws-us-gov':
                 hosted_zone = constants.ENVIRONMENTS[self.env]['route53_zone']
@@ -77,11 +143,11 @@ class ElastiCacheTemplate(IvyTemplate):
                         HostedZoneName=hosted_zone,
                         RecordSets=[
                             route53.RecordSet(
-                                Name='{}.{}.{}'.format(cache['name'], cache['engine'], hosted_zone),
-                                ResourceRecords=[GetAtt(cache_cluster, 'PrimaryEndPoint.Address')],
+                                Name='{}.{}'.format(record, hosted_zone),
+                                ResourceRecords=[endpoint],
                                 Type='CNAME',
                                 TTL=600
-                            )
+                            ) for record, endpoint in records
                         ]
                     )
                 )
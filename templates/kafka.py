@@ -1,12 +1,19 @@
-from troposphere import autoscaling, ec2, Base64, Parameter, Ref
+from troposphere import autoscaling, ec2, iam, Ref, Sub
+
+import netaddr
 
 from config import constants
 from .base import IvyTemplate
-from utils.ec2 import get_block_device_mapping, get_latest_ami_id, EBS_OPTIMIZED_INSTANCES
+from utils.ec2 import ebs_block_device, ebs_volume
 
 
 class KafkaTemplate(IvyTemplate):
     CAPABILITIES = ['CAPABILITY_IAM']
+    CONFIG_KEY = 'kafka'
+
+    @classmethod
+    def ami_lookups(cls, env):
+        return [('ivy-kafka', cls.ami_owner(env))]
 
     def configure(self):
         """
@@ -18,16 +25,25 @@ class KafkaTemplate(IvyTemplate):
         self.get_standard_parameters()
         self.get_standard_policies()
 
-        _global_config = constants.ENVIRONMENTS[self.env]
 
-        self.ami = self.add_parameter(
-            Parameter(
-                'AMI',
-                Type='String',
-                Description='AMI ID for instances',
-                Default=get_latest_ami_id(self.region, "ivy-" + self.service, _global_config.get('ami_owner', 'self'))
-            )
-        )
+        self.get_ami_parameter()
+
+        if any(cluster.get('brokers') for cluster in constants.ENVIRONMENTS[self.env][self.service]):
+            # Brokers with a stable identity attach their ENI and log volume themselves
+            self.get_eni_policies()
+            self.add_iam_policy(iam.Policy(
+                PolicyName='KafkaLogVolumes',
+                PolicyDocument={
+                    'Statement': [{
+                        'Effect': 'Allow',
+                        'Resource': '*',
+                        'Action': [
+                            'ec2:AttachVolume',
+                            'ec2:DescribeVolumes'
+                        ]
+                    }]
+                }
+            ))
 
         for cluster in constants.ENVIRONMENTS[self.env][self.service]:
             _cluster_name = "{}-{}".format(self.service, cluster['name'])  # {service}-app
@@ -55,49 +71,141 @@ class KafkaTemplate(IvyTemplate):
             )
             self.add_security_group(Ref(_security_group))
 
-            _block_device_mapping = get_block_device_mapping(self.parameters['InstanceType'].resource['Default'])
+            _block_device_mapping = self.get_block_device_mapping(cluster.get('instance_type', 't2.nano'),
+                                                                  launch_template=True)
             _block_device_mapping += {
-                ec2.BlockDeviceMapping(
+                ec2.LaunchTemplateBlockDeviceMapping(
                     DeviceName="/dev/xvda",
-                    Ebs=ec2.EBSBlockDevice(
-                        DeleteOnTermination=True,
-                        VolumeSize=cluster.get('volume_size', 20),
-                        VolumeType="gp2",
-                    )
+                    Ebs=ebs_block_device(cluster, 'volume', 20, boot=True)
                 )
             }
 
-            _userdata = self.get_cloudinit_template(replacements=(
+            if cluster.get('brokers'):
+                self.generate_brokers(cluster, _cluster_name, _block_device_mapping)
+            else:
+                self.generate_asg(cluster, _cluster_name, _block_device_mapping)
+
+    def generate_asg(self, cluster, cluster_name, block_device_mapping):
+        """
+        Adds one autoscaling group of count brokers that keep their logs on the root volume
+        """
+        _subnets = self.get_subnets('private')
+        if cluster.get('placement_group') == 'cluster':
+            # A cluster placement group lives in one availability zone, so the brokers do too
+            _zone = cluster.get('availability_zone', _subnets[0]['AvailabilityZone'])
+            _subnets = [subnet for subnet in _subnets if subnet['AvailabilityZone'] == _zone]
+        _placement_groups = self.add_placement_groups(self.cfn_name(cluster_name), cluster,
+                                                      [subnet['AvailabilityZone'] for subnet in _subnets])
+        _placement_group = list(_placement_groups.values())[0] if _placement_groups else None
+
+        _userdata = self.get_cloudinit_template(replacements=(
+            ('__PROMPT_COLOR__', self.prompt_color()),
+            ('__CLUSTER_NAME__', cluster_name),
+            ('__BROKER_ID__', ''),
+            ('{#CFN_ENI_ID}', ''),
+            ('{#CFN_LOG_EBS_VOLUME_ID}', ''),
+        ))
+
+        _launch_template = self.add_launch_template(
+            self.cfn_name(cluster_name, 'LaunchTemplate'),
+            instance_type=cluster.get('instance_type', 't2.nano'),
+            block_device_mappings=block_device_mapping,
+            user_data=_userdata,
+            ebs_optimized=self.ebs_optimized(cluster.get('instance_type', 't2.nano')),
+            placement=ec2.Placement(GroupName=Ref(_placement_group)) if _placement_group else None
+        )
+        self.add_resource(
+            autoscaling.AutoScalingGroup(
+                self.cfn_name(cluster_name, 'ASGroup'),
+                HealthCheckType='EC2',
+                LaunchTemplate=self.launch_template_specification(_launch_template),
+                MinSize=cluster.get('count', 3),
+                MaxSize=cluster.get('count', 3),
+                VPCZoneIdentifier=[subnet['SubnetId'] for subnet in _subnets],
+                Tags=self.get_autoscaling_tags(service_override=cluster_name, role_override=self.service) + [
+                    autoscaling.Tag('Name', "{}{}".format(self.env, cluster_name), True)
+                ],
+                **({'PlacementGroup': Ref(_placement_group)} if _placement_group else {})
+            )
+        )
+
+    def generate_brokers(self, cluster, cluster_name, block_device_mapping):
+        """
+        Adds a one-instance autoscaling group per broker, like Cassandra nodes: a replaced broker keeps its broker
+        ID, its ENI (and so its IP address) and its retained log volume, and only catches up on what it missed
+        """
+        subnets = self.get_subnets('private')
+        brokers = [(broker.get('id', index), broker) for index, broker in enumerate(cluster['brokers'], 1)]
+        if len(set(broker_id for broker_id, _ in brokers)) != len(brokers):
+            raise RuntimeError('Broker IDs of {} must be unique: {}'.format(
+                cluster_name, [broker_id for broker_id, _ in brokers]))
+        broker_subnets = [
+            [s for s in subnets if netaddr.IPAddress(broker['ip']) in netaddr.IPNetwork(s['CidrBlock'])][0]
+            for _, broker in brokers
+        ]
+        zones = sorted(set(s['AvailabilityZone'] for s in broker_subnets))
+        placement_groups = self.add_placement_groups(self.cfn_name(cluster_name), cluster, zones)
+
+        for (broker_id, broker), subnet in zip(brokers, broker_subnets):
+            role = '{}-{}'.format(cluster_name, broker_id)
+            tags = self.get_tags(service_override=cluster_name, role_override=role)
+
+            eni = self.add_resource(
+                ec2.NetworkInterface(
+                    self.cfn_name(cluster_name, 'Broker', str(broker_id), 'ENI'),
+                    Description='Kafka: Cluster: {} Broker: {} ENV: {} PrivateSubnet {}'.format(
+                        cluster_name, broker_id, self.env, subnet['SubnetId']),
+                    GroupSet=self.security_groups,
+                    PrivateIpAddress=broker['ip'],
+                    SourceDestCheck=True,
+                    SubnetId=subnet['SubnetId'],
+                    Tags=tags,
+                )
+            )
+            log_volume = self.add_resource(
+                ebs_volume(
+                    self.cfn_name(cluster_name, 'Broker', str(broker_id), 'LogVolume'),
+                    cluster, 'log_volume', 100,
+                    AvailabilityZone=subnet['AvailabilityZone'],
+                    DeletionPolicy='Retain',
+                    Tags=tags + [ec2.Tag('Name', role + '-logvol')]
+                )
+            )
+
+            user_data_template = self.get_cloudinit_template(replacements=(
                 ('__PROMPT_COLOR__', self.prompt_color()),
-                ('__CLUSTER_NAME__', _cluster_name),
+                ('__CLUSTER_NAME__', cluster_name),
+                ('__BROKER_ID__', broker_id),
             ))
+            userdata = Sub(
+                user_data_template
+                    .replace('${', '${!')  # Replace bash brackets with CFN escaped style
+                    .replace('{#', '${'),  # Replace rain-style CFN escapes with proper CFN brackets
+                {
+                    'CFN_ENI_ID': Ref(eni),
+                    'CFN_LOG_EBS_VOLUME_ID': Ref(log_volume)
+                }
+            )
 
-            _launch_configuration = self.add_resource(
-                autoscaling.LaunchConfiguration(
-                    self.cfn_name(_cluster_name, 'LaunchConfiguration'),
-                    AssociatePublicIpAddress=False,
-                    BlockDeviceMappings=_block_device_mapping,
-                    ImageId=Ref(self.ami),
-                    InstanceType=cluster.get('instance_type', 't2.nano'),
-                    EbsOptimized=True if cluster.get('instance_type', 't2.nano') in EBS_OPTIMIZED_INSTANCES else False,
-                    InstanceMonitoring=False,
-                    IamInstanceProfile=Ref(self.instance_profile),
-                    KeyName=Ref(self.keypair_name),
-                    SecurityGroups=self.security_groups,
-                    UserData=Base64(_userdata)
-                )
+            launch_template = self.add_launch_template(
+                self.cfn_name(cluster_name, 'Broker', str(broker_id), 'LaunchTemplate'),
+                instance_type=cluster.get('instance_type', 't2.nano'),
+                block_device_mappings=block_device_mapping,
+                user_data=userdata,
+                ebs_optimized=self.ebs_optimized(cluster.get('instance_type', 't2.nano')),
+                placement=self.placement(placement_groups, subnet['AvailabilityZone'], zones)
             )
             self.add_resource(
                 autoscaling.AutoScalingGroup(
-                    self.cfn_name(_cluster_name, 'ASGroup'),
+                    self.cfn_name(cluster_name, 'Broker', str(broker_id), 'ASGroup'),
+                    AvailabilityZones=[subnet['AvailabilityZone']],
                     HealthCheckType='EC2',
-                    LaunchConfigurationName=Ref(_launch_configuration),
-                    MinSize=cluster.get('count', 3),
-                    MaxSize=cluster.get('count', 3),
-                    VPCZoneIdentifier=[subnet['SubnetId'] for subnet in self.get_subnets('private')],
-                    Tags=self.get_autoscaling_tags(service_override=_cluster_name, role_override=self.service) + [
-                        autoscaling.Tag('Name', "{}{}".format(self.env, _cluster_name), True)
+                    LaunchTemplate=self.launch_template_specification(launch_template),
+                    MinSize=1,
+                    MaxSize=1,
+                    VPCZoneIdentifier=[subnet['SubnetId']],
+                    Tags=self.get_autoscaling_tags(service_override=cluster_name, role_override=role) + [
+                        autoscaling.Tag('Name', "{}{}".format(self.env, role), True)
                     ]
                 )
             )
-
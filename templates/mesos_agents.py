@@ -1,15 +1,24 @@
 from troposphere import (autoscaling, ec2, elasticloadbalancing, elasticloadbalancingv2,
-                         cloudwatch, sns,iam, policies, route53, Base64, GetAtt, Parameter,
+                         cloudwatch, sns,iam, policies, route53, GetAtt, Join,
                          Ref)
 
 from config import constants
 from .base import IvyTemplate
-from utils.ec2 import get_block_device_mapping, get_latest_ami_id, EBS_OPTIMIZED_INSTANCES
+from utils.autoscaling import InstanceReusePolicy, POOL_STATES, WarmPool
+from utils.ec2 import ebs_block_device
 
 
 class MesosAgentsTemplate(IvyTemplate):
+    CONFIG_KEY = 'mesos'
+    # Lifecycle hook agents of groups with a warm pool complete when they are ready
+    LAUNCH_LIFECYCLE_HOOK = 'mesos-agent-launching'
+
     elb_external_security_group = None
 
+    @classmethod
+    def ami_lookups(cls, env):
+        return [('ivy-mesos', cls.ami_owner(env))]
+
     def generate_load_balancer(self, lb_name, typ, port, cert_arn, log_bucket):
 
         lb_name = self.cfn_name(lb_name)
@@ -230,16 +239,160 @@ class MesosAgentsTemplate(IvyTemplate):
         ))
         return _alb, _target_group
 
-    def generate_asg(self, placement, count, block_mapping, load_balancers=None, target_group_arns=None, preferred_subnets_only=False):
+    def mixed_instances_policy(self, launch_template, capacity):
+        """
+        Spreads an agent autoscaling group over several instance types and Spot capacity
+        :param capacity: (dict) capacity configuration of one placement, e.g.
+            {
+                'instance_types': ['c5.4xlarge', 'c5a.4xlarge', 'm5.4xlarge'],  # overrides InstanceType
+                'on_demand_base': 1,  # instances that are always on-demand
+                'spot_percentage': 70,  # share of Spot instances above the on-demand base
+                'spot_allocation_strategy': 'capacity-optimized'  # default
+            }
+        :return: (autoscaling.MixedInstancesPolicy)
+        """
+        spot_percentage = capacity.get('spot_percentage', 0)
+        if not 0 <= spot_percentage <= 100:
+            raise RuntimeError('spot_percentage must be between 0 and 100: {}'.format(spot_percentage))
+        return autoscaling.MixedInstancesPolicy(
+            InstancesDistribution=autoscaling.InstancesDistribution(
+                OnDemandAllocationStrategy='prioritized',
+                OnDemandBaseCapacity=capacity.get('on_demand_base', 0),
+                OnDemandPercentageAboveBaseCapacity=100 - spot_percentage,
+                SpotAllocationStrategy=capacity.get('spot_allocation_strategy', 'capacity-optimized')
+            ),
+            LaunchTemplate=autoscaling.LaunchTemplate(
+                LaunchTemplateSpecification=self.launch_template_specification(launch_template),
+                **({'Overrides': [autoscaling.LaunchTemplateOverrides(InstanceType=t)
+                                  for t in capacity['instance_types']]} if capacity.get('instance_types') else {})
+            )
+        )
+
+    def scaling_policies(self, role_name, asg, placement, scaling, target_groups=None):
+        """
+        Target tracking policies for an agent autoscaling group
+        :param scaling: (dict) scaling configuration of one placement, e.g.
+            {
+                'max_size': 100,
+                'cpu': 60,  # average CPU utilization, in percent
+                'requests_per_target': 1000,  # ALB requests per agent and minute, application load balancers only
+                'requests_load_balancer': 'internal',  # default, or 'external'
+                'allocation': 75,  # Mesos CPU allocation, in percent, published as a custom metric
+                'disable_scale_in': False
+            }
+        :param target_groups: (dict) 'internal' and 'external' to (load balancer, target group), None for ELBs
+        :return: (list) of autoscaling.ScalingPolicy
+        """
+        config = constants.ENVIRONMENTS[self.env]['mesos']['agent']
+        target_tracking = []
+
+        def add_policy(name, target, **metric):
+            if target <= 0:
+                raise RuntimeError('Scaling target {} of {} agents must be positive: {}'.format(name, placement, target))
+            target_tracking.append(autoscaling.ScalingPolicy(
+                '{}{}ScalingPolicy'.format(role_name, name),
+                AutoScalingGroupName=Ref(asg),
+                EstimatedInstanceWarmup=config.get('instance_warmup', 300),
+                PolicyType='TargetTrackingScaling',
+                TargetTrackingConfiguration=autoscaling.TargetTrackingConfiguration(
+                    DisableScaleIn=scaling.get('disable_scale_in', False),
+                    TargetValue=float(target),
+                    **metric
+                )
+            ))
+
+        if scaling.get('cpu'):
+            add_policy('CPU', scaling['cpu'], PredefinedMetricSpecification=autoscaling.PredefinedMetricSpecification(
+                PredefinedMetricType='ASGAverageCPUUtilization'
+            ))
+
+        if scaling.get('requests_per_target'):
+            if not target_groups:
+                raise RuntimeError('requests_per_target of {} agents needs lb_type "application"'.format(placement))
+            load_balancer, target_group = target_groups[scaling.get('requests_load_balancer', 'internal')]
+            add_policy('Requests', scaling['requests_per_target'],
+                       PredefinedMetricSpecification=autoscaling.PredefinedMetricSpecification(
+                           PredefinedMetricType='ALBRequestCountPerTarget',
+                           ResourceLabel=Join('/', [GetAtt(load_balancer, 'LoadBalancerFullName'),
+                                                    GetAtt(target_group, 'TargetGroupFullName')])
+                       ))
+
+        if scaling.get('allocation'):
+            add_policy('Allocation', scaling['allocation'],
+                       CustomizedMetricSpecification=autoscaling.CustomizedMetricSpecification(
+                           Namespace='Mesos',
+                           MetricName='CpusAllocatedPercent',
+                           Dimensions=[
+                               autoscaling.MetricDimension(Name='Environment', Value=self.env),
+                               autoscaling.MetricDimension(Name='Placement', Value=placement)
+                           ],
+                           Statistic='Average'
+                       ))
+
+        return target_tracking
+
+    def warm_pool(self, role_name, asg, placement, pool, instance_types, docker_storage='ebs'):
+        """
+        Keeps agents that already ran their one-time setup ready for scale-out. Agents keeping docker on instance
+        store volumes format them again when they leave a stopped pool, hibernated pools cannot have them.
+        :param pool: (dict) warm pool configuration of one placement, e.g.
+            {
+                'min_size': 2,  # instances always kept in the pool
+                'max_prepared': 10,  # instances in service and in the pool, default MaxSize of the group
+                'state': 'Stopped',  # default, or 'Running' or 'Hibernated'
+                'reuse_on_scale_in': True  # return instances to the pool instead of terminating them
+            }
+        :param docker_storage: (string) 'ebs' or 'instance-store', see IvyTemplate.data_storage()
+        :return: (WarmPool)
+        """
+        state = pool.get('state', 'Stopped')
+        if state not in POOL_STATES:
+            raise RuntimeError('Warm pool state of {} agents must be one of {}: {}'.format(
+                placement, ', '.join(POOL_STATES), state))
+        if state == 'Hibernated':
+            # a hibernated agent resumes with docker mounted on instance store volumes that lost their data
+            if docker_storage == 'instance-store':
+                raise RuntimeError('{} agents with docker_storage instance-store cannot hibernate in a warm pool'
+                                   .format(placement))
+            # hibernation writes memory to the root volume
+            rootfs_size = constants.ENVIRONMENTS[self.env]['mesos']['agent'].get('rootfs_size', 50)
+            for instance_type in [self._instance_type_name(t) for t in instance_types or [None]]:
+                memory = self.instance_type_catalog.capabilities(instance_type)['MemoryMiB']
+                if memory >= rootfs_size * 1024:
+                    raise RuntimeError('Hibernating {} agents needs a rootfs larger than the {} MiB of memory of {}'
+                                       .format(placement, memory, instance_type))
+        return WarmPool(
+            '{}WarmPool'.format(role_name),
+            AutoScalingGroupName=Ref(asg),
+            InstanceReusePolicy=InstanceReusePolicy(ReuseOnScaleIn=pool.get('reuse_on_scale_in', False)),
+            MinSize=pool.get('min_size', 0),
+            PoolState=state,
+            **({'MaxGroupPreparedCapacity': pool['max_prepared']} if 'max_prepared' in pool else {})
+        )
+
+    def generate_asg(self, placement, count, block_mapping, load_balancers=None, target_group_arns=None,
+                     preferred_subnets_only=False, target_groups=None):
         if placement not in ["public", "private"]:
             raise NameError("Mesos ASG must be either public or private")
 
+        agent_config = constants.ENVIRONMENTS[self.env]['mesos']['agent']
+        capacity = agent_config.get('capacity', {}).get(placement)
+        instance_types = capacity.get('instance_types', []) if capacity else []
+        scaling = agent_config.get('scaling', {}).get(placement, {})
+        pool = agent_config.get('warm_pool', {}).get(placement)
+        docker_storage = self.data_storage(agent_config, 'docker_storage', *instance_types)
+
         mesos_masters = constants.ENVIRONMENTS[self.env]['mesos']['master']['masters']
         user_data = self.get_cloudinit_template(
             replacements=(
+                ('__INSTANCE_STORE_FUNCTIONS__', self.get_cloudinit_template('instance_store')),
                 ('__PROMPT_COLOR__', self.prompt_color()),
                 ('__PLACEMENT__', placement),
-                ('__ZK_CONNECT__', ','.join(['{}:2181'.format(z) for z in mesos_masters]))
+                ('__ZK_CONNECT__', ','.join(['{}:2181'.format(z) for z in mesos_masters])),
+                ('__DOCKER_STORAGE__', docker_storage),
+                ('__PUBLISH_ALLOCATION__', 'true' if scaling.get('allocation') else 'false'),
+                ('__WARM_POOL__', 'true' if pool else 'false'),
+                ('__LIFECYCLE_HOOK__', self.LAUNCH_LIFECYCLE_HOOK)
             )
         )
 
@@ -257,37 +410,50 @@ class MesosAgentsTemplate(IvyTemplate):
         # )
 
         role_name = "Mesos{}Agent".format(placement.capitalize())
-
-        launch_configuration = self.add_resource(
-            autoscaling.LaunchConfiguration(
-                '{}LaunchConfiguration'.format(role_name),
-                AssociatePublicIpAddress=False,
-                BlockDeviceMappings=block_mapping,
-                EbsOptimized=True if self.defaults.get('instance_type') in EBS_OPTIMIZED_INSTANCES else False,
-                KeyName=Ref(self.keypair_name),
-                ImageId=Ref(self.ami),
-                IamInstanceProfile=Ref(self.instance_profile),
-                InstanceType=Ref(self.instance_type),
-                InstanceMonitoring=False,
-                SecurityGroups=self.security_groups,
-                UserData=Base64(user_data)
-            )
+        subnets = self.get_subnets(placement, _preferred_only=preferred_subnets_only)
+
+        launch_template = self.add_launch_template(
+            '{}LaunchTemplate'.format(role_name),
+            instance_type=Ref(self.instance_type),
+            block_device_mappings=block_mapping,
+            user_data=user_data,
+            ebs_optimized=self.ebs_optimized(*instance_types),
+            hibernation=bool(pool) and pool.get('state') == 'Hibernated'
         )
+        if capacity:
+            asg_options = {'MixedInstancesPolicy': self.mixed_instances_policy(launch_template, capacity)}
+        else:
+            asg_options = {'LaunchTemplate': self.launch_template_specification(launch_template)}
+
+        max_size = scaling.get('max_size', 100)
+        if max_size < count:
+            raise RuntimeError('max_size of {} agents is below their count: {} < {}'.format(placement, max_size, count))
+        if 'scaling_cooldown' in agent_config:
+            asg_options['Cooldown'] = agent_config['scaling_cooldown']
+        if 'protect_from_scale_in' in agent_config:
+            asg_options['NewInstancesProtectedFromScaleIn'] = agent_config['protect_from_scale_in']
+        if pool:
+            # Agents complete it once they are ready for the warm pool, and again once they joined the cluster
+            asg_options['LifecycleHookSpecificationList'] = [
+                autoscaling.LifecycleHookSpecification(
+                    DefaultResult='ABANDON',
+                    HeartbeatTimeout=900,
+                    LifecycleHookName=self.LAUNCH_LIFECYCLE_HOOK,
+                    LifecycleTransition='autoscaling:EC2_INSTANCE_LAUNCHING'
+                )
+            ]
 
-        self.add_resource(
+        asg = self.add_resource(
             autoscaling.AutoScalingGroup(
                 '{}ASGroup'.format(role_name),
-                AvailabilityZones=[subnet['AvailabilityZone'] for subnet in
-                                   self.get_subnets(placement, _preferred_only=preferred_subnets_only)],
+                AvailabilityZones=[subnet['AvailabilityZone'] for subnet in subnets],
                 HealthCheckType='ELB',
                 HealthCheckGracePeriod=600,
-                LaunchConfigurationName=Ref(launch_configuration),
                 LoadBalancerNames=load_balancers if target_group_arns == None else [],
                 TargetGroupARNs=target_group_arns if load_balancers == None else [],
                 MinSize=count,
-                MaxSize=100,
-                VPCZoneIdentifier=[subnet['SubnetId'] for subnet in
-                                   self.get_subnets(placement, _preferred_only=preferred_subnets_only)],
+                MaxSize=max_size,
+                VPCZoneIdentifier=[subnet['SubnetId'] for subnet in subnets],
                 Tags=self.get_autoscaling_tags(service_override="MesosAgent",
                                                role_override=role_name) + [
                          autoscaling.Tag('Name', self.env + role_name, True)
@@ -303,8 +469,13 @@ class MesosAgentsTemplate(IvyTemplate):
                 #         ]
                 #     )
                 # ]
+                **asg_options
             )
         )
+        for policy in self.scaling_policies(role_name, asg, placement, scaling, target_groups):
+            self.add_resource(policy)
+        if pool:
+            self.add_resource(self.warm_pool(role_name, asg, placement, pool, instance_types, docker_storage))
 
     def configure(self):
         config = constants.ENVIRONMENTS[self.env]['mesos']['agent']
@@ -317,16 +488,8 @@ class MesosAgentsTemplate(IvyTemplate):
         self.get_standard_policies()
         self.get_default_security_groups()
 
-        _global_config = constants.ENVIRONMENTS[self.env]
 
-        self.ami = self.add_parameter(
-            Parameter(
-                'AMI',
-                Type='String',
-                Description='AMI ID for instances',
-                Default=get_latest_ami_id(self.region, 'ivy-mesos', _global_config.get('ami_owner', 'self'))
-            )
-        )
+        self.get_ami_parameter()
 
         # Mesos Agent Security Group
         self.mesos_agent_security_group = self.add_resource(
@@ -410,6 +573,42 @@ class MesosAgentsTemplate(IvyTemplate):
                 }
             )
         )
+        # Agents scaling on Mesos allocation publish it themselves
+        if any(s.get('allocation') for s in config.get('scaling', {}).values()):
+            self.add_iam_policy(
+                iam.Policy(
+                    PolicyName='PublishAllocationMetric',
+                    PolicyDocument={
+                        'Statement': [
+                            {
+                                'Effect': 'Allow',
+                                'Action': ['cloudwatch:PutMetricData'],
+                                'Resource': '*',
+                                'Condition': {'StringEquals': {'cloudwatch:namespace': 'Mesos'}}
+                            }
+                        ]
+                    }
+                )
+            )
+        # Agents of groups with a warm pool complete their launch lifecycle hook
+        if config.get('warm_pool'):
+            self.add_iam_policy(
+                iam.Policy(
+                    PolicyName='CompleteLifecycleAction',
+                    PolicyDocument={
+                        'Statement': [
+                            {
+                                'Effect': 'Allow',
+                                'Action': [
+                                    'autoscaling:CompleteLifecycleAction',
+                                    'autoscaling:DescribeAutoScalingInstances'
+                                ],
+                                'Resource': '*'
+                            }
+                        ]
+                    }
+                )
+            )
         # Add docker roles to assumable roles list
         for r in self.generate_docker_roles():
             self.add_resource(r)
@@ -461,6 +660,10 @@ class MesosAgentsTemplate(IvyTemplate):
             )
             self.add_resource(external_elb)
             self.add_resource(external_target_group)
+            target_groups = {
+                'internal': (internal_elb, internal_target_group),
+                'external': (external_elb, external_target_group)
+            }
 
         # extra public load balancers (for SSL termination, ELB doesn't do SNI)
         extra_public_load_balancers = []
@@ -491,23 +694,15 @@ class MesosAgentsTemplate(IvyTemplate):
         #
 
         # Add docker volume
-        block_device_mapping = get_block_device_mapping(self.parameters['InstanceType'].resource['Default'])
+        block_device_mapping = self.get_block_device_mapping(launch_template=True)
         block_device_mapping.extend([
-            ec2.BlockDeviceMapping(
+            ec2.LaunchTemplateBlockDeviceMapping(
                 DeviceName="/dev/xvda",  # rootfs
-                Ebs=ec2.EBSBlockDevice(
-                    DeleteOnTermination=True,
-                    VolumeSize=config.get('rootfs_size', 50),
-                    VolumeType="gp2"
-                )
+                Ebs=ebs_block_device(config, 'rootfs', 50, boot=True)
             ),
-            ec2.BlockDeviceMapping(
+            ec2.LaunchTemplateBlockDeviceMapping(
                 DeviceName="/dev/xvdb",
-                Ebs=ec2.EBSBlockDevice(
-                    DeleteOnTermination=True,
-                    VolumeSize=config.get('dockervol_size', 100),
-                    VolumeType=config.get('dockervol_type', 'gp2')
-                )
+                Ebs=ebs_block_device(config, 'dockervol', 100)
             )
         ])
 
@@ -536,7 +731,8 @@ class MesosAgentsTemplate(IvyTemplate):
                               count=config['count'].get('private', 2),
                               block_mapping=block_device_mapping,
                               target_group_arns=[Ref(internal_target_group), Ref(external_target_group)] + extra_public_load_balancers,
-                              preferred_subnets_only=preferred_only
+                              preferred_subnets_only=preferred_only,
+                              target_groups=target_groups
                               )
 
             # Public ASG
@@ -544,7 +740,8 @@ class MesosAgentsTemplate(IvyTemplate):
                               count=config['count'].get('public', 0),
                               block_mapping=block_device_mapping,
                               target_group_arns=[Ref(internal_target_group), Ref(external_target_group)] + extra_public_load_balancers,
-                              preferred_subnets_only=preferred_only
+                              preferred_subnets_only=preferred_only,
+                              target_groups=target_groups
                               )
 
         #
@@ -1,13 +1,17 @@
-from troposphere import autoscaling, ec2, iam, Base64, Parameter, Ref, Sub
+from troposphere import autoscaling, ec2, iam, Base64, Ref, Sub
 
 import netaddr
 from config import constants
 from .base import IvyTemplate
-from utils.ec2 import get_block_device_mapping, get_latest_ami_id
 
 
 class MesosMastersTemplate(IvyTemplate):
     CAPABILITIES = ['CAPABILITY_IAM']
+    CONFIG_KEY = 'mesos'
+
+    @classmethod
+    def ami_lookups(cls, env):
+        return [('ivy-mesos', cls.ami_owner(env))]
 
     def configure(self):
         """
@@ -24,16 +28,8 @@ class MesosMastersTemplate(IvyTemplate):
         self.get_standard_parameters()
         self.get_standard_policies()
 
-        _global_config = constants.ENVIRONMENTS[self.env]
 
-        self.ami = self.add_parameter(
-            Parameter(
-                'AMI',
-                Type='String',
-                Description='AMI ID for instances',
-                Default=get_latest_ami_id(self.region, 'ivy-mesos', _global_config.get('ami_owner', 'self'))
-            )
-        )
+        self.get_ami_parameter()
         _mesos_master_security_group = self.add_resource(
             ec2.SecurityGroup(
                 'MesosMasterSecurityGroup',
@@ -70,6 +66,10 @@ class MesosMastersTemplate(IvyTemplate):
 
         masters = [(index, ip) for index, ip in enumerate(config['masters'], 1)]
         subnets = self.get_subnets('private')
+        placement_groups = self.add_placement_groups('MesosMaster', config, [
+            s['AvailabilityZone'] for s in subnets for _, ip in masters
+            if netaddr.IPAddress(ip) in netaddr.IPNetwork(s['CidrBlock'])
+        ])
         for master in masters:
             zone_index, master_ip = master
             subnet = [s for s in subnets if netaddr.IPAddress(master_ip) in netaddr.IPNetwork(s['CidrBlock'])][0]
@@ -116,7 +116,7 @@ class MesosMastersTemplate(IvyTemplate):
                 autoscaling.LaunchConfiguration(
                     'MesosMasterLaunchConfiguration{}'.format(subnet['AvailabilityZone'][-1]),
                     AssociatePublicIpAddress=False,
-                    BlockDeviceMappings=get_block_device_mapping(self.parameters['InstanceType'].resource['Default']),
+                    BlockDeviceMappings=self.get_block_device_mapping(),
                     SecurityGroups=self.security_groups,
                     KeyName=Ref(self.keypair_name),
                     ImageId=Ref(self.ami),
@@ -126,6 +126,7 @@ class MesosMastersTemplate(IvyTemplate):
                     UserData=Base64(_user_data)
                 )
             )
+            _placement = {'PlacementGroup': Ref(placement_groups[subnet['AvailabilityZone']])} if placement_groups else {}
             self.add_resource(
                 autoscaling.AutoScalingGroup(
                     'MesosMasterASGroup{}'.format(subnet['AvailabilityZone'][-1]),
@@ -143,6 +144,7 @@ class MesosMastersTemplate(IvyTemplate):
                                              True),
                              # tag to allow consul to discover the hosts
                              # autoscaling.Tag('{}:consul_master'.format(constants.TAG), self.env, True)
-                         ]
+                         ],
+                    **_placement
                 )
             )
@@ -1,12 +1,18 @@
-from troposphere import autoscaling, ec2, iam, route53, Base64, GetAtt, Parameter, Ref, Sub
+from troposphere import autoscaling, ec2, iam, route53, Base64, GetAtt, Ref, Sub
 
 from config import constants
 from .base import IvyTemplate
-from utils.ec2 import get_latest_ami_id
+from utils.amis import AMAZON_LINUX_2
+from utils.ec2 import ebs_volume
 
 
 class NexusTemplate(IvyTemplate):
     CAPABILITIES = ['CAPABILITY_IAM']
+    CONFIG_KEY = 'nexus'
+
+    @classmethod
+    def ami_lookups(cls, env):
+        return [(AMAZON_LINUX_2, 'amazon')]
 
     def configure(self):
         """
@@ -21,14 +27,7 @@ class NexusTemplate(IvyTemplate):
         self.get_default_security_groups()
         self.get_standard_parameters()
         self.get_standard_policies()
-        self.ami = self.add_parameter(
-            Parameter(
-                'AMI',
-                Type='String',
-                Description='AMI ID for instances',
-                Default=get_latest_ami_id(self.region, 'amzn2-ami-hvm-2.0.????????-x86_64-gp2', 'amazon')
-            )
-        )
+        self.get_ami_parameter()
 
         config = constants.ENVIRONMENTS[self.env][self.service]
 
@@ -53,10 +52,9 @@ class NexusTemplate(IvyTemplate):
         )
 
         # Add our EBS data volume
-        data_volume = ec2.Volume(
+        data_volume = ebs_volume(
             '{}DataVolume'.format(self.name),
-            Size=config.get('data_volume_size', 20),
-            VolumeType='gp2',
+            config, 'data_volume', 20,
             AvailabilityZone=subnet['AvailabilityZone'],
             DeletionPolicy='Retain',
             Tags=self.get_tags(service_override=self.service, role_override=self.name) + [ec2.Tag('Name', self.name + "-datavol")]
@@ -1,14 +1,23 @@
 import random
 
-from troposphere import autoscaling, ec2, iam, route53, Base64, GetAtt, Parameter, Ref, Sub
+from troposphere import autoscaling, ec2, iam, route53, Base64, GetAtt, Ref, Sub
 
 from config import constants
 from .base import IvyTemplate
-from utils.ec2 import get_latest_ami_id
+from utils.amis import AMAZON_LINUX_2
+from utils.ec2 import ebs_volume
 
 
 class PritunlTemplate(IvyTemplate):
     CAPABILITIES = ['CAPABILITY_IAM']
+    CONFIG_KEY = 'pritunl'
+
+    @classmethod
+    def ami_lookups(cls, env):
+        # Bootstrap mode starts from stock Amazon Linux, otherwise use our base image
+        if constants.ENVIRONMENTS[env]['pritunl'].get('bootstrap_mode', False):
+            return [(AMAZON_LINUX_2, 'amazon')]
+        return [('ivy-base', cls.ami_owner(env))]
 
     def configure(self):
         """
@@ -25,20 +34,9 @@ class PritunlTemplate(IvyTemplate):
         self.get_standard_policies()
 
         _vpn_config = constants.ENVIRONMENTS[self.env]['pritunl']
-        _global_config = constants.ENVIRONMENTS[self.env]
         _bootstrap_mode = _vpn_config.get('bootstrap_mode', False)
 
-        _bootstrap_ami = get_latest_ami_id(self.region, 'amzn2-ami-hvm-2.0.????????-x86_64-gp2', 'amazon')
-        _ivy_ami = get_latest_ami_id(self.region, 'ivy-base', _global_config.get('ami_owner', 'self'))
-
-        self.ami = self.add_parameter(
-            Parameter(
-                'AMI',
-                Type='String',
-                Description='AMI ID for instances',
-                Default=_bootstrap_ami if _bootstrap_mode else _ivy_ami
-            )
-        )
+        self.get_ami_parameter()
 
         _public_dns = _vpn_config['public_dns']
 
@@ -89,10 +87,9 @@ class PritunlTemplate(IvyTemplate):
                     }]
                 }
             ))
-            _data_volume = ec2.Volume(
+            _data_volume = ebs_volume(
                 '{}DataVolume'.format(_vpn_name),
-                Size=_vpn_config.get('data_volume_size', 20),
-                VolumeType='gp2',
+                _vpn_config, 'data_volume', 20,
                 AvailabilityZone=_vpn_subnet['AvailabilityZone'],
                 DeletionPolicy='Retain',
                 Tags=self.get_tags(service_override=self.service, role_override=_vpn_name) + [ec2.Tag('Name', _vpn_name + "-datavol")]
@@ -144,8 +141,7 @@ class PritunlTemplate(IvyTemplate):
             )
 
         # Get all route tables in the VPC
-        _vpc_route_tables = self.ec2_conn.describe_route_tables(
-            Filters=[{'Name': 'vpc-id', 'Values': [self.vpc_id]}])['RouteTables']
+        _vpc_route_tables = self.discovery.route_tables(self.vpc_id)
 
         # Set up the routing table for the VPC
         # Allow for changing client subnets in constants.py
@@ -6,6 +6,7 @@ import os
 
 
 class RDSTemplate(IvyTemplate):
+    CONFIG_KEY = 'rds'
 
     def configure(self):
         rds_metadata = constants.ENVIRONMENTS[self.env]['rds']
@@ -5,6 +5,7 @@ from .base import IvyTemplate
 
 class SecurityGroupTemplate(IvyTemplate):
     CAPABILITIES = ['CAPABILITY_IAM']
+    DEPENDS_ON = ('VPC',)
 
     def configure(self):
         self.set_description('Shared and Default Security Groups')
@@ -2,11 +2,12 @@ from troposphere import autoscaling, ec2, iam, Base64, GetAtt, Parameter, Ref
 
 from config import constants
 from .base import IvyTemplate
-from utils.ec2 import get_block_device_mapping, get_latest_ami_id
+from utils.ec2 import get_latest_ami_id
 
 
 class VPCTemplate(IvyTemplate):
     CAPABILITIES = ['CAPABILITY_IAM']
+    DEPENDS_ON = ()
 
     def configure(self):
         self.vpc_metadata = constants.ENVIRONMENTS[self.env]['vpc']
@@ -1,12 +1,17 @@
-from troposphere import autoscaling, ec2, Sub, Base64, GetAtt, Parameter, Ref
+from troposphere import autoscaling, ec2, Sub, Base64, GetAtt, Ref
 import itertools
 
 from config import constants
 from .base import IvyTemplate
-from utils.ec2 import get_latest_ami_id
+from utils.amis import AMAZON_LINUX_2
 
 class VPNTemplate(IvyTemplate):
     CAPABILITIES = ['CAPABILITY_IAM']
+    CONFIG_KEY = 'vpn'
+
+    @classmethod
+    def ami_lookups(cls, env):
+        return [(AMAZON_LINUX_2, 'amazon')]
 
     def configure(self):
         """
@@ -22,14 +27,7 @@ class VPNTemplate(IvyTemplate):
         self.get_default_security_groups()
         self.get_standard_parameters()
         self.get_standard_policies()
-        self.ami = self.add_parameter(
-            Parameter(
-                'AMI',
-                Type='String',
-                Description='AMI ID for instances',
-                Default=get_latest_ami_id(self.region, 'amzn2-ami-hvm-2.0.????????-x86_64-gp2', 'amazon')
-            )
-        )
+        self.get_ami_parameter()
 
         # Custom config per VPN
         for vpn in constants.ENVIRONMENTS[self.env]['vpn']:
@@ -89,8 +87,7 @@ class VPNTemplate(IvyTemplate):
                 )
             )
             # Set up Routes from all VPC subnets to the ENI
-            _vpc_route_tables = self.ec2_conn.describe_route_tables(
-                Filters=[{'Name': 'vpc-id', 'Values': [self.vpc_id]}])['RouteTables']
+            _vpc_route_tables = self.discovery.route_tables(self.vpc_id)
 
             _local_subnets = iter(map(
                 lambda x: constants.ENVIRONMENTS[x]['vpc']['cidrblock'],
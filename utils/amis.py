@@ -0,0 +1,101 @@
+import fnmatch
+import threading
+
+from utils.aws import get_client
+from utils.cache import get_cache
+
+AMAZON_LINUX_2 = 'amzn2-ami-hvm-2.0.????????-x86_64-gp2'
+
+
+class AmiCatalog(object):
+    """
+    Resolves AMI name prefixes to the newest matching image in a region.
+
+    All lookups a render needs are resolved in one pass: patterns are grouped by owner and each owner is queried
+    with a single describe_images call, from which only the newest image per pattern is kept. The resulting
+    index is stored in the discovery cache so later runs skip the (large) public image listings entirely.
+    """
+
+    def __init__(self, region, cache=None):
+        self.region = region
+        self.cache = cache or get_cache()
+        self._index = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _owner(owner):
+        return owner if owner else 'self'
+
+    def _query(self, name, owner):
+        return {'name': name, 'owner': self._owner(owner)}
+
+    def resolve(self, lookups):
+        """
+        Resolves every (name, owner) lookup that is not already indexed
+        :param lookups: (list) of (name prefix, owner) tuples, owner may be None for 'self'
+        """
+        with self._lock:
+            missing = {}
+            for name, owner in lookups:
+                key = (name, self._owner(owner))
+                if key in self._index:
+                    continue
+                hit, image = self.cache.lookup(self.region, 'amis', self._query(*key))
+                if hit:
+                    self._index[key] = image
+                else:
+                    missing.setdefault(key[1], set()).add(name)
+
+            if not missing:
+                return
+            ec2 = get_client('ec2', self.region)
+            for owner, names in missing.items():
+                newest = dict((name, None) for name in names)
+                images = ec2.describe_images(
+                    Owners=[owner],
+                    Filters=[
+                        {'Name': 'name', 'Values': ['{}*'.format(name) for name in sorted(names)]},
+                        {'Name': 'state', 'Values': ['available']}
+                    ]
+                )['Images']
+                for image in images:
+                    for name in names:
+                        if not fnmatch.fnmatchcase(image['Name'], '{}*'.format(name)):
+                            continue
+                        if newest[name] is None or image['CreationDate'] > newest[name]['CreationDate']:
+                            newest[name] = image
+                for name, image in newest.items():
+                    if image is not None:
+                        image = dict((k, image[k]) for k in ('ImageId', 'Name', 'CreationDate', 'OwnerId'))
+                        self.cache.store(self.region, 'amis', self._query(name, owner), image)
+                    self._index[(name, owner)] = image
+
+    def image(self, name, owner=None):
+        """
+        :return: (dict) ImageId, Name, CreationDate and OwnerId of the newest image matching name
+        """
+        self.resolve([(name, owner)])
+        image = self._index[(name, self._owner(owner))]
+        if image is None:
+            raise IndexError('No AMIs match for name "{}"'.format(name))
+        return image
+
+    def latest(self, name, owner=None):
+        """
+        :return: (string) ID of the newest image matching name
+        """
+        return self.image(name, owner)['ImageId']
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_ami_catalog(region):
+    """
+    :return: (AmiCatalog) the process-wide catalog for region
+    """
+    with _catalogs_lock:
+        if region not in _catalogs:
+            _catalogs[region] = AmiCatalog(region)
+        return _catalogs[region]
@@ -0,0 +1,24 @@
+from troposphere import AWSObject, AWSProperty
+from troposphere.validators import boolean, integer
+
+# States instances wait in while they are in a warm pool
+POOL_STATES = ('Stopped', 'Running', 'Hibernated')
+
+
+class InstanceReusePolicy(AWSProperty):
+    props = {
+        'ReuseOnScaleIn': (boolean, False),
+    }
+
+
+class WarmPool(AWSObject):
+    # troposphere does not know AWS::AutoScaling::WarmPool yet
+    resource_type = 'AWS::AutoScaling::WarmPool'
+
+    props = {
+        'AutoScalingGroupName': (str, True),
+        'InstanceReusePolicy': (InstanceReusePolicy, False),
+        'MaxGroupPreparedCapacity': (integer, False),
+        'MinSize': (integer, False),
+        'PoolState': (str, False),
+    }
@@ -0,0 +1,73 @@
+import os
+import threading
+
+# Size of each client's HTTPS connection pool, raise it when many threads share a client
+MAX_POOL_CONNECTIONS = int(os.environ.get('RAIN_MAX_POOL_CONNECTIONS', 32))
+
+_lock = threading.RLock()
+_clients = {}
+_resources = threading.local()
+_settings = {'max_pool_connections': MAX_POOL_CONNECTIONS}
+
+
+def get_session():
+    """
+    :return: (boto3.session.Session) the process-wide session, which is also the one boto3.client() uses
+    """
+    import boto3  # deferred, boto3 alone takes a large share of rain's startup time
+
+    with _lock:
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+        return boto3.DEFAULT_SESSION
+
+
+def configure(max_pool_connections=None):
+    """
+    Changes client settings. Clients created before this call are dropped from the registry.
+    """
+    with _lock:
+        if max_pool_connections is not None:
+            _settings['max_pool_connections'] = max_pool_connections
+        _clients.clear()
+        _resources.__dict__.clear()
+
+
+def _client_config():
+    from botocore.config import Config
+    return Config(max_pool_connections=_settings['max_pool_connections'])
+
+
+def get_client(service, region):
+    """
+    Returns the shared client for (service, region), creating it on first use.
+    botocore clients are thread safe, so one client (and its warm connection pool) serves every caller.
+    :param service: (string) AWS service name, e.g. 'ec2'
+    :param region: (string) AWS region
+    :return: botocore client
+    """
+    key = (service, region)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = get_session().client(service, region_name=region, config=_client_config())
+                _clients[key] = client
+    return client
+
+
+def get_resource(service, region):
+    """
+    Returns a boto3 resource for (service, region). Resources are not thread safe, so they are shared
+    per thread rather than per process.
+    :param service: (string) AWS service name, e.g. 'ec2'
+    :param region: (string) AWS region
+    :return: boto3 service resource
+    """
+    key = (service, region)
+    resources = _resources.__dict__.setdefault('resources', {})
+    if key not in resources:
+        with _lock:
+            resources[key] = get_session().resource(service, region_name=region, config=_client_config())
+    return resources[key]
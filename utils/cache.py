@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from utils.aws import get_client, get_session
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get('RAIN_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'ivy-rain'))
+
+# Seconds a cached discovery result stays valid, per resource type
+DEFAULT_TTLS = {
+    'identity': 7 * 24 * 3600,
+    'vpcs': 24 * 3600,
+    'subnets': 24 * 3600,
+    'route_tables': 6 * 3600,
+    'security_groups': 3600,
+    'amis': 3600,
+    'instance_types': 7 * 24 * 3600,
+}
+
+# Resource types describing the VPC layout, invalidated whenever a stack is applied
+NETWORK_RESOURCE_TYPES = ['vpcs', 'subnets', 'route_tables', 'security_groups']
+
+# default: read and write, refresh: skip reads but store fresh results, off: no reads or writes
+MODES = ['default', 'refresh', 'off']
+
+
+class DiscoveryCache(object):
+    """
+    On-disk cache of AWS discovery results, keyed by account, region, resource type and query.
+    Every entry is a small JSON file so the cache can be inspected and purged by hand.
+    """
+
+    def __init__(self, path=CACHE_DIR, mode='default', ttls=None):
+        if mode not in MODES:
+            raise ValueError('Cache mode must be one of {}: {}'.format(MODES, mode))
+        self.path = path
+        self.mode = mode
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self._account = None
+
+    @staticmethod
+    def query_key(query):
+        return hashlib.sha1(json.dumps(query, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, account, region, resource_type, query):
+        return os.path.join(self.path, account, region, resource_type, self.query_key(query) + '.json')
+
+    def account_id(self, region):
+        """
+        Returns the account the current credentials belong to. The STS lookup is itself cached, keyed by a
+        hash of the access key, so a warm cache needs no network round-trip at all.
+        :param region: (string) AWS region used for the STS call
+        :return: (string) AWS account ID
+        """
+        if self._account is None:
+            credentials = get_session().get_credentials()
+            access_key = credentials.access_key if credentials else 'anonymous'
+            identity_key = hashlib.sha1(access_key.encode('utf-8')).hexdigest()[:16]
+            self._account = self._fetch(
+                'identity', 'global', 'identity', identity_key,
+                lambda: get_client('sts', region).get_caller_identity()['Account']
+            )
+        return self._account
+
+    def _get(self, account, region, resource_type, query):
+        if self.mode != 'default':
+            return False, None
+        path = self._entry_path(account, region, resource_type, query)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False, None
+        if self.is_expired(entry):
+            return False, None
+        return True, entry['value']
+
+    def _set(self, account, region, resource_type, query, value):
+        if self.mode == 'off':
+            return
+        path = self._entry_path(account, region, resource_type, query)
+        entry = {
+            'account': account,
+            'region': region,
+            'resource_type': resource_type,
+            'query': query,
+            'created': time.time(),
+            'value': value
+        }
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # write then rename so concurrent renders never read a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f, default=str)
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write discovery cache entry %s: %s', path, e)
+
+    def _fetch(self, account, region, resource_type, query, fn):
+        hit, value = self._get(account, region, resource_type, query)
+        if hit:
+            return value
+        value = fn()
+        self._set(account, region, resource_type, query, value)
+        return value
+
+    def lookup(self, region, resource_type, query):
+        """
+        :return: (tuple) (hit, value), hit is False when the entry is missing, expired or reads are disabled
+        """
+        if self.mode != 'default':
+            return False, None
+        return self._get(self.account_id(region), region, resource_type, query)
+
+    def store(self, region, resource_type, query, value):
+        """
+        Stores a JSON serializable value for query
+        """
+        if self.mode == 'off':
+            return
+        self._set(self.account_id(region), region, resource_type, query, value)
+
+    def fetch(self, region, resource_type, query, fn):
+        """
+        Returns a cached value for query, calling fn() and storing its result on a miss
+        :param region: (string) AWS region the query runs in
+        :param resource_type: (string) one of DEFAULT_TTLS, selects the TTL
+        :param query: JSON serializable description of the query, used as the cache key
+        :param fn: callable returning a JSON serializable value
+        """
+        if self.mode == 'off':
+            return fn()
+        return self._fetch(self.account_id(region), region, resource_type, query, fn)
+
+    def entries(self):
+        """
+        :return: (list) of (path, entry) for every cache entry on disk, entry without its value
+        """
+        results = []
+        for root, _, files in os.walk(self.path):
+            for name in sorted(files):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    with open(path) as f:
+                        entry = json.load(f)
+                except (IOError, OSError, ValueError):
+                    entry = {}
+                entry.pop('value', None)
+                results.append((path, entry))
+        return results
+
+    def is_expired(self, entry):
+        return time.time() - entry.get('created', 0) > self.ttls.get(entry.get('resource_type'), 0)
+
+    def purge(self, resource_types=None, region=None, expired_only=False):
+        """
+        Deletes cache entries
+        :param resource_types: (list) only purge these resource types
+        :param region: (string) only purge entries for this region
+        :param expired_only: (bool) only purge entries past their TTL
+        :return: (int) number of entries removed
+        """
+        removed = 0
+        for path, entry in self.entries():
+            if resource_types and entry.get('resource_type') not in resource_types:
+                continue
+            if region and entry.get('region') != region:
+                continue
+            if expired_only and not self.is_expired(entry):
+                continue
+            os.remove(path)
+            removed += 1
+        return removed
+
+
+_cache = None
+
+
+def configure(mode='default', path=CACHE_DIR):
+    """
+    Sets up the process-wide discovery cache
+    """
+    global _cache
+    _cache = DiscoveryCache(path=path, mode=mode)
+    return _cache
+
+
+def get_cache():
+    """
+    :return: (DiscoveryCache) the process-wide discovery cache
+    """
+    if _cache is None:
+        configure()
+    return _cache
@@ -0,0 +1,198 @@
+import difflib
+import json
+
+# Properties that make CloudFormation replace (not update) a resource when they change, per resource type.
+# '*' means any property change replaces the resource. Types not listed are assumed to update in place.
+REPLACEMENT_PROPERTIES = {
+    'AWS::AutoScaling::LaunchConfiguration': ['*'],
+    'AWS::AutoScaling::AutoScalingGroup': ['AutoScalingGroupName', 'InstanceId'],
+    'AWS::EC2::EIP': ['Domain'],
+    'AWS::EC2::Instance': ['AvailabilityZone', 'ImageId', 'KeyName', 'NetworkInterfaces', 'PlacementGroupName',
+                           'PrivateIpAddress', 'SecurityGroups', 'SubnetId', 'Tenancy'],
+    'AWS::EC2::LaunchTemplate': ['LaunchTemplateName'],
+    'AWS::EC2::NatGateway': ['AllocationId', 'SubnetId'],
+    'AWS::EC2::NetworkInterface': ['PrivateIpAddress', 'SubnetId'],
+    'AWS::EC2::PlacementGroup': ['*'],
+    'AWS::EC2::Route': ['DestinationCidrBlock', 'RouteTableId'],
+    'AWS::EC2::RouteTable': ['VpcId'],
+    'AWS::EC2::SecurityGroup': ['GroupDescription', 'GroupName', 'VpcId'],
+    'AWS::EC2::Subnet': ['AvailabilityZone', 'CidrBlock', 'VpcId'],
+    'AWS::EC2::Volume': ['AvailabilityZone', 'Encrypted', 'KmsKeyId', 'SnapshotId'],
+    'AWS::EC2::VolumeAttachment': ['Device', 'InstanceId', 'VolumeId'],
+    'AWS::EC2::VPC': ['CidrBlock', 'InstanceTenancy'],
+    'AWS::ElastiCache::CacheCluster': ['CacheSubnetGroupName', 'ClusterName', 'Engine', 'Port'],
+    'AWS::ElastiCache::ReplicationGroup': ['CacheSubnetGroupName', 'Engine', 'ReplicationGroupId'],
+    'AWS::ElastiCache::SubnetGroup': ['CacheSubnetGroupName'],
+    'AWS::ElasticLoadBalancing::LoadBalancer': ['LoadBalancerName', 'Scheme'],
+    'AWS::ElasticLoadBalancingV2::LoadBalancer': ['Name', 'Scheme', 'Type'],
+    'AWS::ElasticLoadBalancingV2::TargetGroup': ['Name', 'Port', 'Protocol', 'TargetType', 'VpcId'],
+    'AWS::IAM::InstanceProfile': ['InstanceProfileName', 'Path'],
+    'AWS::IAM::Role': ['Path', 'RoleName'],
+    'AWS::RDS::DBInstance': ['AvailabilityZone', 'CharacterSetName', 'DBClusterIdentifier', 'DBInstanceIdentifier',
+                             'DBName', 'DBSubnetGroupName', 'Engine', 'KmsKeyId', 'MasterUsername',
+                             'StorageEncrypted'],
+    'AWS::RDS::DBSubnetGroup': ['DBSubnetGroupName'],
+    'AWS::Route53::RecordSet': ['HostedZoneId', 'HostedZoneName', 'Name', 'Type'],
+    'AWS::S3::Bucket': ['BucketName'],
+}
+
+INDENT = '    '
+
+
+def _dump(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def as_text(value):
+    """
+    Renders a Fn::Base64 / Fn::Sub / Fn::Join value (like UserData) as the text it stands for, with
+    references shown inline, so two versions can be compared line by line.
+    :return: (string) the text, or None if value is not a text-building intrinsic
+    """
+    if isinstance(value, str):
+        return value
+    if not isinstance(value, dict) or len(value) != 1:
+        return None
+    (function, argument), = value.items()
+    if function == 'Fn::Base64':
+        return as_text(argument)
+    if function == 'Fn::Sub':
+        return argument if isinstance(argument, str) else as_text(argument[0])
+    if function == 'Fn::Join' and isinstance(argument, list) and len(argument) == 2:
+        parts = [as_text(part) for part in argument[1]]
+        return argument[0].join(part if part is not None else '${{{}}}'.format(_dump(raw))
+                                for part, raw in zip(parts, argument[1]))
+    return None
+
+
+def _text_diff(path, old, new, depth):
+    yield '{}{}:'.format(INDENT * depth, path)
+    for line in difflib.unified_diff(old.splitlines(), new.splitlines(), 'deployed', 'rendered', lineterm=''):
+        yield '{}{}'.format(INDENT * (depth + 1), line)
+
+
+def diff_values(path, old, new, depth=1):
+    """
+    Structural diff of two JSON values: dicts are compared key by key, equal length lists item by item, other
+    lists as sets of items, and text (including UserData style intrinsics) line by line.
+    :return: generator of output lines
+    """
+    if old == new:
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        old_text, new_text = as_text(old), as_text(new)
+        if old_text is not None and new_text is not None and ('\n' in old_text or '\n' in new_text):
+            for line in _text_diff(path, old_text, new_text, depth):
+                yield line
+            return
+        for key in sorted(set(old) | set(new)):
+            child = '{}.{}'.format(path, key) if path else key
+            if key not in new:
+                yield '{}- {}: {}'.format(INDENT * depth, child, _dump(old[key]))
+            elif key not in old:
+                yield '{}+ {}: {}'.format(INDENT * depth, child, _dump(new[key]))
+            else:
+                for line in diff_values(child, old[key], new[key], depth):
+                    yield line
+    elif isinstance(old, list) and isinstance(new, list):
+        if len(old) == len(new):
+            for i, (o, n) in enumerate(zip(old, new)):
+                for line in diff_values('{}[{}]'.format(path, i), o, n, depth):
+                    yield line
+            return
+        # lists of rules, tags and the like: report the items that went away and the ones that are new
+        old_items, new_items = [_dump(o) for o in old], [_dump(n) for n in new]
+        yield '{}{}:'.format(INDENT * depth, path)
+        for item in old_items:
+            if item not in new_items:
+                yield '{}- {}'.format(INDENT * (depth + 1), item)
+        for item in new_items:
+            if item not in old_items:
+                yield '{}+ {}'.format(INDENT * (depth + 1), item)
+    elif isinstance(old, str) and isinstance(new, str) and ('\n' in old or '\n' in new):
+        for line in _text_diff(path, old, new, depth):
+            yield line
+    else:
+        yield '{}~ {}: {} -> {}'.format(INDENT * depth, path, _dump(old), _dump(new))
+
+
+def replaced_properties(resource_type, old_properties, new_properties):
+    """
+    :return: (list) of changed properties that are expected to replace a resource of resource_type
+    """
+    replacing = REPLACEMENT_PROPERTIES.get(resource_type, [])
+    changed = [key for key in sorted(set(old_properties) | set(new_properties))
+               if old_properties.get(key) != new_properties.get(key)]
+    if '*' in replacing:
+        return changed
+    return [key for key in changed if key in replacing]
+
+
+class TemplateDiff(object):
+    """
+    Compares a deployed template with a rendered one, matching resources by logical ID and type.
+
+    lines() yields output as it goes, so large templates start printing right away; the counts and the
+    resources predicted to be replaced are available once it is exhausted.
+    """
+
+    def __init__(self, old, new):
+        self.old = old or {}
+        self.new = new or {}
+        self.added = []
+        self.removed = []
+        self.modified = []
+        self.replaced = []
+
+    def _resource_lines(self):
+        old_resources = self.old.get('Resources', {})
+        new_resources = self.new.get('Resources', {})
+        for logical_id in sorted(set(old_resources) | set(new_resources)):
+            old, new = old_resources.get(logical_id), new_resources.get(logical_id)
+            if old == new:
+                continue
+            if old is None:
+                self.added.append(logical_id)
+                yield '+ {} ({})'.format(logical_id, new.get('Type'))
+            elif new is None:
+                self.removed.append(logical_id)
+                yield '- {} ({})'.format(logical_id, old.get('Type'))
+            elif old.get('Type') != new.get('Type'):
+                self.replaced.append(logical_id)
+                yield '! {} ({} -> {}) [replacement: type changed]'.format(logical_id, old.get('Type'),
+                                                                          new.get('Type'))
+            else:
+                self.modified.append(logical_id)
+                replacing = replaced_properties(new.get('Type'), old.get('Properties', {}),
+                                                new.get('Properties', {}))
+                if replacing:
+                    self.replaced.append(logical_id)
+                yield '~ {} ({}){}'.format(logical_id, new.get('Type'),
+                                           ' [replacement: {}]'.format(', '.join(replacing)) if replacing else '')
+                for line in diff_values('', old, new):
+                    yield line
+
+    def lines(self):
+        """
+        :return: generator of output lines, ending with a summary
+        """
+        for section in sorted(set(self.old) | set(self.new)):
+            if section == 'Resources':
+                for line in self._resource_lines():
+                    yield line
+            elif section not in self.new:
+                yield '- {}'.format(section)
+            elif section not in self.old:
+                yield '+ {}: {}'.format(section, _dump(self.new[section]))
+            elif self.old[section] != self.new[section]:
+                yield '~ {}'.format(section)
+                for line in diff_values('', self.old.get(section), self.new.get(section)):
+                    yield line
+        yield self.summary()
+
+    def summary(self):
+        if not (self.added or self.removed or self.modified or self.replaced):
+            return 'Resources: no changes'
+        return 'Resources: {} to add, {} to change, {} to remove, {} to replace{}'.format(
+            len(self.added), len(self.modified), len(self.removed), len(self.replaced),
+            ' ({})'.format(', '.join(self.replaced)) if self.replaced else '')
@@ -0,0 +1,193 @@
+import fnmatch
+import logging
+
+from config import constants
+from utils import trace
+from utils.cache import get_cache
+
+logger = logging.getLogger(__name__)
+
+# EC2 filter names we know how to evaluate in memory, per resource type
+_FILTER_FIELDS = {
+    'vpc-id': lambda r: [r.get('VpcId')],
+    'group-id': lambda r: [r.get('GroupId')],
+    'group-name': lambda r: [r.get('GroupName')],
+    'description': lambda r: [r.get('Description')],
+    'owner-id': lambda r: [r.get('OwnerId')],
+    'subnet-id': lambda r: [r.get('SubnetId')],
+    'route-table-id': lambda r: [r.get('RouteTableId')],
+    'availability-zone': lambda r: [r.get('AvailabilityZone')],
+    'tag-key': lambda r: [t['Key'] for t in r.get('Tags', [])],
+    'tag-value': lambda r: [t['Value'] for t in r.get('Tags', [])],
+}
+
+
+def _filter_values(resource, name):
+    if name.startswith('tag:'):
+        key = name[len('tag:'):]
+        return [t['Value'] for t in resource.get('Tags', []) if t['Key'] == key]
+    return _FILTER_FIELDS[name](resource)
+
+
+def can_match_filters(filters):
+    """
+    :param filters: (list) of EC2 API style {'Name': <string>, 'Values': [<string>]} filters
+    :return: (bool) True if every filter can be evaluated locally by match_filters
+    """
+    return all(f['Name'].startswith('tag:') or f['Name'] in _FILTER_FIELDS for f in filters)
+
+
+def match_filters(resource, filters):
+    """
+    Evaluates EC2 API style filters against a describe_* result the same way EC2 does: filters are ANDed,
+    values within a filter are ORed, and values may contain '*' and '?' wildcards.
+    :param resource: (dict) a single resource from a describe_* response
+    :param filters: (list) of {'Name': <string>, 'Values': [<string>]} filters
+    :return: (bool) True if the resource matches all filters
+    """
+    for f in filters:
+        actual = [v for v in _filter_values(resource, f['Name']) if v is not None]
+        if not any(fnmatch.fnmatchcase(a, str(pattern)) for a in actual for pattern in f['Values']):
+            return False
+    return True
+
+
+class DiscoveryContext(object):
+    """
+    Per-render view of the EC2 networking objects a template looks up.
+
+    Each resource type (subnets, route tables, security groups) is fetched once for every VPC the render
+    knows about, using a single batched describe call, and every later lookup is answered from memory.
+    Results are also kept in the on-disk discovery cache so later renders can skip the round-trips.
+    """
+
+    # resource type -> (describe operation, response key)
+    RESOURCE_TYPES = {
+        'subnets': ('describe_subnets', 'Subnets'),
+        'route_tables': ('describe_route_tables', 'RouteTables'),
+        'security_groups': ('describe_security_groups', 'SecurityGroups'),
+    }
+
+    def __init__(self, ec2_conn, env, cache=None):
+        self.ec2_conn = ec2_conn
+        self.env = env
+        self.region = constants.ENVIRONMENTS[env]['region']
+        self.cache = cache or get_cache()
+        self._vpc = None
+        self._resources = {}
+
+    def _describe(self, operation, key, **kwargs):
+        """
+        Calls a describe operation, following pagination if the operation supports it
+        :return: (list) of all resources returned under key
+        """
+        if self.ec2_conn.can_paginate(operation):
+            results = []
+            for page in self.ec2_conn.get_paginator(operation).paginate(**kwargs):
+                results.extend(page[key])
+            return results
+        return getattr(self.ec2_conn, operation)(**kwargs)[key]
+
+    def vpc_ids(self):
+        """
+        All VPC IDs this render may ask about: the tagged VPC of the environment and the configured override
+        :return: (list) of VPC IDs
+        """
+        vpc_ids = {self.vpc()['VpcId']}
+        vpc_override = constants.ENVIRONMENTS[self.env]['vpc'].get('vpc_id')
+        if vpc_override:
+            vpc_ids.add(vpc_override)
+        return sorted(vpc_ids)
+
+    def vpc(self):
+        """
+        Returns the VPC tagged for this environment
+        :return: (dict) representing a VPC
+        """
+        if self._vpc is None:
+            filters = [
+                {'Name': 'tag:{}:service'.format(constants.TAG), 'Values': ['VPC']},
+                {'Name': 'tag:{}:environment'.format(constants.TAG), 'Values': [self.env]}
+            ]
+            with trace.phase('discovery'):
+                result = self.cache.fetch(self.region, 'vpcs', filters,
+                                          lambda: self._describe('describe_vpcs', 'Vpcs', Filters=filters))
+            if len(result) == 0:
+                raise Exception('VPC {} not found in region {}'.format(self.env, self.region))
+            elif len(result) > 1:
+                raise Exception('More than 1 VPC {} found in region {}'.format(self.env, self.region))
+            self._vpc = result[0]
+        return self._vpc
+
+    def prefetch(self, *resource_types):
+        """
+        Fetches the given resource types (all of them by default) for every known VPC, one call per type
+        """
+        with trace.phase('discovery'):
+            self._prefetch(resource_types or sorted(self.RESOURCE_TYPES))
+
+    def _prefetch(self, resource_types):
+        vpc_ids = self.vpc_ids()
+        for resource_type in resource_types:
+            loaded = self._resources.setdefault(resource_type, {})
+            missing = []
+            for vpc_id in vpc_ids:
+                if vpc_id in loaded:
+                    continue
+                hit, value = self.cache.lookup(self.region, resource_type, {'vpc-id': vpc_id})
+                if hit:
+                    loaded[vpc_id] = value
+                else:
+                    missing.append(vpc_id)
+            if missing:
+                self._load(resource_type, missing)
+
+    def _load(self, resource_type, vpc_ids):
+        """
+        Fetches resource_type for all vpc_ids with a single describe call and stores the results per VPC
+        """
+        operation, key = self.RESOURCE_TYPES[resource_type]
+        loaded = self._resources.setdefault(resource_type, {})
+        by_vpc = dict((vpc_id, []) for vpc_id in vpc_ids)
+        for resource in self._describe(operation, key, Filters=[{'Name': 'vpc-id', 'Values': vpc_ids}]):
+            by_vpc.setdefault(resource['VpcId'], []).append(resource)
+        for vpc_id, resources in by_vpc.items():
+            loaded[vpc_id] = resources
+            self.cache.store(self.region, resource_type, {'vpc-id': vpc_id}, resources)
+
+    def _get(self, resource_type, vpc_id):
+        if vpc_id not in self._resources.get(resource_type, {}):
+            self.prefetch(resource_type)
+        if vpc_id not in self._resources[resource_type]:
+            # a VPC we did not know about up front, fetch it on its own
+            self._load(resource_type, [vpc_id])
+        return self._resources[resource_type][vpc_id]
+
+    def subnets(self, vpc_id):
+        """
+        :return: (list) of all subnets in vpc_id
+        """
+        return list(self._get('subnets', vpc_id))
+
+    def route_tables(self, vpc_id):
+        """
+        :return: (list) of all route tables in vpc_id
+        """
+        return list(self._get('route_tables', vpc_id))
+
+    def security_groups(self, vpc_id, filters=None):
+        """
+        Returns security groups in vpc_id matching EC2 API style filters.
+        Filters we cannot evaluate locally are passed through to the API.
+        :param filters: (list) of {'Name': <string>, 'Values': [<string>]} filters
+        :return: (list) of matching security groups
+        """
+        filters = filters or []
+        if not can_match_filters(filters):
+            logger.debug('Falling back to describe_security_groups for filters %s', filters)
+            filters = [{'Name': 'vpc-id', 'Values': [vpc_id]}] + filters
+            with trace.phase('discovery'):
+                return self.cache.fetch(self.region, 'security_groups', filters,
+                                        lambda: self._describe('describe_security_groups', 'SecurityGroups',
+                                                               Filters=filters))
+        return [sg for sg in self._get('security_groups', vpc_id) if match_filters(sg, filters)]
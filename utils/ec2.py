@@ -1,105 +1,112 @@
-import boto3
 from troposphere import ec2
+from troposphere.validators import integer
 
+from utils.amis import get_ami_catalog
+from utils.aws import get_client, get_resource
+from utils.instance_types import get_instance_type_catalog
 
-INSTANCETYPE_TO_BLOCKDEVICEMAPPING = {
-    'm3.medium': 1,
-    'm3.large': 1,
-    'm3.xlarge': 2,
-    'm3.2xlarge': 2,
-    'c3.large': 2,
-    'c3.xlarge': 2,
-    'c3.2xlarge': 2,
-    'c3.4xlarge': 2,
-    'c3.8xlarge': 2,
-    'r3.large': 1,
-    'r3.xlarge': 1,
-    'r3.2xlarge': 1,
-    'r3.4xlarge': 1,
-    'r3.8xlarge': 2,
-    'g2.2xlarge': 1,
-    'g2.8xlarge': 2,
-    'i2.xlarge': 1,
-    'i2.2xlarge': 2,
-    'i2.4xlarge': 4,
-    'i2.8xlarge': 8,
-    'd2.xlarge': 3,
-    'd2.2xlarge': 6,
-    'd2.4xlarge': 12,
-    'd2.8xlarge': 24
+
+# Allowed sizes (GiB), IOPS, throughput (MiB/s) and IOPS per GiB of each EBS volume type, None where the type
+# does not take the setting. Types that cannot be boot volumes have boot False.
+VOLUME_TYPES = {
+    'gp2': {'size': (1, 16384), 'iops': None, 'throughput': None, 'iops_per_gib': None, 'boot': True},
+    'gp3': {'size': (1, 16384), 'iops': (3000, 16000), 'throughput': (125, 1000), 'iops_per_gib': 500,
+            'boot': True},
+    'io1': {'size': (4, 16384), 'iops': (100, 64000), 'throughput': None, 'iops_per_gib': 50, 'boot': True},
+    'io2': {'size': (4, 16384), 'iops': (100, 64000), 'throughput': None, 'iops_per_gib': 500, 'boot': True},
+    'st1': {'size': (125, 16384), 'iops': None, 'throughput': None, 'iops_per_gib': None, 'boot': False},
+    'sc1': {'size': (125, 16384), 'iops': None, 'throughput': None, 'iops_per_gib': None, 'boot': False},
+    'standard': {'size': (1, 1024), 'iops': None, 'throughput': None, 'iops_per_gib': None, 'boot': True},
 }
 
-EBS_OPTIMIZED_INSTANCES = [
-    "t3.nano",
-    "t3.micro",
-    "t3.small",
-    "t3.medium",
-    "t3.large",
-    "t3.xlarge",
-    "t3.2xlarge",
-    "c1.xlarge",
-    "c3.xlarge",
-    "c3.2xlarge",
-    "c3.4xlarge",
-    "c4.large",
-    "c4.xlarge",
-    "c4.2xlarge",
-    "c4.4xlarge",
-    "c4.8xlarge",
-    "c5.4xlarge",
-    "c5.24xlarge",
-    "d2.xlarge",
-    "d2.2xlarge",
-    "d2.4xlarge",
-    "d2.8xlarge",
-    "g2.2xlarge",
-    "i2.xlarge",
-    "i2.2xlarge",
-    "i2.4xlarge",
-    "i3.large",
-    "i3.xlarge",
-    "i3.2xlarge",
-    "i3.4xlarge",
-    "i3.8xlarge",
-    "i3.16xlarge",
-    "m1.large",
-    "m1.xlarge",
-    "m2.2xlarge",
-    "m2.4xlarge",
-    "m3.xlarge",
-    "m3.2xlarge",
-    "m4.large",
-    "m4.xlarge",
-    "m4.2xlarge",
-    "m4.4xlarge",
-    "m4.10xlarge",
-    "r3.xlarge",
-    "r3.2xlarge",
-    "r3.4xlarge",
-    "r4.large",
-    "r4.xlarge",
-    "r4.2xlarge",
-    "r4.4xlarge",
-    "r4.8xlarge",
-    "r4.16xlarge",
-    "r5.2xlarge",
-    "r5.4xlarge",
-    "m5.large",
-    "m5.xlarge",
-    "m5.2xlarge",
-    "m5.4xlarge",
-    "m5.8xlarge",
-    "m5.12xlarge",
-    "m5.16xlarge",
-    "m5.24xlarge",
-]
-
-
-def get_block_device_mapping(instanceType):
+
+# Strategies of placement groups, and the most partitions a partition placement group can have
+PLACEMENT_STRATEGIES = ('cluster', 'spread', 'partition')
+MAX_PARTITIONS = 7
+
+
+class Volume(ec2.Volume):
+    # troposphere does not know gp3's Throughput property of AWS::EC2::Volume yet
+    props = dict(ec2.Volume.props, Throughput=(integer, False))
+
+
+class PlacementGroup(ec2.PlacementGroup):
+    # troposphere does not know the PartitionCount property of AWS::EC2::PlacementGroup yet
+    props = dict(ec2.PlacementGroup.props, PartitionCount=(integer, False))
+
+
+def volume_settings(config, prefix, default_size, default_type='gp2', boot=False):
+    """
+    Reads the <prefix>_size, <prefix>_type, <prefix>_iops and <prefix>_throughput settings of a volume and checks
+    them against what the volume type allows
+    :param config: (dict) configuration of the cluster or service the volume belongs to
+    :param prefix: (string) e.g. 'rootfs' or 'data_volume'
+    :param boot: (bool) the volume is a root volume
+    :return: (dict) VolumeSize and VolumeType, plus Iops and Throughput when the type takes them
+    """
+    size = config.get('{}_size'.format(prefix), default_size)
+    volume_type = config.get('{}_type'.format(prefix), default_type)
+    iops = config.get('{}_iops'.format(prefix))
+    throughput = config.get('{}_throughput'.format(prefix))
+    name = '{} volume'.format(prefix)
+
+    if volume_type not in VOLUME_TYPES:
+        raise RuntimeError('{}: unsupported volume type {}, expected one of {}'.format(
+            name, volume_type, ', '.join(sorted(VOLUME_TYPES))))
+    limits = VOLUME_TYPES[volume_type]
+    if boot and not limits['boot']:
+        raise RuntimeError('{}: {} volumes cannot be boot volumes'.format(name, volume_type))
+    if not limits['size'][0] <= size <= limits['size'][1]:
+        raise RuntimeError('{}: {} volumes must be {} to {} GiB, not {}'.format(
+            name, volume_type, limits['size'][0], limits['size'][1], size))
+
+    settings = {'VolumeSize': size, 'VolumeType': volume_type}
+    for key, value in (('iops', iops), ('throughput', throughput)):
+        if value is None:
+            continue
+        if limits[key] is None:
+            raise RuntimeError('{}: {} volumes do not take {}'.format(name, volume_type, key))
+        if not limits[key][0] <= value <= limits[key][1]:
+            raise RuntimeError('{}: {} {} must be {} to {}, not {}'.format(
+                name, volume_type, key, limits[key][0], limits[key][1], value))
+        settings[key.capitalize()] = value
+    if limits['iops'] is not None and iops is None and volume_type.startswith('io'):
+        raise RuntimeError('{}: {} volumes need {}_iops'.format(name, volume_type, prefix))
+    if iops is not None and iops > limits['iops_per_gib'] * size:
+        raise RuntimeError('{}: {} IOPS on {} GiB is more than the {} IOPS per GiB {} volumes allow'.format(
+            name, iops, size, limits['iops_per_gib'], volume_type))
+    if throughput is not None and throughput > (iops or limits['iops'][0]) / 4:
+        raise RuntimeError('{}: {} MiB/s of throughput needs at least {} IOPS'.format(name, throughput, throughput * 4))
+    return settings
+
+
+def ebs_block_device(config, prefix, default_size, default_type='gp2', boot=False):
+    """
+    :return: (ec2.EBSBlockDevice) deleted on termination, configured by volume_settings()
+    """
+    return ec2.EBSBlockDevice(DeleteOnTermination=True,
+                              **volume_settings(config, prefix, default_size, default_type, boot))
+
+
+def ebs_volume(title, config, prefix, default_size, default_type='gp2', **kwargs):
+    """
+    :param kwargs: other properties of the volume (AvailabilityZone, Tags, ...)
+    :return: (Volume) configured by volume_settings()
+    """
+    settings = volume_settings(config, prefix, default_size, default_type)
+    return Volume(title, Size=settings.pop('VolumeSize'), **dict(kwargs, **settings))
+
+
+def get_block_device_mapping(instanceType, region, launch_template=False):
+    """
+    :param launch_template: (bool) return mappings for a launch template instead of a launch configuration
+    :return: (list) of mappings of the instance type's ephemeral instance store volumes
+    """
+    mapping_class = ec2.LaunchTemplateBlockDeviceMapping if launch_template else ec2.BlockDeviceMapping
     mappings = []
-    for i in range(INSTANCETYPE_TO_BLOCKDEVICEMAPPING.get(instanceType, 0)):
+    for i in range(get_instance_type_catalog(region).instance_store_volumes(instanceType)):
         mappings.append(
-            ec2.BlockDeviceMapping(
+            mapping_class(
                 # this needs to wrap over to /dev/sdaa if we ever use d2.8xl instances
                 DeviceName='/dev/sd{}'.format(chr(ord('m') + i)),
                 VirtualName='ephemeral{}'.format(i)
@@ -109,16 +116,7 @@ def get_block_device_mapping(instanceType):
 
 
 def get_latest_ami_id(region, amiName, owner=None):
-    ec2 = boto3.resource('ec2', region_name=region)
-    images = ec2.images.filter(
-        Filters=[{'Name': 'name', 'Values': ["{}*".format(amiName)]}],
-        Owners=[owner if owner else 'self']
-    )
-    try:
-        return sorted(images, key=lambda x: x.creation_date, reverse=True)[0].id
-    except IndexError:
-        raise IndexError('No AMIs match for name "{}"'.format(amiName))
-
+    return get_ami_catalog(region).latest(amiName, owner)
 
 
 def get_snapshots_by_tags(tags, latest=True, region='us-west-2'):
@@ -129,12 +127,61 @@ def get_snapshots_by_tags(tags, latest=True, region='us-west-2'):
     :param region: (string) AWS region
     :return: (list) boto3 snapshot objects ordered by start_time
     """
-    ec2 = boto3.resource('ec2', region_name=region)
+    ec2 = get_resource('ec2', region)
     snapshots = ec2.snapshots.filter(
-        Filters=[{'Name': 'tag:{}'.format(k), 'Values': [v]} for k, v in tags.items()]
+        Filters=[{'Name': 'tag:{}'.format(k), 'Values': [v]} for k, v in tags.items()],
+        OwnerIds=['self']
     )
     snapshots = sorted(snapshots, key=lambda x: x.start_time, reverse=True)
     if snapshots:
         return snapshots[0] if latest else snapshots
     else:
         return None
+
+
+def get_latest_snapshots(tags, group_by, region):
+    """
+    :param tags: (dict) {tag_name: tag_value} all snapshots have
+    :param group_by: (string) tag to group snapshots by, e.g. the role of the volume they were taken of
+    :return: (dict) group_by tag value -> ID of the newest completed snapshot with that value
+    """
+    latest = {}
+    for snapshot in get_snapshots_by_tags(tags, latest=False, region=region) or []:
+        if snapshot.state != 'completed':
+            continue
+        value = dict((tag['Key'], tag['Value']) for tag in snapshot.tags or []).get(group_by)
+        if value is not None:
+            latest.setdefault(value, snapshot.id)
+    return latest
+
+
+def get_stack_volumes(stack_name, region):
+    """
+    Volumes that rain split off into nested stacks are tagged with the nested stack, so the volumes are looked up
+    by the IDs of the stack and of every nested stack it has
+    :return: (dict) logical ID -> snapshot the volume was created from ('' for none) of the volumes of a stack
+    """
+    import botocore.exceptions
+
+    cfn = get_client('cloudformation', region)
+    try:
+        stack_ids = [cfn.describe_stacks(StackName=stack_name)['Stacks'][0]['StackId']]
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ValidationError' and 'does not exist' in e.response['Error']['Message']:
+            return {}
+        raise
+    for page in cfn.get_paginator('list_stack_resources').paginate(StackName=stack_name):
+        stack_ids.extend(resource['PhysicalResourceId'] for resource in page['StackResourceSummaries']
+                         if resource['ResourceType'] == 'AWS::CloudFormation::Stack' and
+                         resource.get('PhysicalResourceId'))
+
+    paginator = get_client('ec2', region).get_paginator('describe_volumes')
+    volumes = {}
+    for page in paginator.paginate(Filters=[
+        {'Name': 'tag:aws:cloudformation:stack-id', 'Values': stack_ids},
+        {'Name': 'status', 'Values': ['creating', 'available', 'in-use']}
+    ]):
+        for volume in page['Volumes']:
+            tags = dict((tag['Key'], tag['Value']) for tag in volume.get('Tags', []))
+            volumes[tags['aws:cloudformation:logical-id']] = volume.get('SnapshotId', '')
+    return volumes
@@ -0,0 +1,223 @@
+import logging
+import threading
+import time
+
+import botocore.exceptions
+
+from utils.aws import get_client
+
+logger = logging.getLogger(__name__)
+
+# Final stack statuses, the ones a stack operation ends in
+SUCCESS_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'DELETE_COMPLETE', 'IMPORT_COMPLETE']
+FAILURE_STATUSES = ['CREATE_FAILED', 'DELETE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED',
+                    'UPDATE_ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_FAILED', 'IMPORT_ROLLBACK_COMPLETE',
+                    'IMPORT_ROLLBACK_FAILED']
+
+# Resources that take many minutes to create or update; while only these are in progress, poll less often
+SLOW_RESOURCE_TYPES = [
+    'AWS::CloudFront::Distribution',
+    'AWS::EC2::NatGateway',
+    'AWS::EC2::VPNConnection',
+    'AWS::EC2::VPNGateway',
+    'AWS::ElastiCache::CacheCluster',
+    'AWS::ElastiCache::ReplicationGroup',
+    'AWS::Elasticsearch::Domain',
+    'AWS::RDS::DBCluster',
+    'AWS::RDS::DBInstance',
+]
+
+MIN_INTERVAL = 2
+SLOW_INTERVAL = 15
+MAX_INTERVAL = 30
+
+
+def format_event(event):
+    """
+    :param event: (dict) a stack event as returned by describe_stack_events
+    :return: (string) one line describing the event
+    """
+    return '{} {:<36} {:<40} {}{}'.format(
+        event['Timestamp'].strftime('%H:%M:%S'), event['ResourceStatus'], event['ResourceType'],
+        event['LogicalResourceId'],
+        ' ({})'.format(event['ResourceStatusReason']) if event.get('ResourceStatusReason') else '')
+
+
+class StackTail(object):
+    """
+    Progress of one stack operation followed by a StackEventTailer
+    """
+
+    def __init__(self, stack_id, emit):
+        self.stack_id = stack_id
+        self.emit = emit
+        self.status = None
+        self.failures = []
+        self.started = False
+        self.interval = MIN_INTERVAL
+        self.next_poll = 0
+        self._seen = set()
+        self._high_water = None
+        self._in_progress = {}
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def succeeded(self):
+        return self.status in SUCCESS_STATUSES
+
+    def _new_events(self, conn):
+        """
+        Fetches events newer than the high-water mark, following NextToken only as far as needed
+        :return: (list) of new events, oldest first
+        """
+        events = []
+        kwargs = {'StackName': self.stack_id}
+        while True:
+            page = conn.describe_stack_events(**kwargs)
+            for event in page['StackEvents']:
+                if event['EventId'] in self._seen:
+                    return list(reversed(events))
+                if self._high_water is not None and event['Timestamp'] < self._high_water:
+                    return list(reversed(events))
+                events.append(event)
+                if not self.started and self._is_root(event) and \
+                        event.get('ResourceStatusReason') == 'User Initiated':
+                    # the stack level event that started this operation, anything older belongs to earlier ones
+                    return list(reversed(events))
+            if not page.get('NextToken'):
+                return list(reversed(events))
+            kwargs['NextToken'] = page['NextToken']
+
+    def _is_root(self, event):
+        # nested stacks show up as AWS::CloudFormation::Stack resources too, but with their own physical ID
+        return event['ResourceType'] == 'AWS::CloudFormation::Stack' and \
+            event.get('PhysicalResourceId') == self.stack_id
+
+    def poll(self, conn):
+        """
+        Emits every event that arrived since the last poll, exactly once, and schedules the next poll
+        """
+        try:
+            events = self._new_events(conn)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'Throttling':
+                raise
+            logger.debug('Throttled polling %s', self.stack_id)
+            events = None
+
+        for event in events or []:
+            self.started = True
+            self._seen.add(event['EventId'])
+            self._high_water = max(self._high_water or event['Timestamp'], event['Timestamp'])
+            self.emit(format_event(event))
+            status = event['ResourceStatus']
+            if self._is_root(event):
+                if status in SUCCESS_STATUSES or status in FAILURE_STATUSES:
+                    self.status = status
+                continue
+            if status.endswith('_IN_PROGRESS'):
+                self._in_progress[event['LogicalResourceId']] = event['ResourceType']
+            else:
+                self._in_progress.pop(event['LogicalResourceId'], None)
+            if status.endswith('_FAILED'):
+                self.failures.append(event)
+
+        if events is None:
+            self.interval = min(self.interval * 2, MAX_INTERVAL)
+        elif events:
+            self.interval = MIN_INTERVAL
+        else:
+            self.interval = min(self.interval * 1.5, MAX_INTERVAL)
+        if self._in_progress and all(t in SLOW_RESOURCE_TYPES for t in self._in_progress.values()):
+            self.interval = max(self.interval, SLOW_INTERVAL)
+        self.next_poll = time.time() + self.interval
+
+        if self.status:
+            self.finish(self.status)
+
+    def finish(self, status):
+        self.status = status
+        self._done.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+
+class StackEventTailer(object):
+    """
+    Follows the events of any number of stack operations from one polling thread.
+
+    Each stack is polled on its own schedule: right after new events arrive it is polled every MIN_INTERVAL
+    seconds, backing off up to MAX_INTERVAL while nothing happens, and to at least SLOW_INTERVAL while the only
+    resources in progress are slow ones like RDS instances or NAT gateways. Only events newer than the
+    high-water mark are fetched, so every event is emitted once, in order, without re-reading the history.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._tails = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, stack_id, emit=print):
+        """
+        Starts following stack_id. Call right after the create/update/delete call returned.
+        :param emit: callable receiving one formatted line per event
+        :return: (StackTail)
+        """
+        tail = StackTail(stack_id, emit)
+        with self._lock:
+            self._tails.append(tail)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='stack-events')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+        return tail
+
+    def wait(self, stack_id, emit=print):
+        """
+        Follows stack_id until its operation finishes
+        :return: (StackTail) with the final status
+        """
+        tail = self.add(stack_id, emit)
+        tail.wait()
+        return tail
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._tails = [t for t in self._tails if not t.done]
+                if not self._tails:
+                    self._thread = None
+                    return
+                due = [t for t in self._tails if t.next_poll <= time.time()]
+                next_poll = min(t.next_poll for t in self._tails)
+            for tail in due:
+                try:
+                    tail.poll(self.conn)
+                except Exception as e:
+                    tail.emit('*** Could not read events: {} ***'.format(e))
+                    tail.finish('UNKNOWN')
+            if not due:
+                self._wakeup.wait(max(0, next_poll - time.time()))
+                self._wakeup.clear()
+
+
+_tailers = {}
+_tailers_lock = threading.Lock()
+
+
+def get_tailer(region):
+    """
+    :return: (StackEventTailer) the process-wide tailer for region, so concurrent applies share one poll loop
+    """
+    with _tailers_lock:
+        if region not in _tailers:
+            _tailers[region] = StackEventTailer(get_client('cloudformation', region))
+        return _tailers[region]
@@ -0,0 +1,122 @@
+import threading
+
+from utils.aws import get_client
+from utils.cache import get_cache
+
+# describe_instance_types takes at most this many types per call
+MAX_TYPES_PER_CALL = 100
+
+
+def _capabilities(instance_type):
+    """
+    :param instance_type: (dict) an InstanceTypes item of describe_instance_types
+    :return: (dict) the parts of it templates use, small enough to cache
+    """
+    storage = instance_type.get('InstanceStorageInfo')
+    return {
+        'InstanceType': instance_type['InstanceType'],
+        'VCpus': instance_type['VCpuInfo']['DefaultVCpus'],
+        'MemoryMiB': instance_type['MemoryInfo']['SizeInMiB'],
+        'NetworkPerformance': instance_type['NetworkInfo']['NetworkPerformance'],
+        'EbsOptimizedSupport': instance_type['EbsInfo']['EbsOptimizedSupport'],
+        'InstanceStorage': {
+            'TotalSizeGB': storage['TotalSizeInGB'],
+            'Disks': [dict((k, disk[k]) for k in ('Count', 'SizeInGB', 'Type')) for disk in storage['Disks']],
+            'NvmeSupport': storage.get('NvmeSupport', 'unsupported'),
+        } if storage else None,
+    }
+
+
+class InstanceTypeCatalog(object):
+    """
+    Capabilities of EC2 instance types in a region: vCPUs, memory, network performance, EBS optimization and
+    instance store layout, as reported by describe_instance_types.
+
+    Types are looked up in batches and every type is stored in the discovery cache, so renders after the first
+    make no calls at all; --refresh looks them up again.
+    """
+
+    def __init__(self, region, cache=None):
+        self.region = region
+        self.cache = cache or get_cache()
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, instance_types):
+        """
+        Looks up every instance type that is not already indexed
+        :param instance_types: (list) of instance type names
+        """
+        with self._lock:
+            missing = []
+            for name in sorted(set(instance_types)):
+                if name in self._index:
+                    continue
+                hit, capabilities = self.cache.lookup(self.region, 'instance_types', {'instance_type': name})
+                if hit:
+                    self._index[name] = capabilities
+                else:
+                    missing.append(name)
+
+            ec2 = get_client('ec2', self.region) if missing else None
+            for i in range(0, len(missing), MAX_TYPES_PER_CALL):
+                kwargs = {'InstanceTypes': missing[i:i + MAX_TYPES_PER_CALL]}
+                while True:
+                    response = ec2.describe_instance_types(**kwargs)
+                    for instance_type in response['InstanceTypes']:
+                        capabilities = _capabilities(instance_type)
+                        self.cache.store(self.region, 'instance_types',
+                                         {'instance_type': capabilities['InstanceType']}, capabilities)
+                        self._index[capabilities['InstanceType']] = capabilities
+                    if not response.get('NextToken'):
+                        break
+                    kwargs['NextToken'] = response['NextToken']
+
+    def capabilities(self, instance_type):
+        """
+        :return: (dict) InstanceType, VCpus, MemoryMiB, NetworkPerformance, EbsOptimizedSupport ('default',
+                 'supported' or 'unsupported') and InstanceStorage (TotalSizeGB, Disks and NvmeSupport, None
+                 for EBS-only types)
+        """
+        self.resolve([instance_type])
+        if instance_type not in self._index:
+            raise KeyError('Unknown instance type "{}" in {}'.format(instance_type, self.region))
+        return self._index[instance_type]
+
+    def ebs_optimized(self, instance_type):
+        """
+        :return: (bool) True if instances of this type can be EBS-optimized (always so for 'default' types)
+        """
+        return self.capabilities(instance_type)['EbsOptimizedSupport'] in ('default', 'supported')
+
+    def instance_store_volumes(self, instance_type):
+        """
+        Instance store volumes that need a block device mapping. NVMe instance store volumes are attached
+        automatically, so only the older SSD and HDD ones are counted.
+        :return: (int) number of volumes
+        """
+        storage = self.capabilities(instance_type)['InstanceStorage']
+        if not storage or storage['NvmeSupport'] == 'required':
+            return 0
+        return sum(disk['Count'] for disk in storage['Disks'])
+
+    def nvme_instance_store(self, instance_type):
+        """
+        :return: (bool) True if instances of this type come with NVMe instance store volumes
+        """
+        storage = self.capabilities(instance_type)['InstanceStorage']
+        return bool(storage) and storage['NvmeSupport'] != 'unsupported'
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_instance_type_catalog(region):
+    """
+    :return: (InstanceTypeCatalog) the process-wide catalog for region
+    """
+    with _catalogs_lock:
+        if region not in _catalogs:
+            _catalogs[region] = InstanceTypeCatalog(region)
+        return _catalogs[region]
@@ -0,0 +1,474 @@
+import json
+import re
+
+# CloudFormation's hard limits per stack
+MAX_RESOURCES = 500
+MAX_TEMPLATE_BYTES = 1024 * 1024
+MAX_PARAMETERS = 200
+MAX_OUTPUTS = 200
+# Templates are split once they pass this fraction of a limit, and child stacks are filled up to it
+HEADROOM = 0.8
+# Resources referenced by this many other resources (security groups, instance profiles, ENIs with routes...)
+# stay in the parent stack and are passed to child stacks as parameters
+HUB_REFERRERS = 2
+
+STACK_TYPE = 'AWS::CloudFormation::Stack'
+CHILD_PREFIX = 'RainNested'
+# Metadata key of child templates keeping the DependsOn of resources whose dependencies on the parent moved to
+# the stack resource, so merge_template() can put them back
+DEPENDS_ON_METADATA = 'RainDependsOn'
+# Pseudo parameters that differ between a nested stack and its parent; children get the parent's values
+PARENT_PSEUDO_PARAMETERS = {
+    'AWS::StackName': 'RainParentStackName',
+    'AWS::StackId': 'RainParentStackId',
+}
+
+_SUB_VARIABLE = re.compile(r'\$\{([^!}][^}]*)\}')
+
+
+class SplitError(Exception):
+    pass
+
+
+def dumps(template):
+    """
+    Serializes a template the way rain sends it to CloudFormation
+    """
+    return json.dumps(template, indent=4, sort_keys=True, separators=(',', ': '))
+
+
+def needs_split(rendered, body=None):
+    """
+    :param rendered: (dict) rendered template
+    :param body: (string) the serialized template, if already at hand
+    :return: (bool) True if the template is close enough to CloudFormation's limits to be split
+    """
+    body = body if body is not None else dumps(rendered)
+    return len(rendered.get('Resources', {})) > MAX_RESOURCES * HEADROOM or \
+        len(body.encode('utf-8')) > MAX_TEMPLATE_BYTES * HEADROOM
+
+
+def _sub_references(text, local_names=()):
+    for match in _SUB_VARIABLE.finditer(text):
+        name, _, attribute = match.group(1).partition('.')
+        if name not in local_names:
+            yield name, attribute or None
+
+
+def references(value):
+    """
+    Finds everything a piece of a rendered template refers to
+    :return: (set) of (kind, name, attribute) tuples; kind is 'ref' (Ref, Fn::GetAtt, Fn::Sub variables),
+             'condition' or 'mapping'
+    """
+    found = set()
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, list):
+            stack.extend(value)
+            continue
+        if not isinstance(value, dict):
+            continue
+        for key, argument in value.items():
+            if key == 'Ref' and isinstance(argument, str):
+                found.add(('ref', argument, None))
+            elif key == 'Fn::GetAtt':
+                name, attribute = argument.split('.', 1) if isinstance(argument, str) else argument[:2]
+                if isinstance(name, str) and isinstance(attribute, str):
+                    found.add(('ref', name, attribute))
+                else:
+                    stack.append(argument)
+            elif key == 'Fn::Sub':
+                text, variables = (argument, {}) if isinstance(argument, str) else (argument[0], argument[1])
+                found.update(('ref', n, a) for n, a in _sub_references(text, variables))
+                stack.append(variables)
+            elif key == 'Fn::FindInMap' and isinstance(argument, list) and isinstance(argument[0], str):
+                found.add(('mapping', argument[0], None))
+                stack.append(argument[1:])
+            elif key == 'Fn::If' and isinstance(argument, list) and isinstance(argument[0], str):
+                found.add(('condition', argument[0], None))
+                stack.append(argument[1:])
+            elif key == 'Condition' and isinstance(argument, str):
+                found.add(('condition', argument, None))
+            else:
+                stack.append(argument)
+    return found
+
+
+def resource_dependencies(resource):
+    """
+    :return: (set) of logical IDs resource refers to or lists in DependsOn, pseudo parameters included
+    """
+    names = set(name for kind, name, _ in references(resource) if kind == 'ref')
+    depends_on = resource.get('DependsOn', [])
+    names.update([depends_on] if isinstance(depends_on, str) else depends_on)
+    return names
+
+
+def rewrite(value, replace):
+    """
+    Copies a piece of a rendered template, replacing references
+    :param replace: callable (name, attribute) -> (dict, string) the intrinsic to use instead and the variable
+                    to use inside Fn::Sub, or None to keep the reference
+    """
+    if isinstance(value, list):
+        return [rewrite(v, replace) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        (key, argument), = value.items()
+        if key == 'Ref' and isinstance(argument, str):
+            replacement = replace(argument, None)
+            return replacement[0] if replacement else value
+        if key == 'Fn::GetAtt':
+            name, attribute = argument.split('.', 1) if isinstance(argument, str) else argument[:2]
+            replacement = replace(name, attribute) if isinstance(attribute, str) else None
+            return replacement[0] if replacement else {key: rewrite(argument, replace)}
+        if key == 'Fn::Sub':
+            text, variables = (argument, {}) if isinstance(argument, str) else (argument[0], argument[1])
+
+            def substitute(match):
+                name, _, attribute = match.group(1).partition('.')
+                replacement = None if name in variables else replace(name, attribute or None)
+                return '${{{}}}'.format(replacement[1]) if replacement else match.group(0)
+
+            text = _SUB_VARIABLE.sub(substitute, text)
+            return {key: text if isinstance(argument, str) else [text, rewrite(variables, replace)]}
+    return dict((k, rewrite(v, replace)) for k, v in value.items())
+
+
+def _parameter_name(name, attribute):
+    return re.sub('[^a-zA-Z0-9]', '', name + (attribute or ''))
+
+
+def _components(resources, keep=()):
+    """
+    Groups resources that have to stay together, in the order they appear in the template: everything a hub
+    (a resource several others refer to) depends on stays in the parent, the rest is grouped by references.
+    :param keep: (iterable) logical IDs that stay in the parent anyway, like those already deployed there
+    :return: (set, list) logical IDs that stay in the parent, and lists of logical IDs that can move together
+    """
+    logical_ids = set(resources)
+    dependencies = dict((logical_id, resource_dependencies(resource) & logical_ids)
+                        for logical_id, resource in resources.items())
+    referrers = dict((logical_id, set()) for logical_id in resources)
+    for logical_id, names in dependencies.items():
+        for name in names:
+            referrers[name].add(logical_id)
+
+    parent = set(logical_id for logical_id, names in referrers.items() if len(names) >= HUB_REFERRERS)
+    parent.update(logical_id for logical_id in keep if logical_id in logical_ids)
+    pending = list(parent)
+    while pending:
+        for name in dependencies[pending.pop()]:
+            if name not in parent:
+                parent.add(name)
+                pending.append(name)
+
+    # union-find over the references between resources that may move
+    leader = dict((logical_id, logical_id) for logical_id in resources if logical_id not in parent)
+
+    def find(logical_id):
+        while leader[logical_id] != logical_id:
+            leader[logical_id] = leader[leader[logical_id]]
+            logical_id = leader[logical_id]
+        return logical_id
+
+    for logical_id in leader:
+        for name in dependencies[logical_id]:
+            if name in leader:
+                leader[find(name)] = find(logical_id)
+
+    components = {}
+    for logical_id in resources:
+        if logical_id in leader:
+            components.setdefault(find(logical_id), []).append(logical_id)
+    order = dict((logical_id, i) for i, logical_id in enumerate(resources))
+    return parent, sorted(components.values(), key=lambda c: order[c[0]])
+
+
+def _size(logical_id, resource):
+    # as serialized by dumps(), two levels deep in the Resources section
+    text = json.dumps({logical_id: resource}, indent=4, sort_keys=True, separators=(',', ': '))
+    return len(text.encode('utf-8')) + 8 * text.count('\n')
+
+
+class _Child(object):
+
+    def __init__(self, logical_id):
+        self.logical_id = logical_id
+        self.resources = []
+        self.size = 0
+        self.parameters = set()
+        self.stack = None
+
+    def fits(self, resources, size, parameters):
+        return len(self.resources) + len(resources) <= MAX_RESOURCES * HEADROOM and \
+            self.size + size <= MAX_TEMPLATE_BYTES * HEADROOM and \
+            len(self.parameters | parameters) <= MAX_PARAMETERS * HEADROOM
+
+
+def _child_number(logical_id):
+    return int(logical_id[len(CHILD_PREFIX):])
+
+
+def split_template(rendered, old_location=None):
+    """
+    Splits a rendered template into a parent template and nested child stack templates.
+
+    Resources other resources share stay in the parent, together with everything they depend on. The other
+    resources are grouped along their references and packed into children, in template order. When the stack
+    is already split (old_location), every resource keeps the stack it is deployed in and only new resources
+    are placed, in the child their group is in or else the last child, so resources do not move as the template
+    grows or shrinks. A child refers to resources and parameters of the parent through its own parameters;
+    outputs of the parent that refer to resources of a child read them from the child's outputs. Conditions and
+    mappings are copied where they are used.
+
+    Note that CloudFormation creates a resource that moves to another stack anew, and deletes (or retains)
+    the old one. Resources only move when their references change so that they have to: a resource that
+    becomes shared moves to the parent, groups that now refer to each other move to one child.
+    :param rendered: (dict) rendered template
+    :param old_location: (dict) logical ID -> nested stack holding it (None for the parent) in the deployed
+                         stack, as returned by merge_template()
+    :return: (dict, dict) the parent template, and child logical ID -> child template. The children's
+             AWS::CloudFormation::Stack resources in the parent still need a TemplateURL.
+    """
+    resources = rendered.get('Resources', {})
+    # an unsplit stack has every resource in the parent, which says nothing about where they belong
+    old_location = old_location if old_location and any(old_location.values()) else {}
+    parent_ids, components = _components(
+        resources, keep=[logical_id for logical_id, child_id in old_location.items() if child_id is None])
+    parent_parameters = rendered.get('Parameters', {})
+
+    def add(child, component, size, parameters):
+        child.resources.extend(component)
+        child.size += size
+        child.parameters.update(parameters)
+
+    deployed = dict((child_id, _Child(child_id)) for child_id in set(old_location.values()) if child_id)
+    children = sorted(deployed.values(), key=lambda c: _child_number(c.logical_id))
+    last_number = _child_number(children[-1].logical_id) if children else 0
+    for component in components:
+        size = sum(_size(logical_id, resources[logical_id]) for logical_id in component)
+        parameters = set()
+        for logical_id in component:
+            parameters.update(_parameter_name(n, a) for k, n, a in references(resources[logical_id])
+                              if k == 'ref' and (n in parent_ids or n in parent_parameters))
+        # a group stays in the child most of its deployed resources are in, new groups go to the last child
+        counts = {}
+        for logical_id in component:
+            if old_location.get(logical_id):
+                counts[old_location[logical_id]] = counts.get(old_location[logical_id], 0) + 1
+        if counts:
+            add(deployed[max(sorted(counts), key=counts.get)], component, size, parameters)
+            continue
+        if not children or not children[-1].fits(component, size, parameters):
+            last_number += 1
+            children.append(_Child('{}{}'.format(CHILD_PREFIX, last_number)))
+            if not children[-1].fits(component, size, parameters):
+                raise SplitError('{} resources that refer to each other are too large for one nested stack: {}'
+                                 .format(len(component), ', '.join(component[:5])))
+        add(children[-1], component, size, parameters)
+    # children whose resources are all gone are deleted
+    children = [child for child in children if child.resources]
+
+    location = dict((logical_id, child.logical_id) for child in children for logical_id in child.resources)
+    templates = {}
+    child_outputs = dict((child.logical_id, {}) for child in children)
+
+    for child in children:
+        template_parameters = {}
+        stack_parameters = {}
+        depends_on = set()
+        conditions = set()
+        mappings = set()
+
+        def replace(name, attribute):
+            if name in PARENT_PSEUDO_PARAMETERS:
+                parameter = PARENT_PSEUDO_PARAMETERS[name]
+                template_parameters[parameter] = {'Type': 'String'}
+                stack_parameters[parameter] = {'Ref': name}
+            elif name in parent_parameters:
+                parameter = name
+                template_parameters[parameter] = parent_parameters[name]
+                if parent_parameters[name].get('Type', 'String').startswith('List<') or \
+                        parent_parameters[name].get('Type') == 'CommaDelimitedList':
+                    stack_parameters[parameter] = {'Fn::Join': [',', {'Ref': name}]}
+                else:
+                    stack_parameters[parameter] = {'Ref': name}
+            elif name in parent_ids:
+                parameter = _parameter_name(name, attribute)
+                template_parameters[parameter] = {'Type': 'String'}
+                stack_parameters[parameter] = {'Fn::GetAtt': [name, attribute]} if attribute else {'Ref': name}
+            else:
+                return None
+            return {'Ref': parameter}, parameter
+
+        child_resources = {}
+        moved_depends_on = {}
+        for logical_id in child.resources:
+            resource = rewrite(resources[logical_id], replace)
+            if 'DependsOn' in resource:
+                # references to the parent become parameters, explicit dependencies move to the stack resource
+                local_depends_on = []
+                for name in [resource['DependsOn']] if isinstance(resource['DependsOn'], str) \
+                        else resource['DependsOn']:
+                    if location.get(name) == child.logical_id:
+                        local_depends_on.append(name)
+                    else:
+                        depends_on.add(name)
+                if local_depends_on != resource['DependsOn']:
+                    moved_depends_on[logical_id] = resource['DependsOn']
+                if local_depends_on:
+                    resource['DependsOn'] = local_depends_on
+                else:
+                    del resource['DependsOn']
+            child_resources[logical_id] = resource
+            for kind, name, _ in references(resources[logical_id]):
+                if kind == 'condition':
+                    conditions.add(name)
+                elif kind == 'mapping':
+                    mappings.add(name)
+
+        # conditions may use other conditions, parameters and mappings
+        all_conditions = rendered.get('Conditions', {})
+        pending = list(conditions)
+        while pending:
+            for kind, name, _ in references(all_conditions[pending.pop()]):
+                if kind == 'condition' and name not in conditions:
+                    conditions.add(name)
+                    pending.append(name)
+                elif kind == 'mapping':
+                    mappings.add(name)
+                elif kind == 'ref':
+                    replace(name, None)
+
+        template = {
+            'AWSTemplateFormatVersion': rendered.get('AWSTemplateFormatVersion', '2010-09-09'),
+            'Description': '{} ({} of {})'.format(rendered.get('Description', 'Nested stack'),
+                                                child.logical_id, len(children)),
+            'Resources': child_resources,
+        }
+        if template_parameters:
+            template['Parameters'] = template_parameters
+        if moved_depends_on:
+            template['Metadata'] = {DEPENDS_ON_METADATA: moved_depends_on}
+        if conditions:
+            template['Conditions'] = dict((name, all_conditions[name]) for name in conditions)
+        if mappings:
+            template['Mappings'] = dict((name, rendered['Mappings'][name]) for name in mappings)
+        templates[child.logical_id] = template
+
+        stack = {'Type': STACK_TYPE, 'Properties': {'Parameters': stack_parameters}}
+        if depends_on:
+            stack['DependsOn'] = sorted(depends_on)
+        child.stack = stack
+
+    def replace_in_parent(name, attribute):
+        if name not in location:
+            return None
+        output = _parameter_name(name, attribute)
+        child_outputs[location[name]][output] = {'Fn::GetAtt': [name, attribute]} if attribute else {'Ref': name}
+        return {'Fn::GetAtt': [location[name], 'Outputs.{}'.format(output)]}, '{}.Outputs.{}'.format(
+            location[name], output)
+
+    parent = dict((key, value) for key, value in rendered.items() if key not in ('Resources', 'Outputs'))
+    parent['Resources'] = dict((logical_id, resources[logical_id]) for logical_id in resources
+                               if logical_id in parent_ids)
+    if 'Outputs' in rendered:
+        parent['Outputs'] = rewrite(rendered['Outputs'], replace_in_parent)
+    for child in children:
+        parent['Resources'][child.logical_id] = child.stack
+        if child_outputs[child.logical_id]:
+            if len(child_outputs[child.logical_id]) > MAX_OUTPUTS:
+                raise SplitError('{} would need more than {} outputs'.format(child.logical_id, MAX_OUTPUTS))
+            templates[child.logical_id]['Outputs'] = dict(
+                (name, {'Value': value}) for name, value in child_outputs[child.logical_id].items())
+
+    for logical_id, template in templates.items():
+        if len(template['Resources']) > MAX_RESOURCES:
+            raise SplitError('{} has more than {} resources'.format(logical_id, MAX_RESOURCES))
+        if len(dumps(template).encode('utf-8')) > MAX_TEMPLATE_BYTES:
+            raise SplitError('{} is larger than {} bytes'.format(logical_id, MAX_TEMPLATE_BYTES))
+    if len(parent['Resources']) > MAX_RESOURCES:
+        raise SplitError('{} resources are shared and have to stay in the parent stack, more than {}'.format(
+            len(parent_ids), MAX_RESOURCES))
+    return parent, templates
+
+
+def child_stacks(template):
+    """
+    :return: (list) logical IDs of the nested stacks split_template() created in a (deployed) template
+    """
+    return sorted(logical_id for logical_id, resource in template.get('Resources', {}).items()
+                  if resource.get('Type') == STACK_TYPE and logical_id.startswith(CHILD_PREFIX))
+
+
+def _parameter_values(stack):
+    """
+    :param stack: (dict) AWS::CloudFormation::Stack resource of a child in the parent template
+    :return: callable for rewrite() that turns references to the child's parameters back into what the parent
+             passes them, e.g. the Fn::GetAtt or pseudo parameter the child referred to before it was split off
+    """
+    values = stack.get('Properties', {}).get('Parameters', {})
+
+    def replace(name, attribute):
+        if attribute or name not in values:
+            return None
+        value = values[name]
+        if 'Fn::Join' in value:
+            # list parameters are passed joined
+            value = value['Fn::Join'][1]
+        if 'Ref' in value:
+            return value, value['Ref']
+        return value, '.'.join(value['Fn::GetAtt'])
+    return replace
+
+
+def merge_template(parent, children):
+    """
+    Puts the resources of nested child stacks back into their parent, so a split template can be compared
+    with an unsplit render. The references split_template() rewrote are restored: parameters of a child become
+    the references to the parent they stand for, DependsOn moved to the stack resource returns to the resource,
+    and outputs of the parent that read a child's outputs refer to the child's resources again.
+    :param children: (dict) child logical ID -> child template
+    :return: (dict, dict) the merged template, and logical ID -> logical ID of the nested stack holding it
+             (None for resources of the parent)
+    """
+    resources = parent.get('Resources', {})
+    merged = dict(parent)
+    merged['Resources'] = dict((logical_id, resource) for logical_id, resource in resources.items()
+                               if logical_id not in children)
+    location = dict((logical_id, None) for logical_id in merged['Resources'])
+    for child_id, child in sorted(children.items()):
+        replace = _parameter_values(resources.get(child_id, {}))
+        depends_on = child.get('Metadata', {}).get(DEPENDS_ON_METADATA, {})
+        for logical_id, resource in child.get('Resources', {}).items():
+            resource = rewrite(resource, replace)
+            if logical_id in depends_on:
+                resource['DependsOn'] = depends_on[logical_id]
+            merged['Resources'][logical_id] = resource
+            location[logical_id] = child_id
+
+    def child_output(name, attribute):
+        if name not in children or not (attribute or '').startswith('Outputs.'):
+            return None
+        value = children[name].get('Outputs', {}).get(attribute[len('Outputs.'):], {}).get('Value')
+        if value is None:
+            return None
+        return value, value['Ref'] if 'Ref' in value else '.'.join(value['Fn::GetAtt'])
+
+    if 'Outputs' in parent:
+        merged['Outputs'] = rewrite(parent['Outputs'], child_output)
+    return merged, location
+
+
+def moved_resources(old_location, new_location):
+    """
+    :return: (list) of (logical ID, old stack, new stack) for resources that exist in both layouts but in
+             different stacks; None stands for the parent stack
+    """
+    return [(logical_id, old_location[logical_id], new_location[logical_id])
+            for logical_id in sorted(set(old_location) & set(new_location))
+            if old_location[logical_id] != new_location[logical_id]]
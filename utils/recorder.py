@@ -0,0 +1,125 @@
+import atexit
+import base64
+import copy
+import datetime
+import json
+import logging
+import os
+import threading
+
+from botocore.awsrequest import AWSResponse
+
+from utils.aws import get_session
+
+logger = logging.getLogger(__name__)
+
+FIXTURE_VERSION = 1
+
+
+class ReplayMissError(RuntimeError):
+    pass
+
+
+def _encode(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.isoformat()}
+    if isinstance(obj, bytes):
+        return {'__bytes__': base64.b64encode(obj).decode('ascii')}
+    return {'__repr__': repr(obj)}
+
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    if '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+def _call_key(service, operation, params):
+    return '{}.{} {}'.format(service, operation, json.dumps(params, sort_keys=True, default=_encode))
+
+
+class AWSRecorder(object):
+    """
+    Records every botocore response to a JSON fixture, or replays a fixture without touching the network.
+
+    Hooks are registered on the botocore event system, so they cover every client and resource created from
+    the session afterwards. Calls are matched on service, operation and parameters; repeated calls with the
+    same parameters replay their recorded responses in order, repeating the last one when exhausted.
+    """
+
+    def __init__(self, path, mode):
+        if mode not in ('record', 'replay'):
+            raise ValueError('Recorder mode must be record or replay: {}'.format(mode))
+        self.path = path
+        self.mode = mode
+        self.calls = []
+        self._responses = {}
+        self._lock = threading.Lock()
+
+    def install(self, session=None):
+        """
+        Registers the recorder with the botocore event system. Must run before clients are created.
+        """
+        events = (session or get_session()).events
+        events.register_first('before-parameter-build.*.*', self._capture_params,
+                              unique_id='rain-recorder-params')
+        if self.mode == 'replay':
+            self.load()
+            events.register_first('before-call.*.*', self._replay, unique_id='rain-recorder-replay')
+        else:
+            events.register_last('after-call.*.*', self._record, unique_id='rain-recorder-record')
+            atexit.register(self.save)
+        return self
+
+    def _capture_params(self, params, model, context, **kwargs):
+        # the API parameters as the caller passed them, before botocore serializes them for the wire
+        context['rain_params'] = copy.deepcopy(params)
+
+    def _record(self, http_response, parsed, model, context, **kwargs):
+        # request IDs and headers change on every call, leave them out so fixtures diff cleanly
+        response = dict((k, v) for k, v in parsed.items() if k != 'ResponseMetadata')
+        with self._lock:
+            self.calls.append({
+                'service': model.service_model.service_name,
+                'operation': model.name,
+                'params': context.get('rain_params', {}),
+                'status': http_response.status_code,
+                'response': response
+            })
+
+    def _replay(self, model, context, **kwargs):
+        service = model.service_model.service_name
+        key = _call_key(service, model.name, context.get('rain_params', {}))
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                raise ReplayMissError('No recorded response in {} for {}'.format(self.path, key))
+            call = responses.pop(0) if len(responses) > 1 else responses[0]
+        http_response = AWSResponse('https://{}.replay'.format(service), call['status'], {}, None)
+        parsed = copy.deepcopy(call['response'])
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': call['status'], 'HTTPHeaders': {}, 'RetryAttempts': 0}
+        return http_response, parsed
+
+    def load(self):
+        with open(self.path) as f:
+            fixture = json.load(f, object_hook=_decode)
+        if fixture.get('version') != FIXTURE_VERSION:
+            raise ValueError('Unsupported fixture version in {}: {}'.format(self.path, fixture.get('version')))
+        self.calls = fixture['calls']
+        self._responses = {}
+        for call in self.calls:
+            key = _call_key(call['service'], call['operation'], call['params'])
+            self._responses.setdefault(key, []).append(call)
+
+    def save(self):
+        if self.mode != 'record':
+            return
+        with self._lock:
+            if os.path.dirname(self.path) and not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path, 'w') as f:
+                json.dump({'version': FIXTURE_VERSION, 'calls': self.calls}, f, indent=2, sort_keys=True,
+                          default=_encode)
+        logger.info('Recorded %d AWS calls to %s', len(self.calls), self.path)
@@ -0,0 +1,125 @@
+import concurrent.futures
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class DependencyError(Exception):
+    pass
+
+
+def find_imports(obj):
+    """
+    Returns every Fn::ImportValue name used in a rendered template
+    :param obj: (dict) template as returned by Template.to_dict()
+    :return: (set) of imported export names (only literal names can be resolved)
+    """
+    imports = set()
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            if 'Fn::ImportValue' in value and isinstance(value['Fn::ImportValue'], str):
+                imports.add(value['Fn::ImportValue'])
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return imports
+
+
+def find_exports(obj):
+    """
+    Returns every export name declared in a rendered template's Outputs
+    :param obj: (dict) template as returned by Template.to_dict()
+    :return: (set) of export names (only literal names can be resolved)
+    """
+    exports = set()
+    for output in obj.get('Outputs', {}).values():
+        name = output.get('Export', {}).get('Name')
+        if isinstance(name, str):
+            exports.add(name)
+    return exports
+
+
+class StackGraph(object):
+    """
+    Dependency graph between templates of one environment. An edge node -> dependency means the
+    dependency's stack must be applied successfully before node's stack is rendered and applied.
+    """
+
+    def __init__(self):
+        self.dependencies = {}
+
+    def add_node(self, node):
+        self.dependencies.setdefault(node, set())
+
+    def add_edge(self, node, dependency):
+        self.add_node(node)
+        self.add_node(dependency)
+        if node != dependency:
+            self.dependencies[node].add(dependency)
+
+    def dependents(self, node):
+        return set(n for n, deps in self.dependencies.items() if node in deps)
+
+    def levels(self):
+        """
+        Groups nodes into levels where every node only depends on nodes of earlier levels
+        :return: (list) of sorted lists of nodes
+        """
+        remaining = dict((n, set(deps)) for n, deps in self.dependencies.items())
+        levels = []
+        while remaining:
+            ready = sorted(n for n, deps in remaining.items() if not deps)
+            if not ready:
+                raise DependencyError('Dependency cycle between stacks: {}'.format(', '.join(sorted(remaining))))
+            levels.append(ready)
+            for n in ready:
+                del remaining[n]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return levels
+
+    def run(self, fn, parallelism=4):
+        """
+        Calls fn(node) for every node, starting each node as soon as all of its dependencies succeeded and
+        running up to parallelism nodes at once. After the first failure no new nodes are started; nodes
+        already running are allowed to finish.
+        :param fn: callable returning True on success; exceptions count as failures
+        :return: (dict) node -> 'succeeded', 'failed' or 'skipped'
+        """
+        self.levels()  # fail on cycles before starting anything
+        results = {}
+        lock = threading.Lock()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+            running = {}
+
+            def start_ready():
+                for node in sorted(self.dependencies):
+                    if node in results or node in running.values():
+                        continue
+                    if all(results.get(d) == 'succeeded' for d in self.dependencies[node]):
+                        running[executor.submit(fn, node)] = node
+
+            start_ready()
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                failed = False
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        ok = future.result()
+                    except Exception:
+                        logger.exception('Applying %s failed', node)
+                        ok = False
+                    with lock:
+                        results[node] = 'succeeded' if ok else 'failed'
+                    failed = failed or not ok
+                if failed or 'failed' in results.values():
+                    continue  # fail fast: let running nodes finish, start nothing new
+                start_ready()
+
+        for node in self.dependencies:
+            results.setdefault(node, 'skipped')
+        return results
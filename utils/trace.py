@@ -0,0 +1,172 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+_tracer = None
+
+
+class Tracer(object):
+    """
+    Collects every AWS API call (through botocore's event hooks) and the wall time of named phases.
+
+    For each call the tracer records latency, retries, HTTP status and the IvyTemplate method (or rain.py
+    function) it was made from. report() prints everything; write_chrome_trace() exports the same data in
+    Chrome's trace event format for chrome://tracing or Perfetto.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.phases = []
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def install(self, session=None):
+        """
+        Registers the tracer with the botocore event system. Install before --record/--replay so replayed
+        calls are traced too.
+        """
+        if session is None:
+            from utils.aws import get_session
+            session = get_session()
+        events = session.events
+        events.register_first('before-call.*.*', self._before_call, unique_id='rain-trace-before')
+        events.register_last('after-call.*.*', self._after_call, unique_id='rain-trace-after')
+        events.register_last('after-call-error.*.*', self._after_call_error, unique_id='rain-trace-error')
+        return self
+
+    @staticmethod
+    def _caller():
+        """
+        :return: (string) the innermost IvyTemplate method, or rain.py function, on the current stack
+        """
+        frame = sys._getframe(2)
+        fallback = None
+        while frame is not None:
+            owner = frame.f_locals.get('self')
+            if owner is not None and any(c.__name__ == 'IvyTemplate' for c in type(owner).__mro__):
+                return '{}.{}'.format(type(owner).__name__, frame.f_code.co_name)
+            if fallback is None and os.path.basename(frame.f_code.co_filename) == 'rain.py':
+                fallback = 'rain.{}'.format(frame.f_code.co_name)
+            frame = frame.f_back
+        return fallback or '-'
+
+    def _before_call(self, model, context, **kwargs):
+        context['rain_trace'] = {
+            'service': model.service_model.service_name,
+            'operation': model.name,
+            'caller': self._caller(),
+            'thread': threading.get_ident(),
+            'start': time.perf_counter(),
+        }
+
+    def _finish(self, context, status, retries):
+        call = context.get('rain_trace')
+        if call is None:
+            return
+        call['duration'] = time.perf_counter() - call['start']
+        call['status'] = status
+        call['retries'] = retries
+        with self._lock:
+            self.calls.append(call)
+
+    def _after_call(self, http_response, parsed, context, **kwargs):
+        self._finish(context, http_response.status_code, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+
+    def _after_call_error(self, exception, context, **kwargs):
+        self._finish(context, type(exception).__name__, None)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append({'name': name, 'start': start, 'duration': time.perf_counter() - start,
+                                    'thread': threading.get_ident()})
+
+    def report(self, out=sys.stderr):
+        total = time.perf_counter() - self.started
+
+        def write(line=''):
+            out.write(line + '\n')
+
+        write()
+        write('AWS calls: {} in {:.3f}s'.format(len(self.calls), sum(c['duration'] for c in self.calls)))
+        for call in sorted(self.calls, key=lambda c: c['start']):
+            write('  {:>8.1f}ms  {:>7.3f}s  {}.{:<32} status {:<4} retries {:<2} {}'.format(
+                call['duration'] * 1e3, call['start'] - self.started, call['service'], call['operation'],
+                call['status'], call['retries'] if call['retries'] is not None else '-', call['caller']))
+
+        by_operation = {}
+        for call in self.calls:
+            entry = by_operation.setdefault('{}.{}'.format(call['service'], call['operation']), [0, 0.0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += call['duration']
+            entry[2] = max(entry[2], call['duration'])
+            entry[3] += call['retries'] or 0
+        write()
+        write('{:<48} {:>6} {:>10} {:>10} {:>8}'.format('Operation', 'calls', 'total ms', 'max ms', 'retries'))
+        for operation, (count, duration, longest, retries) in sorted(by_operation.items(),
+                                                                      key=lambda i: -i[1][1]):
+            write('{:<48} {:>6} {:>10.1f} {:>10.1f} {:>8}'.format(operation, count, duration * 1e3,
+                                                                   longest * 1e3, retries))
+
+        by_phase = {}
+        for phase in self.phases:
+            entry = by_phase.setdefault(phase['name'], [0, 0.0])
+            entry[0] += 1
+            entry[1] += phase['duration']
+        write()
+        write('{:<48} {:>6} {:>10}'.format('Phase (inclusive)', 'count', 'total ms'))
+        for name, (count, duration) in sorted(by_phase.items(), key=lambda i: -i[1][1]):
+            write('{:<48} {:>6} {:>10.1f}'.format(name, count, duration * 1e3))
+        write('{:<48} {:>6} {:>10.1f}'.format('total', '', total * 1e3))
+
+    def write_chrome_trace(self, path):
+        """
+        Writes phases and AWS calls as complete ('X') events of Chrome's trace event format
+        """
+        pid = os.getpid()
+        events = [{
+            'name': phase['name'], 'cat': 'phase', 'ph': 'X', 'pid': pid, 'tid': phase['thread'],
+            'ts': (phase['start'] - self.started) * 1e6, 'dur': phase['duration'] * 1e6,
+        } for phase in self.phases] + [{
+            'name': '{}.{}'.format(call['service'], call['operation']), 'cat': 'aws', 'ph': 'X', 'pid': pid,
+            'tid': call['thread'], 'ts': (call['start'] - self.started) * 1e6, 'dur': call['duration'] * 1e6,
+            'args': {'caller': call['caller'], 'status': str(call['status']), 'retries': call['retries']},
+        } for call in self.calls]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def enable():
+    """
+    Starts tracing for the rest of the process
+    :return: (Tracer)
+    """
+    global _tracer
+    _tracer = Tracer().install()
+    return _tracer
+
+
+def get_tracer():
+    """
+    :return: (Tracer) the active tracer, None when tracing is off
+    """
+    return _tracer
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Times the enclosed block as phase name when tracing is on, does nothing otherwise
+    """
+    if _tracer is None:
+        yield
+    else:
+        with _tracer.phase(name):
+            yield